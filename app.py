@@ -1,30 +1,1449 @@
 """
 FamilyConnect Pro - Multi-Family Edition with Admin Panel
 Install: pip install gradio pillow
-Run in Google Colab or local environment
+Run in Google Colab or local environment: `python app.py` serves on PORT (default 7860);
+in Colab, or with FAMILYCONNECT_SHARE=1, it launches through Gradio with a public share link
+Persistence: set FAMILYCONNECT_DB=/path/to/familyconnect.db to keep data in SQLite
+(at most FAMILYCONNECT_LOADED_FAMILIES, default 64, are held in memory at once)
+Images are stored under FAMILYCONNECT_BLOBS (default ./familyconnect_blobs) and served from /blobs
+Metrics: Prometheus text at /metrics and an admin Performance panel (FAMILYCONNECT_METRICS=0 disables)
+Scaling out: FAMILYCONNECT_WORKERS=N (with FAMILYCONNECT_DB) runs N processes; link families to /family/CODE
 """
 
 import gradio as gr
-from datetime import datetime, timedelta
-import random
+from datetime import date, datetime, timedelta
 import string
-import base64
-from io import BytesIO
+import asyncio
+import bisect
+import hashlib
+import heapq
+import hmac
+import html
+import inspect
+import itertools
+import json
+import logging
+import math
+import os
+import re
+import secrets
+import shutil
+import socket
+import sqlite3
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import Counter, OrderedDict, deque
+from functools import partial, wraps
+from operator import itemgetter
+from types import MappingProxyType
+from urllib.parse import urlencode
+
+log = logging.getLogger("familyconnect")
+
+# Storage backends
+FAMILY_COLLECTIONS = ("announcements", "messages", "events", "tasks", "photos", "polls", "stories")
+
+def find_by_id(items, record_id):
+    """Item with `record_id` in an id-ordered list (None if absent)"""
+    i = bisect.bisect_left(items, record_id, key=itemgetter('id'))
+    if i < len(items) and items[i]['id'] == record_id:
+        return items[i]
+    return None
+
+def remove_by_id(items, record_id):
+    """Remove and return the item with `record_id` from an id-ordered list (None if absent)"""
+    i = bisect.bisect_left(items, record_id, key=itemgetter('id'))
+    if i < len(items) and items[i]['id'] == record_id:
+        return items.pop(i)
+    return None
+
+def insert_by_id(items, record):
+    """Add `record` to an id-ordered list; appends unless its id is out of order"""
+    if items and items[-1]['id'] >= record['id']:
+        bisect.insort(items, record, key=itemgetter('id'))
+    else:
+        items.append(record)
+
+BLOB_COLLECTIONS = ("photos", "stories")  # collections whose items can reference blobs (as can users)
+
+def record_blob_keys(record):
+    """Blob keys referenced by a collection item or user"""
+    keys = set()
+    for field in ('blob', 'profile_pic'):
+        ref = record.get(field)
+        if ref and not ref.startswith("data:"):
+            keys.add(ref)
+    for field in ('variants', 'profile_variants'):
+        keys.update(variant['key'] for variant in (record.get(field) or {}).values())
+    return keys
+
+def new_family_record(name, code, created=None):
+    """Empty family document with every collection initialised"""
+    family = {"name": name, "code": code, "created": created or datetime.now().isoformat(), "users": {}}
+    for collection in FAMILY_COLLECTIONS:
+        family[collection] = []
+    return family
+
+# Compact records
+# Items of the high-volume collections are held as slotted objects rather than
+# dicts: no per-item hash table, author/role strings shared via sys.intern,
+# 'timestamp' kept as integer epoch seconds, and reaction/comment/attendee
+# containers left unallocated until something is written to them. They still
+# behave like the dicts callers expect (record['x'], .get, `in`, assignment).
+EMPTY_MAPPING = MappingProxyType({})
+_UNSET = object()
+
+def to_epoch(value):
+    """Epoch seconds of an ISO timestamp (numbers pass through)"""
+    if isinstance(value, str):
+        return int(datetime.fromisoformat(value).timestamp())
+    return value
+
+def to_datetime(value):
+    """Local datetime of an ISO timestamp or epoch seconds"""
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value)
+    return datetime.fromisoformat(value)
+
+class CompactRecord:
+    __slots__ = ("_extra",)
+    FIELDS = ()               # slots, named after the dict keys they replace
+    INTERNED = frozenset()    # short strings repeated across items
+    LAZY = {}                 # field: read-only empty value until first written
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._field_set = frozenset(cls.FIELDS)
+
+    def __init__(self, data=None):
+        self._extra = None  # any keys beyond FIELDS
+        for key, value in (data or {}).items():
+            self[key] = value
+
+    def __setitem__(self, key, value):
+        if key not in self._field_set:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+            return
+        if key == 'timestamp':
+            try:
+                value = to_epoch(value)
+            except (TypeError, ValueError):
+                pass  # keep an unparseable legacy value as is
+        elif key in self.INTERNED and type(value) is str:
+            value = sys.intern(value)
+        elif key in self.LAZY and not value:
+            value = None
+        setattr(self, key, value)
+
+    def __getitem__(self, key):
+        value = self.get(key, _UNSET)
+        if value is _UNSET:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        if key in self._field_set:
+            value = getattr(self, key, None)
+            if value is None:
+                if key in self.LAZY:
+                    return self.LAZY[key]
+                if not hasattr(self, key):
+                    return default
+            return value
+        if self._extra is not None:
+            return self._extra.get(key, default)
+        return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def keys(self):
+        keys = [key for key in self.FIELDS if key in self]
+        if self._extra:
+            keys.extend(self._extra)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def update(self, other):
+        for key, value in other.items():
+            self[key] = value
+
+    def container(self, key):
+        """Mutable reactions/comments/attendees container, allocated on first use"""
+        value = getattr(self, key, None)
+        if value is None:
+            value = {} if isinstance(self.LAZY[key], MappingProxyType) else []
+            setattr(self, key, value)
+        return value
+
+    def to_dict(self):
+        """The plain dict layout (ISO timestamp, empty containers) used for JSON"""
+        data = {}
+        for key in self.keys():
+            value = self[key]
+            if key == 'timestamp' and isinstance(value, (int, float)):
+                value = datetime.fromtimestamp(value).isoformat()
+            elif key in self.LAZY and not value:
+                value = {} if isinstance(self.LAZY[key], MappingProxyType) else []
+            data[key] = value
+        return data
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+class MessageRecord(CompactRecord):
+    FIELDS = ("id", "author", "role", "content", "timestamp", "reactions", "rev")
+    __slots__ = FIELDS
+    INTERNED = frozenset({"author", "role"})
+    LAZY = {"reactions": EMPTY_MAPPING}
+
+class AnnouncementRecord(CompactRecord):
+    FIELDS = ("id", "author", "role", "content", "timestamp", "type", "priority", "reactions", "comments", "rev")
+    __slots__ = FIELDS
+    INTERNED = frozenset({"author", "role", "type", "priority"})
+    LAZY = {"reactions": EMPTY_MAPPING, "comments": ()}
+
+class TaskRecord(CompactRecord):
+    FIELDS = ("id", "task", "assigned_to", "status", "due", "created_by")
+    __slots__ = FIELDS
+    INTERNED = frozenset({"assigned_to", "status", "due", "created_by"})
+
+class EventRecord(CompactRecord):
+    FIELDS = ("id", "title", "date", "time", "location", "creator", "attendees")
+    __slots__ = FIELDS
+    INTERNED = frozenset({"date", "time", "location", "creator"})
+    LAZY = {"attendees": ()}
+
+class StoryRecord(CompactRecord):
+    FIELDS = ("id", "author", "role", "content", "timestamp", "variants")
+    __slots__ = FIELDS
+    INTERNED = frozenset({"author", "role"})
+
+COMPACT_RECORD_TYPES = {
+    "messages": MessageRecord, "announcements": AnnouncementRecord, "tasks": TaskRecord,
+    "events": EventRecord, "stories": StoryRecord,
+}
+
+def compact_record(collection, record):
+    """Item in its in-memory layout (collections without a compact type stay dicts)"""
+    record_type = COMPACT_RECORD_TYPES.get(collection)
+    if record_type is None or isinstance(record, CompactRecord):
+        return record
+    return record_type(record)
+
+def json_default(value):
+    """json.dumps hook: compact records serialize as their dict layout, reaction
+    user sets as lists"""
+    if isinstance(value, CompactRecord):
+        return value.to_dict()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+class MemoryStorage:
+    """Keeps every family in a process-local dict (lost on restart)"""
+
+    def __init__(self):
+        self._families = {}
+        self._sequences = {}  # (family_code, collection): last id handed out
+        self._secrets = {}
+        self._blob_refs = Counter()  # blob key: items referencing it
+        self._blob_keys = {}         # (family_code, collection, id or username): blob keys it references
+        self._item_bytes = {}        # (family_code, collection, id or username): JSON size
+        self._bytes = Counter()      # (family_code, collection): JSON size of its items
+        # Writes to different families run concurrently; this guards what they share
+        self._lock = threading.Lock()
+
+    def _track(self, code, collection, key, record):
+        """Keep an item's size and blob references current after a write (record None: removed)"""
+        size = len(json.dumps(record, default=json_default).encode()) if record is not None else 0
+        with self._lock:
+            old = self._item_bytes.pop((code, collection, key), 0)
+            if record is not None:
+                self._item_bytes[(code, collection, key)] = size
+            self._bytes[(code, collection)] += size - old
+        if collection == 'users' or collection in BLOB_COLLECTIONS:
+            self._set_blobs(code, collection, key, record)
+
+    def _set_blobs(self, code, collection, key, record):
+        """Move reference counts from the blobs an item referenced to those it references now"""
+        new = record_blob_keys(record) if record is not None else set()
+        with self._lock:
+            old = self._blob_keys.pop((code, collection, key), set())
+            if new:
+                self._blob_keys[(code, collection, key)] = new
+            for blob in new - old:
+                self._blob_refs[blob] += 1
+            for blob in old - new:
+                self._blob_refs[blob] -= 1
+                if self._blob_refs[blob] <= 0:
+                    del self._blob_refs[blob]
+
+    def family_codes(self):
+        return list(self._families)
+
+    def has_family(self, code):
+        return code in self._families
+
+    def list_families(self):
+        return [{"code": code, "name": family['name'], "created": family['created'],
+                 "members": len(family['users'])}
+                for code, family in self._families.items()]
+
+    def load_family(self, code):
+        return self._families.get(code)
+
+    # Every family is held in memory for good, so there is nothing to evict
+    def pin(self, code):
+        pass
+
+    def unpin(self, code):
+        pass
+
+    def create_family(self, family):
+        code = family['code']
+        for collection in FAMILY_COLLECTIONS:
+            family[collection] = [compact_record(collection, record) for record in family[collection]]
+        self._families[code] = family
+        for username, user in family['users'].items():
+            self._track(code, 'users', username, user)
+        for collection in FAMILY_COLLECTIONS:
+            for record in family[collection]:
+                self._track(code, collection, record['id'], record)
+
+    def delete_family(self, code):
+        self._families.pop(code, None)
+        for collection in FAMILY_COLLECTIONS:
+            self._sequences.pop((code, collection), None)
+        for ref in [ref for ref in list(self._item_bytes) if ref[0] == code]:
+            self._track(*ref, None)
+        for collection in ('users',) + FAMILY_COLLECTIONS:
+            self._bytes.pop((code, collection), None)
+
+    def put_user(self, code, username, user):
+        self._families[code]['users'][username] = user
+        self._track(code, 'users', username, user)
+
+    def next_id(self, code, collection):
+        key = (code, collection)
+        last = self._sequences.get(key)
+        if last is None:
+            items = self._families[code][collection]
+            last = items[-1]['id'] if items else 0
+        self._sequences[key] = last + 1
+        return last + 1
+
+    def next_counter(self, name):
+        key = ("", name)
+        with self._lock:
+            self._sequences[key] = self._sequences.get(key, 0) + 1
+            return self._sequences[key]
+
+    def secret(self, name):
+        return self._secrets.setdefault(name, secrets.token_bytes(32))
+
+    def insert(self, code, collection, record):
+        self._families[code][collection].append(record)
+        self._track(code, collection, record['id'], record)
+
+    def update(self, code, collection, record):
+        # Records are mutated in place, so only the size and blob references need catching up
+        self._track(code, collection, record['id'], record)
+
+    def delete(self, code, collection, record_id):
+        """Remove one item; returns it (None if there was no such item)"""
+        family = self._families.get(code)
+        record = remove_by_id(family[collection], record_id) if family else None
+        if record is not None:
+            self._track(code, collection, record_id, None)
+        return record
+
+    def ttl_timestamps(self, code, collection):
+        """(id, timestamp) of every item in a collection"""
+        family = self._families.get(code)
+        return [(record['id'], record.get('timestamp')) for record in (family[collection] if family else ())]
+
+    def field_values(self, code, collection, field):
+        """One field of every item in a collection (None where it is missing)"""
+        family = self._families.get(code)
+        return [record.get(field) for record in (family[collection] if family else ())]
+
+    # The dict is the store itself: there is no cached copy to drop or refresh
+
+    def unload(self, code=None):
+        pass
+
+    def refresh(self, code, collection, key):
+        return None
+
+    def family_info(self, code):
+        family = self._families.get(code)
+        if family is None:
+            return None
+        return {"code": code, "name": family['name'], "created": family['created']}
+
+    def iter_users(self, code):
+        yield from list(self._families[code]['users'].items())
+
+    def iter_records(self, code):
+        for collection in FAMILY_COLLECTIONS:
+            for record in list(self._families[code][collection]):
+                yield collection, record
+
+    def begin_import(self, info):
+        self._families[info['code']] = new_family_record(info['name'], info['code'], info['created'])
+
+    def family_sizes(self):
+        """(family_code, collection, items, JSON bytes) for users and every collection,
+        from the sizes kept on write"""
+        for code, family in list(self._families.items()):
+            for collection in ('users',) + FAMILY_COLLECTIONS:
+                yield code, collection, len(family[collection]), self._bytes[(code, collection)]
+
+    def import_batch(self, code, users, records):
+        family = self._families[code]
+        for username, user in users:
+            family['users'][username] = user
+            self._track(code, 'users', username, user)
+        for collection, record in records:
+            record = compact_record(collection, record)
+            insert_by_id(family[collection], record)
+            self._track(code, collection, record['id'], record)
+
+    def blob_in_use(self, key):
+        return key in self._blob_refs
+
+LOADED_FAMILIES = int(os.environ.get("FAMILYCONNECT_LOADED_FAMILIES", "64"))
+
+class SQLiteStorage:
+    """SQLite backend (WAL mode) with one row per user and per collection item.
+
+    The connection is opened on first use and families are hydrated only when
+    they are first requested, so startup cost does not grow with history size.
+    At most max_loaded families stay hydrated; the least recently used ones
+    without a write in progress (see pin) are dropped and re-read on next use.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS families (
+            code TEXT PRIMARY KEY, name TEXT NOT NULL, created TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS users (
+            family_code TEXT NOT NULL, username TEXT NOT NULL, data TEXT NOT NULL,
+            PRIMARY KEY (family_code, username)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS records (
+            family_code TEXT NOT NULL, collection TEXT NOT NULL, item_id INTEGER NOT NULL,
+            data TEXT NOT NULL, PRIMARY KEY (family_code, collection, item_id)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS sequences (
+            family_code TEXT NOT NULL, collection TEXT NOT NULL, last_id INTEGER NOT NULL,
+            PRIMARY KEY (family_code, collection)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS blob_refs (key TEXT PRIMARY KEY, refs INTEGER NOT NULL) WITHOUT ROWID;
+    """
+    SQL_HAS_FAMILY = "SELECT 1 FROM families WHERE code = ?"
+    SQL_FAMILY_CODES = "SELECT code FROM families ORDER BY created"
+    SQL_LIST_FAMILIES = """
+        SELECT f.code, f.name, f.created, COUNT(u.username) FROM families f
+        LEFT JOIN users u ON u.family_code = f.code GROUP BY f.code ORDER BY f.created"""
+    SQL_GET_FAMILY = "SELECT name, created FROM families WHERE code = ?"
+    SQL_GET_USERS = "SELECT username, data FROM users WHERE family_code = ?"
+    SQL_GET_USER = "SELECT data FROM users WHERE family_code = ? AND username = ?"
+    SQL_GET_RECORD = "SELECT data FROM records WHERE family_code = ? AND collection = ? AND item_id = ?"
+    SQL_GET_RECORDS = "SELECT collection, data FROM records WHERE family_code = ? ORDER BY collection, item_id"
+    SQL_INSERT_FAMILY = "INSERT INTO families (code, name, created) VALUES (?, ?, ?)"
+    SQL_PUT_USER = "INSERT OR REPLACE INTO users (family_code, username, data) VALUES (?, ?, ?)"
+    SQL_INSERT_RECORD = "INSERT INTO records (family_code, collection, item_id, data) VALUES (?, ?, ?, ?)"
+    SQL_UPDATE_RECORD = "UPDATE records SET data = ? WHERE family_code = ? AND collection = ? AND item_id = ?"
+    SQL_DELETE_RECORD = "DELETE FROM records WHERE family_code = ? AND collection = ? AND item_id = ?"
+    SQL_NEXT_ID = """
+        INSERT INTO sequences (family_code, collection, last_id)
+        VALUES (?1, ?2, (SELECT COALESCE(MAX(item_id), 0) + 1 FROM records
+                         WHERE family_code = ?1 AND collection = ?2))
+        ON CONFLICT (family_code, collection) DO UPDATE SET last_id = last_id + 1"""
+    SQL_GET_SEQUENCE = "SELECT last_id FROM sequences WHERE family_code = ? AND collection = ?"
+    SQL_PUT_META = "INSERT OR IGNORE INTO meta (name, value) VALUES (?, ?)"
+    SQL_FAMILY_SIZES = """
+        SELECT family_code, 'users', COUNT(*), SUM(LENGTH(CAST(data AS BLOB))) FROM users GROUP BY family_code
+        UNION ALL
+        SELECT family_code, collection, COUNT(*), SUM(LENGTH(CAST(data AS BLOB))) FROM records
+        GROUP BY family_code, collection"""
+    SQL_GET_META = "SELECT value FROM meta WHERE name = ?"
+    SQL_FIELD_VALUES = "SELECT json_extract(data, ?3) FROM records WHERE family_code = ?1 AND collection = ?2"
+    SQL_TTL_TIMESTAMPS = """
+        SELECT item_id, json_extract(data, '$.timestamp') FROM records WHERE family_code = ? AND collection = ?"""
+    # Rows that can reference blobs: users and BLOB_COLLECTIONS items
+    SQL_BLOB_ROWS = """
+        SELECT data FROM users WHERE family_code = ?1 UNION ALL
+        SELECT data FROM records WHERE family_code = ?1 AND collection IN ('photos', 'stories')"""
+    SQL_ALL_BLOB_ROWS = """
+        SELECT data FROM users UNION ALL SELECT data FROM records WHERE collection IN ('photos', 'stories')"""
+    SQL_ADD_BLOB_REFS = """
+        INSERT INTO blob_refs (key, refs) VALUES (?, ?)
+        ON CONFLICT (key) DO UPDATE SET refs = refs + excluded.refs"""
+    SQL_DROP_BLOB_REFS = "UPDATE blob_refs SET refs = refs - ?2 WHERE key = ?1"
+    SQL_FORGET_BLOBS = "DELETE FROM blob_refs WHERE key = ? AND refs <= 0"
+    SQL_BLOB_IN_USE = "SELECT 1 FROM blob_refs WHERE key = ?"
+    SQL_DELETE_FAMILY = (
+        "DELETE FROM sequences WHERE family_code = ?",
+        "DELETE FROM records WHERE family_code = ?",
+        "DELETE FROM users WHERE family_code = ?",
+        "DELETE FROM families WHERE code = ?",
+    )
+
+    def __init__(self, path, max_loaded=LOADED_FAMILIES):
+        self.path = path
+        self.max_loaded = max_loaded
+        self.on_evict = None  # called with the codes of families dropped from memory
+        self._local = threading.local()
+        self._schema_ready = False
+        self._lock = threading.RLock()
+        self._loaded = OrderedDict()  # family_code: hydrated family dict, least recently used first
+        self._pins = Counter()  # family_code: writes in progress that hold its hydrated copy
+        self._load_locks = {}  # family_code: lock held while hydrating it
+        self._writes = Counter()  # family_code: writes made by this process
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=64)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            with self._lock:
+                if not self._schema_ready:
+                    conn.executescript(self.SCHEMA)
+                    self._count_existing_blob_refs(conn)
+                    self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    def _count_existing_blob_refs(self, conn):
+        """Fill blob_refs from the stored rows, once per database (stores from before it existed)"""
+        conn.execute("BEGIN IMMEDIATE")  # so only one of several starting processes counts
+        with conn:
+            if conn.execute(self.SQL_GET_META, ("blob_refs",)).fetchone() is None:
+                self._count_blob_refs(conn, added=[key for (data,) in conn.execute(self.SQL_ALL_BLOB_ROWS)
+                                                   for key in record_blob_keys(json.loads(data))])
+                conn.execute(self.SQL_PUT_META, ("blob_refs", b"counted"))
+
+    def _count_blob_refs(self, conn, added=(), removed=()):
+        """Apply blob references gained and lost (keys, repeated per referencing item)"""
+        conn.executemany(self.SQL_ADD_BLOB_REFS, Counter(added).items())
+        removed = Counter(removed)
+        conn.executemany(self.SQL_DROP_BLOB_REFS, removed.items())
+        conn.executemany(self.SQL_FORGET_BLOBS, [(key,) for key in removed])
+
+    def _stored_blob_keys(self, conn, sql, params):
+        row = conn.execute(sql, params).fetchone()
+        return record_blob_keys(json.loads(row[0])) if row else set()
+
+    def family_codes(self):
+        return [row[0] for row in self._conn().execute(self.SQL_FAMILY_CODES)]
+
+    def has_family(self, code):
+        if code in self._loaded:
+            return True
+        return self._conn().execute(self.SQL_HAS_FAMILY, (code,)).fetchone() is not None
+
+    def list_families(self):
+        return [{"code": code, "name": name, "created": created, "members": members}
+                for code, name, created, members in self._conn().execute(self.SQL_LIST_FAMILIES)]
+
+    def load_family(self, code):
+        family = self._loaded.get(code)
+        if family is not None:
+            try:
+                self._loaded.move_to_end(code)
+            except KeyError:
+                pass  # evicted in the meantime; this caller keeps the copy it got
+            return family
+        with self._lock:
+            load_lock = self._load_locks.setdefault(code, threading.Lock())
+        # Hydrate under the family's own lock, so loading one large family doesn't
+        # stall writes and loads for the others
+        with load_lock:
+            family = self._loaded.get(code)
+            if family is not None:
+                return family
+            writes = self._writes[code]
+            family = self._read_family(code)
+            with self._lock:
+                if self._writes[code] != writes:
+                    # A write landed mid-read and had no hydrated copy to update
+                    family = self._read_family(code)
+                if family is not None:
+                    self._loaded[code] = family
+                evicted = self._evict(code)
+        self._evicted(evicted)
+        return family
+
+    def _evict(self, keep):
+        """Drop least recently used, unpinned families (other than `keep`) over
+        max_loaded; returns their codes. Called under self._lock."""
+        evicted = []
+        for code in list(self._loaded):
+            if len(self._loaded) <= self.max_loaded:
+                break
+            if code != keep and not self._pins[code]:
+                del self._loaded[code]
+                evicted.append(code)
+        return evicted
+
+    def _evicted(self, codes):
+        # Outside self._lock: the callback takes locks of its own
+        if codes and self.on_evict is not None:
+            self.on_evict(codes)
+
+    def pin(self, code):
+        """Keep a family hydrated (once loaded) until unpin, e.g. across a read-modify-write"""
+        with self._lock:
+            self._pins[code] += 1
+
+    def unpin(self, code):
+        with self._lock:
+            self._pins[code] -= 1
+            if not self._pins[code]:
+                del self._pins[code]
+
+    def _read_family(self, code):
+        conn = self._conn()
+        row = conn.execute(self.SQL_GET_FAMILY, (code,)).fetchone()
+        if row is None:
+            return None
+        family = new_family_record(row[0], code, row[1])
+        for username, data in conn.execute(self.SQL_GET_USERS, (code,)):
+            family['users'][username] = json.loads(data)
+        for collection, data in conn.execute(self.SQL_GET_RECORDS, (code,)):
+            family[collection].append(compact_record(collection, json.loads(data)))
+        return family
+
+    def create_family(self, family):
+        conn = self._conn()
+        with self._lock, conn:
+            self._writes[family['code']] += 1
+            conn.execute(self.SQL_INSERT_FAMILY, (family['code'], family['name'], family['created']))
+            conn.executemany(self.SQL_PUT_USER, [
+                (family['code'], username, json.dumps(user)) for username, user in family['users'].items()])
+            conn.executemany(self.SQL_INSERT_RECORD, [
+                (family['code'], collection, record['id'], json.dumps(record, default=json_default))
+                for collection in FAMILY_COLLECTIONS for record in family[collection]])
+            self._count_blob_refs(conn, added=[
+                key for record in [*family['users'].values(), *(record for collection in BLOB_COLLECTIONS
+                                                                 for record in family[collection])]
+                for key in record_blob_keys(record)])
+            for collection in FAMILY_COLLECTIONS:
+                family[collection] = [compact_record(collection, record) for record in family[collection]]
+            self._loaded[family['code']] = family
+            evicted = self._evict(family['code'])
+        self._evicted(evicted)
+
+    def delete_family(self, code):
+        conn = self._conn()
+        with self._lock, conn:
+            self._writes[code] += 1
+            self._count_blob_refs(conn, removed=[key for (data,) in conn.execute(self.SQL_BLOB_ROWS, (code,))
+                                                 for key in record_blob_keys(json.loads(data))])
+            for sql in self.SQL_DELETE_FAMILY:
+                conn.execute(sql, (code,))
+            self._loaded.pop(code, None)
+
+    def put_user(self, code, username, user):
+        conn = self._conn()
+        with self._lock, conn:
+            self._writes[code] += 1
+            old = self._stored_blob_keys(conn, self.SQL_GET_USER, (code, username))
+            new = record_blob_keys(user)
+            conn.execute(self.SQL_PUT_USER, (code, username, json.dumps(user)))
+            self._count_blob_refs(conn, added=new - old, removed=old - new)
+            if code in self._loaded:
+                self._loaded[code]['users'][username] = user
+
+    def insert(self, code, collection, record):
+        conn = self._conn()
+        with self._lock, conn:
+            self._writes[code] += 1
+            conn.execute(self.SQL_INSERT_RECORD, (code, collection, record['id'],
+                                                  json.dumps(record, default=json_default)))
+            if collection in BLOB_COLLECTIONS:
+                self._count_blob_refs(conn, added=record_blob_keys(record))
+            if code in self._loaded:
+                # Ids are handed out before the insert, so another process may have
+                # stored (and this one refreshed) a later id first
+                insert_by_id(self._loaded[code][collection], record)
+
+    def update(self, code, collection, record):
+        conn = self._conn()
+        with self._lock, conn:
+            self._writes[code] += 1
+            if collection in BLOB_COLLECTIONS:
+                old = self._stored_blob_keys(conn, self.SQL_GET_RECORD, (code, collection, record['id']))
+                new = record_blob_keys(record)
+                self._count_blob_refs(conn, added=new - old, removed=old - new)
+            conn.execute(self.SQL_UPDATE_RECORD, (json.dumps(record, default=json_default),
+                                                  code, collection, record['id']))
+
+    def next_id(self, code, collection):
+        # Upsert and read back in one transaction, so ids stay unique across processes
+        conn = self._conn()
+        with self._lock, conn:
+            conn.execute(self.SQL_NEXT_ID, (code, collection))
+            return conn.execute(self.SQL_GET_SEQUENCE, (code, collection)).fetchone()[0]
+
+    def next_counter(self, name):
+        # Global counters share the sequences table under an empty family code
+        return self.next_id("", name)
+
+    def secret(self, name):
+        """Random key created on first use and kept in the database"""
+        conn = self._conn()
+        with self._lock, conn:
+            conn.execute(self.SQL_PUT_META, (name, secrets.token_bytes(32)))
+            return conn.execute(self.SQL_GET_META, (name,)).fetchone()[0]
+
+    def delete(self, code, collection, record_id):
+        """Remove one item, without hydrating its family; returns it (None if there was no such item)"""
+        conn = self._conn()
+        with self._lock, conn:
+            self._writes[code] += 1
+            row = conn.execute(self.SQL_GET_RECORD, (code, collection, record_id)).fetchone()
+            conn.execute(self.SQL_DELETE_RECORD, (code, collection, record_id))
+            record = compact_record(collection, json.loads(row[0])) if row else None
+            if record is not None and collection in BLOB_COLLECTIONS:
+                self._count_blob_refs(conn, removed=record_blob_keys(record))
+            if code in self._loaded:
+                loaded = remove_by_id(self._loaded[code][collection], record_id)
+                record = loaded if loaded is not None else record
+            return record
+
+    def ttl_timestamps(self, code, collection):
+        """(id, timestamp) of every item in a collection, read without hydrating the family"""
+        return self._conn().execute(self.SQL_TTL_TIMESTAMPS, (code, collection)).fetchall()
+
+    def field_values(self, code, collection, field):
+        """One field of every item in a collection, read without hydrating the family"""
+        return [value for (value,) in self._conn().execute(self.SQL_FIELD_VALUES, (code, collection, f"$.{field}"))]
+
+    # Other processes writing to the same file: drop or re-read the hydrated copy
+
+    def unload(self, code=None):
+        """Forget hydrated families (all of them if code is None); reloaded on next use"""
+        with self._lock:
+            if code is None:
+                self._loaded.clear()
+                self._writes.update(self._load_locks.keys())  # for loads already under way
+            else:
+                self._loaded.pop(code, None)
+                self._writes[code] += 1
+
+    def refresh(self, code, collection, key):
+        """Re-read one user (collection 'users', key = username) or item into a
+        hydrated family; returns (old, new), or None if the family isn't hydrated"""
+        with self._lock:
+            self._writes[code] += 1  # another process wrote it; a load under way may have missed that
+            family = self._loaded.get(code)
+            if family is None:
+                return None
+            conn = self._conn()
+            if collection == 'users':
+                row = conn.execute(self.SQL_GET_USER, (code, key)).fetchone()
+                old = family['users'].pop(key, None)
+                new = json.loads(row[0]) if row else None
+                if new is not None:
+                    family['users'][key] = new
+                return old, new
+            row = conn.execute(self.SQL_GET_RECORD, (code, collection, key)).fetchone()
+            items = family[collection]
+            old = remove_by_id(items, key)
+            new = compact_record(collection, json.loads(row[0])) if row else None
+            if new is not None:
+                insert_by_id(items, new)
+            return old, new
+
+    def blob_in_use(self, key):
+        return self._conn().execute(self.SQL_BLOB_IN_USE, (key,)).fetchone() is not None
+
+    def family_info(self, code):
+        row = self._conn().execute(self.SQL_GET_FAMILY, (code,)).fetchone()
+        if row is None:
+            return None
+        return {"code": code, "name": row[0], "created": row[1]}
+
+    # Export and import read and write rows directly, without hydrating the family
+
+    def iter_users(self, code):
+        for username, data in self._conn().execute(self.SQL_GET_USERS, (code,)):
+            yield username, json.loads(data)
+
+    def iter_records(self, code):
+        for collection, data in self._conn().execute(self.SQL_GET_RECORDS, (code,)):
+            yield collection, json.loads(data)
+
+    def begin_import(self, info):
+        conn = self._conn()
+        with self._lock, conn:
+            conn.execute(self.SQL_INSERT_FAMILY, (info['code'], info['name'], info['created']))
+
+    def family_sizes(self):
+        yield from self._conn().execute(self.SQL_FAMILY_SIZES)
+
+    def import_batch(self, code, users, records):
+        conn = self._conn()
+        with self._lock, conn:
+            self._writes[code] += 1
+            conn.executemany(self.SQL_PUT_USER, [
+                (code, username, json.dumps(user)) for username, user in users])
+            conn.executemany(self.SQL_INSERT_RECORD, [
+                (code, collection, record['id'], json.dumps(record, default=json_default))
+                for collection, record in records])
+            self._count_blob_refs(conn, added=[
+                key for record in [*(user for _, user in users),
+                                   *(record for collection, record in records if collection in BLOB_COLLECTIONS)]
+                for key in record_blob_keys(record)])
+            self._loaded.pop(code, None)
+
+def make_storage():
+    """Pick the backend from FAMILYCONNECT_DB (SQLite path); defaults to in-memory"""
+    path = os.environ.get("FAMILYCONNECT_DB")
+    if path:
+        return SQLiteStorage(path)
+    return MemoryStorage()
+
+def parse_birthday(birthday):
+    """(month, day) of a YYYY-MM-DD birthday, or None"""
+    try:
+        bday = datetime.strptime(birthday or '', '%Y-%m-%d')
+    except ValueError:
+        return None
+    return bday.month, bday.day
+
+def parse_event_date(value):
+    """Event date as a date; accepts ISO (what add_event stores) or legacy DD/Month/YY"""
+    try:
+        return datetime.fromisoformat(value).date()
+    except ValueError:
+        try:
+            return datetime.strptime(value, '%d/%B/%y').date()
+        except ValueError:
+            return None
+
+def next_birthday(month, day, today):
+    for year in (today.year, today.year + 1):
+        try:
+            candidate = date(year, month, day)
+        except ValueError:  # Feb 29 outside a leap year
+            candidate = date(year, 3, 1)
+        if candidate >= today:
+            return candidate
+
+INDEX_GENERATIONS = itertools.count(1)  # tells a rebuilt index from the one a view last synced with
+MESSAGE_EDIT_LOG = 1000                 # recent message edits remembered per family
+
+class FamilyIndex:
+    """Aggregates derived from one family's data, kept in step with every write
+    so views never have to rescan the collections."""
+
+    def __init__(self, family):
+        self.task_counts = Counter()  # status: number of tasks
+        self.task_by_id = {}
+        self.task_key_by_id = {}      # task id: (assignee, status, due date) it is indexed under
+        self.tasks_by_owner = {}      # (assignee, status): sorted [(due date, task id)]
+        self.pending_due = []         # sorted (due date, task id) of pending tasks
+        self.event_keys = []          # sorted (date, time, event id)
+        self.event_key_by_id = {}
+        self.event_by_id = {}
+        self.birthdays = {}           # username: (month, day, name)
+        # Edits to existing messages (reactions), so chat views can re-render just those
+        self.generation = next(INDEX_GENERATIONS)
+        self.message_edits = deque(maxlen=MESSAGE_EDIT_LOG)  # (seq, message id)
+        self.edit_seq = 0
+        for username, user in family['users'].items():
+            self.on_user(username, user)
+        for collection in FAMILY_COLLECTIONS:
+            for record in family[collection]:
+                self.on_record(collection, record)
+
+    def on_user(self, username, user):
+        parsed = parse_birthday(user.get('birthday'))
+        if parsed:
+            self.birthdays[username] = (*parsed, user['name'])
+        else:
+            self.birthdays.pop(username, None)
+
+    def on_record(self, collection, record):
+        handler = getattr(self, f"on_{collection}", None)
+        if handler:
+            handler(record)
+
+    def on_delete(self, collection, record):
+        handler = getattr(self, f"on_{collection}_deleted", None)
+        if handler:
+            handler(record)
+
+    def on_tasks(self, task):
+        # Tasks are updated in place, so the old entries are found by id, not from the task
+        self.on_tasks_deleted(task)
+        due = parse_event_date(task.get('due') or '') or date.max  # undated tasks sort last
+        key = (task['assigned_to'], task['status'], due)
+        self.task_key_by_id[task['id']] = key
+        self.task_by_id[task['id']] = task
+        self.task_counts[task['status']] += 1
+        bisect.insort(self.tasks_by_owner.setdefault(key[:2], []), (due, task['id']))
+        if task['status'] == 'pending':
+            bisect.insort(self.pending_due, (due, task['id']))
+
+    def on_messages(self, message):
+        if message.get('rev'):  # only edited messages carry a revision
+            self.edit_seq += 1
+            self.message_edits.append((self.edit_seq, message['id']))
+
+    def edits_position(self):
+        return self.generation, self.edit_seq
+
+    def message_edits_since(self, position):
+        """Ids of messages edited after `position` (from edits_position), or None
+        if this index can't tell (rebuilt since, or the log has moved past it)"""
+        generation, seq = position
+        if generation != self.generation:
+            return None
+        if self.message_edits and self.message_edits[0][0] > seq + 1:
+            return None
+        edited = []
+        for edit_seq, message_id in reversed(self.message_edits):
+            if edit_seq <= seq:
+                break
+            edited.append(message_id)
+        return edited
+
+    def on_events(self, event):
+        old = self.event_key_by_id.pop(event['id'], None)
+        if old is not None:
+            del self.event_keys[bisect.bisect_left(self.event_keys, old)]
+        event_date = parse_event_date(event['date'])
+        if event_date is None:
+            self.event_by_id.pop(event['id'], None)
+            return
+        key = (event_date, event.get('time') or '', event['id'])
+        self.event_key_by_id[event['id']] = key
+        self.event_by_id[event['id']] = event
+        bisect.insort(self.event_keys, key)
+
+    def on_tasks_deleted(self, task):
+        key = self.task_key_by_id.pop(task['id'], None)
+        if key is None:
+            return
+        del self.task_by_id[task['id']]
+        assignee, status, due = key
+        self.task_counts[status] -= 1
+        entry = (due, task['id'])
+        owned = self.tasks_by_owner[(assignee, status)]
+        del owned[bisect.bisect_left(owned, entry)]
+        if not owned:
+            del self.tasks_by_owner[(assignee, status)]
+        if status == 'pending':
+            del self.pending_due[bisect.bisect_left(self.pending_due, entry)]
+
+    def on_events_deleted(self, event):
+        key = self.event_key_by_id.pop(event['id'], None)
+        if key is not None:
+            del self.event_keys[bisect.bisect_left(self.event_keys, key)]
+        self.event_by_id.pop(event['id'], None)
+
+    def upcoming_event_count(self, today):
+        return len(self.event_keys) - bisect.bisect_left(self.event_keys, (today,))
+
+    def query_events(self, start=None, end=None, offset=0, limit=20, newest_first=False):
+        """Events dated start <= date < end (either bound optional), paged.
+
+        Returns ([(date, event)], total in range); no sorting or date parsing.
+        """
+        lo = 0 if start is None else bisect.bisect_left(self.event_keys, (start,))
+        hi = len(self.event_keys) if end is None else bisect.bisect_left(self.event_keys, (end,))
+        if newest_first:
+            stop = hi - offset
+            keys = self.event_keys[max(lo, stop - limit):stop][::-1] if stop > lo else []
+        else:
+            keys = self.event_keys[lo + offset:min(hi, lo + offset + limit)]
+        return [(key[0], self.event_by_id[key[2]]) for key in keys], max(0, hi - lo)
+
+    def assigned_tasks(self, assignee, status='pending'):
+        """An assignee's tasks with `status`, soonest due first"""
+        return [self.task_by_id[task_id] for _, task_id in self.tasks_by_owner.get((assignee, status), ())]
+
+    def pending_tasks_due(self, start=None, end=None):
+        """Pending tasks due start <= date < end (either bound optional), soonest first"""
+        lo = 0 if start is None else bisect.bisect_left(self.pending_due, (start,))
+        hi = len(self.pending_due) if end is None else bisect.bisect_left(self.pending_due, (end,))
+        return [self.task_by_id[task_id] for _, task_id in self.pending_due[lo:hi]]
+
+    def upcoming_birthdays(self, today, within_days=30):
+        """[(days until, name)] for birthdays in the next `within_days` days, soonest first"""
+        upcoming = []
+        for month, day, name in self.birthdays.values():
+            days_until = (next_birthday(month, day, today) - today).days
+            if days_until <= within_days:
+                upcoming.append((days_until, name))
+        return sorted(upcoming)
+
+TOKEN_RE = re.compile(r"\w+")
+SEARCH_PREFIX_EXPANSION = 64  # most frequent matching terms considered per query word
+SEARCH_CANDIDATES = 1500      # postings of the leading query word scored before the others narrow them
+
+def search_text(collection, record):
+    """Searchable text of an item (None for collections that aren't searched)"""
+    if collection == 'messages':
+        return f"{record['content']} {record['author']}"
+    if collection == 'announcements':
+        comments = " ".join(comment['content'] for comment in record.get('comments') or [])
+        return f"{record['content']} {record['author']} {comments}"
+    if collection == 'tasks':
+        return f"{record['task']} {record['assigned_to']}"
+    if collection == 'events':
+        return f"{record['title']} {record.get('location', '')}"
+    return None
+
+def tokenize(text):
+    return [token for token in TOKEN_RE.findall(text.casefold()) if len(token) > 1]
+
+class SearchIndex:
+    """Incremental inverted index over one family's searchable items.
+
+    Documents are (collection, id) pairs. Postings map term -> {doc: term
+    frequency}; a sorted term list lets a query word match every term it
+    prefixes with two bisects.
+    """
+
+    def __init__(self, family):
+        self.postings = {}   # term: {doc: tf}
+        self.terms = []      # sorted vocabulary
+        self.doc_terms = {}  # doc: Counter of its terms (for updates/deletes)
+        for collection in FAMILY_COLLECTIONS:
+            for record in family[collection]:
+                self.on_record(collection, record)
+
+    def __len__(self):
+        return len(self.doc_terms)
+
+    def on_user(self, username, user):
+        pass
+
+    def on_record(self, collection, record):
+        text = search_text(collection, record)
+        if text is None:
+            return
+        doc = (collection, record['id'])
+        self._remove(doc)
+        counts = Counter(tokenize(text))
+        self.doc_terms[doc] = counts
+        for term, tf in counts.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = {}
+                bisect.insort(self.terms, term)
+            postings[doc] = tf
+
+    def on_delete(self, collection, record):
+        self._remove((collection, record['id']))
+
+    def _remove(self, doc):
+        for term in self.doc_terms.pop(doc, ()):
+            postings = self.postings[term]
+            del postings[doc]
+            if not postings:
+                del self.postings[term]
+                del self.terms[bisect.bisect_left(self.terms, term)]
+
+    def _expand(self, word):
+        """Terms starting with `word`, most frequent first (capped)"""
+        lo = bisect.bisect_left(self.terms, word)
+        hi = bisect.bisect_left(self.terms, word + "\uffff")
+        matches = self.terms[lo:hi]
+        if len(matches) > SEARCH_PREFIX_EXPANSION:
+            matches = heapq.nlargest(SEARCH_PREFIX_EXPANSION, matches, key=lambda term: len(self.postings[term]))
+        return matches
+
+    def search(self, query, limit=100):
+        """Docs matching every query word (as a prefix), best first.
+
+        Score is the sum of tf * idf over matched terms, with exact word
+        matches weighted above prefix-only ones; ties go to newer items. The
+        word with the fewest postings picks the candidates, within a budget
+        (see _score); the other words only narrow and add to them. If that
+        leaves fewer than `limit` hits, the budget grows until it covers
+        every posting.
+
+        Returns ([(collection, id)], total matches, exact); total is a lower
+        bound when exact is False.
+        """
+        words = tokenize(query)
+        if not words:
+            return [], 0, True
+        # Each word's terms rarest first, and the most selective word first
+        expanded = sorted((sorted(self._expand(word), key=lambda term: len(self.postings[term]))
+                           for word in words),
+                          key=lambda terms: sum(len(self.postings[term]) for term in terms))
+        budget = SEARCH_CANDIDATES
+        while True:
+            scores, exact = self._score(expanded, words, budget)
+            if exact or len(scores) >= limit:
+                break
+            budget *= 8
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], item[0][1]))
+        return [doc for doc, _ in best], len(scores), exact
+
+    def _weights(self, terms, words):
+        total_docs = len(self.doc_terms) or 1
+        return {term: math.log(1 + total_docs / len(self.postings[term])) * (1.0 if term in words else 0.6)
+                for term in terms}
+
+    def _score(self, expanded, words, budget):
+        """{doc: score} for the leading word's candidates, narrowed by the other words.
+
+        The leading word's terms are scored rarest first, each taking an even
+        share of what is left of `budget`; a term with more postings than its
+        share contributes only its newest ones. Returns (scores, exact), where
+        exact is False if any posting was skipped.
+        """
+        lead, *rest = expanded
+        scores = {}
+        exact = True
+        weights = self._weights(lead, words)
+        for left, term in zip(range(len(lead), 0, -1), lead):
+            postings, weight = self.postings[term], weights[term]
+            share = budget // left
+            items = postings.items()
+            if len(postings) > share:
+                exact = False
+                items = itertools.islice(reversed(items), share)  # postings are kept in write order
+            for doc, tf in items:
+                scores[doc] = scores.get(doc, 0) + tf * weight
+            budget -= min(len(postings), share)
+        for terms in rest:
+            # Candidates are few, so match them through their own terms
+            # rather than intersecting with every expanded term's postings
+            weights = self._weights(terms, words)
+            narrowed = {}
+            for doc, score in scores.items():
+                extra = 0
+                for term, tf in self.doc_terms[doc].items():
+                    weight = weights.get(term)
+                    if weight:
+                        extra += tf * weight
+                if extra:
+                    narrowed[doc] = score + extra
+            scores = narrowed
+        return scores, exact
+
+# Expiry of ephemeral data
+# collection: seconds an item lives after its timestamp
+TTL_POLICIES = {"stories": 86400}
+if os.environ.get("FAMILYCONNECT_MESSAGE_RETENTION_DAYS"):
+    TTL_POLICIES["messages"] = int(os.environ["FAMILYCONNECT_MESSAGE_RETENTION_DAYS"]) * 86400
+TTL_SWEEP_INTERVAL = 60  # seconds
+
+class TTLIndex:
+    """Min-heap of (expires_at, family_code, collection, record_id) across all families,
+    so a sweep only touches entries that have actually expired."""
 
-# In-memory storage
-class FamilyConnectDB:
     def __init__(self):
-        self.families = {}  # family_code: family_data
-        self.admin_users = {"admin": "admin123"}  # admin credentials
-        self.current_user = None
-        self.current_family = None
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, expires_at, code, collection, record_id):
+        with self._lock:
+            heapq.heappush(self._heap, (expires_at, code, collection, record_id))
+
+    def clear(self):
+        with self._lock:
+            self._heap.clear()
+
+    def pop_expired(self, now):
+        expired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                expired.append(heapq.heappop(self._heap))
+        return expired
+
+def expires_at(collection, timestamp):
+    """Epoch seconds when an item of a TTL collection with this timestamp expires
+    (None if it never does)"""
+    ttl = TTL_POLICIES.get(collection)
+    if ttl is None:
+        return None
+    try:
+        return to_datetime(timestamp).timestamp() + ttl
+    except (TypeError, ValueError):
+        return None
+
+class FamilyDirectory:
+    """Family summaries with sorted secondary indexes (created, name, members)
+    for the paginated admin listing."""
+
+    SORT_KEYS = {
+        "created": itemgetter('created'),
+        "name": lambda summary: summary['name'].casefold(),
+        "members": itemgetter('members'),
+    }
+
+    def __init__(self, summaries):
+        self.families = {}  # code: summary
+        self.sorted = {field: [] for field in self.SORT_KEYS}  # field: sorted [(key, code)]
+        for summary in summaries:
+            self.add(summary)
+
+    def __len__(self):
+        return len(self.families)
+
+    def add(self, summary):
+        self.families[summary['code']] = summary
+        for field, key in self.SORT_KEYS.items():
+            bisect.insort(self.sorted[field], (key(summary), summary['code']))
+
+    def remove(self, code):
+        summary = self.families.pop(code, None)
+        if summary is None:
+            return
+        for field, key in self.SORT_KEYS.items():
+            entries = self.sorted[field]
+            del entries[bisect.bisect_left(entries, (key(summary), code))]
+
+    def set_members(self, code, members):
+        summary = self.families.get(code)
+        if summary is not None and summary['members'] != members:
+            self.remove(code)
+            self.add(dict(summary, members=members))
+
+    def page(self, field, descending=False, offset=0, limit=25):
+        """One page of summaries ordered by `field`, plus the total count"""
+        entries = self.sorted[field]
+        if descending:
+            stop = len(entries) - offset
+            window = entries[max(0, stop - limit):max(0, stop)][::-1]
+        else:
+            window = entries[offset:offset + limit]
+        return [self.families[code] for _, code in window], len(entries)
+
+# Change fan-out between processes
+# Several app processes can share one SQLite file (see run_cluster). Each keeps
+# hydrated families, indexes and rendered views in memory, so every write is
+# also published as a small change -- {"family", "collection", "op", "key"} --
+# and the other processes re-read just that row instead of their whole cache.
+BROKER_RECONNECT_DELAY = 1.0  # seconds between attempts to reach the hub
+
+class LocalBroker:
+    """In-process stand-in for the hub: hands each change to every other node
+    subscribed in this process (several FamilyConnectDB on one SQLite file)"""
+
+    def __init__(self):
+        self._handlers = []  # (node, handler)
+        self._lock = threading.Lock()
+
+    def subscribe(self, node, handler):
+        with self._lock:
+            self._handlers.append((node, handler))
+
+    def publish(self, node, change):
+        with self._lock:
+            handlers = [handler for other, handler in self._handlers if other != node]
+        for handler in handlers:
+            handler(change)
+
+class BrokerHub:
+    """Unix socket pub/sub: relays each line a node sends to every other node.
+
+    Only processes of the user running the hub may connect: the socket is
+    made owner-only after binding and, where the platform reports it
+    (SO_PEERCRED), peers running as another user are dropped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._clients = set()
+        self._lock = threading.Lock()
+
+    def start(self):
+        if os.path.lexists(self.path):
+            os.unlink(self.path)  # left over from a previous run
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        os.chmod(self.path, 0o600)
+        server.listen()
+        threading.Thread(target=self._accept, args=(server,), name="broker-hub", daemon=True).start()
+
+    @staticmethod
+    def peer_uid(conn):
+        """UID of the process on the other end of `conn` (None if the platform can't tell)"""
+        if not hasattr(socket, "SO_PEERCRED"):
+            return None
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        return struct.unpack("3i", creds)[1]  # pid, uid, gid
+
+    def _accept(self, server):
+        while True:
+            conn, _ = server.accept()
+            uid = self.peer_uid(conn)
+            if uid is not None and uid != os.getuid():
+                log.warning("Broker hub refused a connection from uid %s", uid)
+                conn.close()
+                continue
+            with self._lock:
+                self._clients.add(conn)
+            threading.Thread(target=self._relay, args=(conn,), name="broker-relay", daemon=True).start()
+
+    def _relay(self, conn):
+        try:
+            for line in conn.makefile("rb"):
+                with self._lock:
+                    for other in self._clients:
+                        if other is not conn:
+                            try:
+                                other.sendall(line)
+                            except OSError:
+                                pass  # its own relay thread notices and drops it
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._clients.discard(conn)
+            conn.close()
+
+class UnixSocketBroker:
+    """A node's connection to a BrokerHub (newline-delimited JSON).
+
+    Changes published while the hub is unreachable are lost, so after every
+    reconnect this node resyncs itself and asks the others to do the same.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._sock = None
+        self._lock = threading.Lock()  # serializes writes to the socket
+        self._handlers = []            # (node, handler)
+        self._reader = None
+
+    def subscribe(self, node, handler):
+        self._handlers.append((node, handler))
+        if self._reader is None:
+            connected = threading.Event()
+            self._reader = threading.Thread(target=self._read, args=(connected,), name="broker-reader",
+                                            daemon=True)
+            self._reader.start()
+            connected.wait(BROKER_RECONNECT_DELAY)
+
+    def publish(self, node, change):
+        line = (json.dumps(dict(change, node=node)) + "\n").encode()
+        with self._lock:
+            if self._sock is None:
+                return  # resynced on reconnect
+            try:
+                self._sock.sendall(line)
+            except OSError:
+                log.exception("Broker publish failed")
+
+    def _deliver(self, change):
+        for node, handler in self._handlers:
+            if change.get('node') != node:
+                try:
+                    handler(change)
+                except Exception:
+                    log.exception("Applying change %s failed", change)
+
+    def _read(self, connected):
+        first = True
+        while True:
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.path)
+            except OSError:
+                first = False
+                time.sleep(BROKER_RECONNECT_DELAY)
+                continue
+            with self._lock:
+                self._sock = sock
+            connected.set()
+            if not first:
+                self._deliver({"op": "resync"})
+                for node, _ in self._handlers:
+                    self.publish(node, {"op": "resync"})
+            first = False
+            try:
+                for line in sock.makefile("rb"):
+                    self._deliver(json.loads(line))
+            except OSError:
+                pass
+            with self._lock:
+                self._sock = None
+            sock.close()
+            time.sleep(BROKER_RECONNECT_DELAY)
+
+def make_broker():
+    """Pick the change broker from FAMILYCONNECT_BROKER ("local" or
+    "unix:/path.sock"); None, the default, means this is the only process"""
+    spec = os.environ.get("FAMILYCONNECT_BROKER")
+    if not spec:
+        return None
+    if spec == "local":
+        return LocalBroker()
+    if spec.startswith("unix:"):
+        return UnixSocketBroker(spec[len("unix:"):])
+    raise ValueError(f"Unknown FAMILYCONNECT_BROKER: {spec}")
+
+def home_worker(code, workers):
+    """Worker index a family is pinned to. Rendezvous hashing, so changing the
+    worker count only moves the families of the added or removed workers."""
+    return max(range(workers),
+               key=lambda i: hashlib.blake2b(f"{i}:{code}".encode(), digest_size=8).digest())
+
+IMPORT_BATCH_SIZE = 500  # rows written per transaction when importing
+
+class FamilyConnectDB:
+    def __init__(self, storage=None, broker=None, node=None):
+        self.storage = storage or MemoryStorage()
+        if broker is not None and isinstance(self.storage, MemoryStorage):
+            raise ValueError("A change broker needs storage shared between processes (FAMILYCONNECT_DB)")
+        self.broker = broker
+        self.node = node or secrets.token_hex(4)
+        self.admin_users = {"admin": "admin123"}  # admin credentials, hashed on first login
+        self._write_lock = threading.RLock()  # process-wide state: directory, versions, TTL bookkeeping
+        self._family_locks = {}  # family_code: RLock serializing that family's writes and index builds
+        self._versions = {}  # family_code: Counter of per-collection write versions
+        # index class: {family_code: instance}; each is built on first use, then kept in step with writes
+        self._indexes = {FamilyIndex: {}, SearchIndex: {}}
+        self.ttl = TTLIndex()
+        self._directory = None  # FamilyDirectory, built on first admin listing
+        self._ttl_tracked = set()  # families whose existing TTL items are in self.ttl
+        self.storage.on_evict = self._evicted
+        if broker is not None:
+            broker.subscribe(self.node, self.apply_change)
 
         # Demo family
         demo_code = "DEMO2025"
-        self.families[demo_code] = {
-            "name": "Smith Family",
-            "code": demo_code,
-            "created": datetime.now().isoformat(),
+        if self.storage.has_family(demo_code):
+            return
+        demo = new_family_record("Smith Family", demo_code)
+        demo.update({
             "users": {
                 "dad": {
                     "name": "Dad", "avatar": "👨", "status": "At work",
@@ -52,14 +1471,14 @@ class FamilyConnectDB:
                     "id": 1, "author": "Dad", "role": "Father",
                     "content": "🏠 Family meeting tonight at 7 PM to discuss weekend plans!",
                     "timestamp": datetime.now().isoformat(), "type": "text",
-                    "reactions": {"❤️": ["Mom", "Sarah"], "👍": ["Tommy"]},
+                    "reactions": {"❤️": ["mom", "sarah"], "👍": ["tommy"]},
                     "priority": "high", "comments": []
                 }
             ],
             "messages": [
-                {"author": "Mom", "role": "Mother", "content": "What does everyone want for dinner? 🍽️",
+                {"id": 1, "author": "Mom", "role": "Mother", "content": "What does everyone want for dinner? 🍽️",
                  "timestamp": datetime.now().isoformat(), "reactions": {}},
-                {"author": "Sarah", "role": "Daughter", "content": "Can we have pizza? 🍕",
+                {"id": 2, "author": "Sarah", "role": "Daughter", "content": "Can we have pizza? 🍕",
                  "timestamp": datetime.now().isoformat(), "reactions": {}},
             ],
             "events": [
@@ -73,32 +1492,1092 @@ class FamilyConnectDB:
                  "due": "2025-10-31", "created_by": "Mom"},
                 {"id": 2, "task": "Buy groceries", "assigned_to": "Mom", "status": "completed",
                  "due": "2025-10-30", "created_by": "Dad"}
-            ],
-            "photos": [],
-            "polls": [],
-            "stories": []
-        }
+            ]
+        })
+        try:
+            self.storage.create_family(demo)
+        except sqlite3.IntegrityError:
+            pass  # another process sharing the store (cluster workers start together) seeded it first
+
+    def family_codes(self):
+        return self.storage.family_codes()
+
+    def has_family(self, code):
+        return bool(code) and self.storage.has_family(code)
+
+    def get_family(self, code):
+        if not code:
+            return None
+        family = self.storage.load_family(code)
+        if family is not None and code not in self._ttl_tracked:
+            self._track_ttl(code)
+        return family
+
+    def _family_lock(self, code):
+        lock = self._family_locks.get(code)
+        if lock is None:
+            lock = self._family_locks.setdefault(code, threading.RLock())
+        return lock
+
+    @contextmanager
+    def _writing(self, code):
+        """Hold a family's lock, keeping its hydrated copy from being evicted meanwhile
+        (pinned before waiting, so queued writers count too)"""
+        self.storage.pin(code)
+        try:
+            with self._family_lock(code):
+                yield
+        finally:
+            self.storage.unpin(code)
+
+    def _evicted(self, codes):
+        """Storage dropped these hydrated families: drop what was derived from them"""
+        for code in codes:
+            for built in self._indexes.values():
+                built.pop(code, None)
+            render_cache.drop(code)
+
+    def _track_ttl(self, code):
+        """Queue a family's existing TTL items for expiry (read from storage, so
+        families nobody has opened are swept too)"""
+        with self._family_lock(code):
+            if code in self._ttl_tracked:
+                return
+            self._ttl_tracked.add(code)
+            for collection in TTL_POLICIES:
+                for record_id, timestamp in self.storage.ttl_timestamps(code, collection):
+                    expiry = expires_at(collection, timestamp)
+                    if expiry is not None:
+                        self.ttl.add(expiry, code, collection, record_id)
+
+    def directory(self):
+        if self._directory is None:
+            with self._write_lock:
+                if self._directory is None:
+                    self._directory = FamilyDirectory(self.storage.list_families())
+        return self._directory
+
+    def index(self, code):
+        """Derived aggregates for a family (None if it doesn't exist)"""
+        return self._derived(FamilyIndex, code)
+
+    def search_index(self, code):
+        """Full-text index over a family's messages, announcements, tasks and events"""
+        return self._derived(SearchIndex, code)
+
+    def family_activity(self, code, today):
+        """(pending tasks, upcoming events) for a listing row. Uses the family's index
+        if this process has built one; otherwise reads just those fields from storage,
+        so listing a page of families doesn't hydrate them."""
+        index = self._indexes[FamilyIndex].get(code)
+        if index is not None:
+            return index.task_counts['pending'], index.upcoming_event_count(today)
+        pending = sum(status == 'pending' for status in self.storage.field_values(code, 'tasks', 'status'))
+        upcoming = 0
+        for value in self.storage.field_values(code, 'events', 'date'):
+            event_date = parse_event_date(value) if isinstance(value, str) else None
+            if event_date is not None and event_date >= today:
+                upcoming += 1
+        return pending, upcoming
+
+    def _derived(self, index_class, code):
+        built = self._indexes[index_class]
+        index = built.get(code)
+        if index is None:
+            # Built under the family's own lock: its writes wait for the build (so
+            # none are missed), while other families' writes carry on
+            with self._writing(code):
+                index = built.get(code)
+                if index is None:
+                    family = self.get_family(code)
+                    if family is None:
+                        return None
+                    index = built[code] = index_class(family)
+        return index
+
+    def _built_indexes(self, code):
+        return [built[code] for built in self._indexes.values() if code in built]
+
+    def version(self, code, collections):
+        """Write versions of the given collections, used to key rendered views"""
+        versions = self._versions.get(code)
+        if versions is None:
+            return (0,) * len(collections)
+        return tuple(versions[collection] for collection in collections)
+
+    def bump(self, code, collection):
+        with self._write_lock:
+            self._versions.setdefault(code, Counter())[collection] += 1
+        event_bus.publish(code, collection)
+
+    def _changed(self, code, collection, op="put", key=None):
+        """Bump locally and tell the other processes which row to re-read"""
+        self.bump(code, collection)
+        self._replicate({"family": code, "collection": collection, "op": op, "key": key})
+
+    def _replicate(self, change):
+        if self.broker is not None:
+            self.broker.publish(self.node, change)
+
+    def apply_change(self, change):
+        """Bring this process's caches in line with a write made by another one"""
+        op, code = change.get('op'), change.get('family')
+        if op == 'resync':
+            self.reset_caches()
+            return
+        if op == 'family':  # created, imported or deleted
+            self._forget_family(code)
+            with self._write_lock:
+                self._directory = None
+            return
+        self._refresh(code, change['collection'], change['key'])
+        self.bump(code, change['collection'])
+
+    def _refresh(self, code, collection, key):
+        """Re-read one row into the hydrated family and its indexes"""
+        with self._writing(code):
+            refreshed = self.storage.refresh(code, collection, key)
+            if refreshed is not None:
+                old, new = refreshed
+                for index in self._built_indexes(code):
+                    if collection == 'users':
+                        index.on_user(key, new or {})
+                    elif new is not None:
+                        index.on_record(collection, new)
+                    elif old is not None:
+                        index.on_delete(collection, old)
+                if new is not None and code in self._ttl_tracked:
+                    expiry = expires_at(collection, new.get('timestamp'))
+                    if expiry is not None:
+                        self.ttl.add(expiry, code, collection, key)
+        if collection == 'users':
+            with self._write_lock:
+                self._directory = None  # member counts may have changed
+
+    def reset_caches(self):
+        """Drop every hydrated family and derived index, e.g. after missing changes"""
+        self.storage.unload()
+        with self._write_lock:
+            for built in self._indexes.values():
+                built.clear()
+            self._ttl_tracked.clear()
+            self.ttl.clear()  # re-queued from storage by the next sweep
+            self._directory = None
+            codes = list(self._versions)
+        for code in codes:
+            for collection in ('users', *FAMILY_COLLECTIONS):
+                self.bump(code, collection)
+
+    def _forget_family(self, code):
+        """Drop everything this process holds for a family"""
+        with self._family_lock(code), self._write_lock:
+            self.storage.unload(code)
+            self._versions.pop(code, None)
+            for built in self._indexes.values():
+                built.pop(code, None)
+            self._ttl_tracked.discard(code)
+        render_cache.drop(code)
+
+    def create_family(self, name, code):
+        family = new_family_record(name, code)
+        with self._write_lock:
+            self.storage.create_family(family)
+            if self._directory is not None:
+                self._directory.add({"code": code, "name": name, "created": family['created'],
+                                     "members": len(family['users'])})
+        self._replicate({"family": code, "op": "family"})
+        return family
+
+    def delete_family(self, code):
+        self.storage.delete_family(code)
+        with self._write_lock:
+            if self._directory is not None:
+                self._directory.remove(code)
+        self._forget_family(code)
+        self._replicate({"family": code, "op": "family"})
+
+    def export_family(self, code):
+        """Stream a family as export entries: its header, then users, then items"""
+        info = self.storage.family_info(code)
+        if info is None:
+            return
+        yield {"type": "family", **info}
+        for username, user in self.storage.iter_users(code):
+            yield {"type": "user", "family": code, "username": username, "user": user}
+        for collection, record in self.storage.iter_records(code):
+            yield {"type": "record", "family": code, "collection": collection, "record": record}
+
+    def import_entries(self, entries, batch_size=IMPORT_BATCH_SIZE):
+        """Load export entries in batches; returns {family_code: imported|skipped}.
+
+        Families whose code already exists are skipped rather than merged. If
+        anything fails part-way, the families this call created are deleted again.
+        """
+        results = {}
+        code = None
+        users, records = [], []
+
+        def flush():
+            if users or records:
+                self.storage.import_batch(code, users, records)
+                users.clear()
+                records.clear()
+
+        def finish():
+            flush()
+            members = sum(1 for _ in self.storage.iter_users(code))
+            with self._write_lock:
+                if self._directory is not None:
+                    self._directory.set_members(code, members)
+            self._forget_family(code)
+            self._replicate({"family": code, "op": "family"})
+
+        try:
+            for entry in entries:
+                kind = entry.get('type')
+                if kind == 'family':
+                    if code is not None:
+                        finish()
+                    code = entry['code']
+                    if self.has_family(code):
+                        results[code], code = "skipped", None
+                        continue
+                    info = {"code": code, "name": entry['name'], "created": entry['created']}
+                    with self._write_lock:
+                        self.storage.begin_import(info)
+                        if self._directory is not None:
+                            self._directory.add(dict(info, members=0))
+                    results[code] = "imported"
+                elif code is None or entry.get('family') != code:
+                    continue  # belongs to a skipped family
+                elif kind == 'user':
+                    users.append((entry['username'], entry['user']))
+                elif kind == 'record' and entry.get('collection') in FAMILY_COLLECTIONS:
+                    records.append((entry['collection'], entry['record']))
+                if len(users) + len(records) >= batch_size:
+                    flush()
+            if code is not None:
+                finish()
+        except BaseException:
+            self.discard_import(results)
+            raise
+        return results
+
+    def discard_import(self, results):
+        """Delete the families an import created (see import_entries)"""
+        for code, result in results.items():
+            if result == "imported" and self.storage.family_info(code) is not None:
+                self.delete_family(code)
+
+    def put_user(self, code, username, user):
+        with self._writing(code):
+            self.storage.put_user(code, username, user)
+            for index in self._built_indexes(code):
+                index.on_user(username, user)
+            members = len(self.get_family(code)['users'])
+            with self._write_lock:
+                if self._directory is not None:
+                    self._directory.set_members(code, members)
+        self._changed(code, 'users', key=username)
+
+    def add_record(self, code, collection, record):
+        """Append one item to a family collection, assigning the next id.
+
+        Returns the stored item, which may be the compact form of `record`.
+        """
+        record = compact_record(collection, record)
+        with self._writing(code):
+            self.get_family(code)
+            record["id"] = self.storage.next_id(code, collection)
+            self.storage.insert(code, collection, record)
+            for index in self._built_indexes(code):
+                index.on_record(collection, record)
+            expiry = expires_at(collection, record.get('timestamp'))
+            if expiry is not None:
+                self.ttl.add(expiry, code, collection, record['id'])
+        self._changed(code, collection, key=record['id'])
+        return record
+
+    def modify_record(self, code, collection, record_id, change):
+        """Run change(record) under the family's write lock; it returns a truthy
+        result if it modified the record, which is then persisted.
+
+        Returns (record, result); record is None if there is no such item.
+        """
+        with self._writing(code):
+            if self.broker is not None:
+                # Start from the stored row, not a copy another process may have since replaced
+                self._refresh(code, collection, record_id)
+            family = self.get_family(code)
+            record = find_by_id(family[collection], record_id) if family else None
+            if record is None:
+                return None, None
+            result = change(record)
+            if result:
+                self._persist_update(code, collection, record)
+        if result:
+            self._changed(code, collection, key=record_id)
+        return record, result
+
+    def _persist_update(self, code, collection, record):
+        self.storage.update(code, collection, record)
+        for index in self._built_indexes(code):
+            index.on_record(collection, record)
+
+    def delete_record(self, code, collection, record_id):
+        """Remove one item, without hydrating its family; returns it (None if it was already gone)"""
+        with self._writing(code):
+            record = self.storage.delete(code, collection, record_id)
+            if record is None:
+                return None
+            for index in self._built_indexes(code):
+                index.on_delete(collection, record)
+        self._changed(code, collection, "delete", record_id)
+        return record
+
+    def sweep_expired(self, now=None):
+        """Delete TTL-expired items and the blobs only they referenced; returns the count"""
+        for code in self.family_codes():
+            if code not in self._ttl_tracked:
+                self._track_ttl(code)
+        removed = 0
+        for _, code, collection, record_id in self.ttl.pop_expired(now or time.time()):
+            if code not in self._ttl_tracked:
+                continue  # family deleted since the entry was added
+            record = self.delete_record(code, collection, record_id)
+            if record is None:
+                continue
+            removed += 1
+            for key in record_blob_keys(record):
+                if not self.storage.blob_in_use(key):
+                    blobs.delete(key)
+        return removed
+
+    def get_page(self, code, collection, before=None, limit=50):
+        """Newest `limit` items with id < before, plus the cursor for the page before them"""
+        items = self.get_family(code)[collection]
+        end = len(items) if before is None else bisect.bisect_left(items, before, key=itemgetter('id'))
+        start = max(0, end - limit)
+        return items[start:end], (items[start]['id'] if start > 0 else None)
+
+    def get_since(self, code, collection, after_id):
+        """Items appended after `after_id` (collections are kept in id order)"""
+        items = self.get_family(code)[collection]
+        return items[bisect.bisect_right(items, after_id, key=itemgetter('id')):]
+
+# Blob store
+BLOB_DIR = os.environ.get("FAMILYCONNECT_BLOBS", "familyconnect_blobs")
+BLOB_ROUTE = "/blobs"
+BLOB_KEY_RE = re.compile(r"^[0-9a-f]{64}\.(png|jpg|webp)$")
+BLOB_EXTENSIONS = {"PNG": "png", "JPEG": "jpg", "WEBP": "webp"}
+BLOB_CONTENT_TYPES = {"png": "image/png", "jpg": "image/jpeg", "webp": "image/webp"}
+
+class BlobStore:
+    """Content-addressed image files on disk.
+
+    Keys are "<sha256>.<ext>", so identical uploads are stored once and a
+    key's bytes never change (which makes them safe to cache forever).
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def exists(self, key):
+        return bool(BLOB_KEY_RE.match(key)) and os.path.exists(self.path(key))
+
+    def put_image(self, img, fmt="PNG", **save_args):
+        """Encode a PIL image straight to disk and return its key"""
+        tmp_dir = os.path.join(self.root, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                img.save(f, format=fmt, **save_args)
+            return self._commit(tmp_path, BLOB_EXTENSIONS[fmt])
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _commit(self, tmp_path, ext):
+        digest = hashlib.sha256()
+        with open(tmp_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                digest.update(chunk)
+        key = f"{digest.hexdigest()}.{ext}"
+        dest = self.path(key)
+        if not os.path.exists(dest):
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(tmp_path, dest)
+        return key
+
+    def put_file(self, f, ext):
+        """Copy a file object into the store in chunks and return its key"""
+        tmp_dir = os.path.join(self.root, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                for chunk in iter(lambda: f.read(1 << 16), b""):
+                    out.write(chunk)
+            return self._commit(tmp_path, ext)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def delete(self, key):
+        if self.exists(key):
+            os.remove(self.path(key))
+
+blobs = BlobStore(BLOB_DIR)
+
+# Image processing
+IMAGE_WORKERS = int(os.environ.get("FAMILYCONNECT_IMAGE_WORKERS", "2"))
+IMAGE_QUALITY = {"WEBP": 80, "JPEG": 82}
+# Upload limits, checked from the file and its header before any pixel is decoded
+MAX_UPLOAD_BYTES = int(os.environ.get("FAMILYCONNECT_MAX_UPLOAD_MB", "25")) * 2**20
+MAX_IMAGE_PIXELS = int(os.environ.get("FAMILYCONNECT_MAX_IMAGE_MP", "120")) * 10**6
+MAX_DECODE_PIXELS = 25 * 10**6  # pixels actually decoded (after JPEG draft); ~100 MB as RGBA
+IMAGE_DECODE_WAIT = 10          # seconds an upload may wait for a decode slot before it's turned away
+
+# variant name: (longest side in px, square crop)
+PHOTO_VARIANTS = {"grid": (400, False), "grid_2x": (800, False), "full": (1600, False)}
+AVATAR_VARIANTS = {"avatar": (128, True), "avatar_2x": (256, True)}
+
+def open_image(image_path, variants):
+    """Open an upload with only its header read, set up to decode no larger than
+    `variants` need. JPEGs are drafted, so the decoder itself scales by 1/2 to 1/8
+    (a 50 MP photo decodes at 1/4 scale, about 3 MP, for the 1600px variant); other formats
+    decode at full size.
+
+    Raises ValueError, with a message for the user, for files that aren't
+    images or are over the size limits.
+    """
+    from PIL import Image, UnidentifiedImageError
+
+    if os.path.getsize(image_path) > MAX_UPLOAD_BYTES:
+        raise ValueError(f"Image file is over {MAX_UPLOAD_BYTES // 2**20} MB")
+    try:
+        img = Image.open(image_path)
+    except UnidentifiedImageError:
+        raise ValueError("Not a supported image file") from None
+    except Image.DecompressionBombError:
+        raise ValueError(f"Image is over {MAX_IMAGE_PIXELS // 10**6} megapixels") from None
+    width, height = img.size
+    if width * height > MAX_IMAGE_PIXELS:
+        img.close()
+        raise ValueError(f"Image is over {MAX_IMAGE_PIXELS // 10**6} megapixels")
+    # Smallest scale every variant can still be cut from: longest side for thumbnails, shortest for crops
+    scale = max(size / (min(width, height) if square else max(width, height))
+                for size, square in variants.values())
+    if scale < 1:
+        img.draft(img.mode, (math.ceil(width * scale), math.ceil(height * scale)))
+    if img.width * img.height > MAX_DECODE_PIXELS:
+        img.close()
+        raise ValueError(f"Image is too large to process ({width}×{height})")
+    return img
+
+def build_image_variants(image_path, variants, blob_root):
+    """Decode once and write every variant to the blob store as lossy WebP (JPEG fallback).
+
+    Runs in a worker process; returns {name: {"key", "width", "height"}}.
+    """
+    from PIL import Image, ImageOps, features
+
+    fmt = "WEBP" if features.check("webp") else "JPEG"
+    save_args = {"quality": IMAGE_QUALITY[fmt]}
+    if fmt == "JPEG":
+        save_args["progressive"] = True
+    store = BlobStore(blob_root)
+    with open_image(image_path, variants) as img:
+        img = ImageOps.exif_transpose(img)
+        has_alpha = fmt == "WEBP" and img.mode in ("RGBA", "LA", "PA")
+        img = img.convert("RGBA" if has_alpha else "RGB")
+        results = {}
+        for name, (size, square) in variants.items():
+            if square:
+                out = ImageOps.fit(img, (size, size), Image.LANCZOS)
+            else:
+                out = img.copy()
+                out.thumbnail((size, size), Image.LANCZOS)
+            key = store.put_image(out, fmt, **save_args)
+            results[name] = {"key": key, "width": out.width, "height": out.height}
+        return results
+
+_image_pool = None
+_image_pool_lock = threading.Lock()
+
+def image_pool():
+    """Process pool for image decoding/encoding, started on first upload"""
+    global _image_pool
+    with _image_pool_lock:
+        if _image_pool is None:
+            _image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+        return _image_pool
+
+# One slot per pool worker: uploads past that wait here (briefly) rather than
+# piling up in the pool's queue, and are turned away if the wait runs out
+image_decodes = threading.BoundedSemaphore(IMAGE_WORKERS)
+
+def admit_image(image_path, variants):
+    """Vet an upload's header and take a decode slot for it; raises ValueError if refused"""
+    open_image(image_path, variants).close()
+    if not image_decodes.acquire(timeout=IMAGE_DECODE_WAIT):
+        raise ValueError("Too many photos are being processed, please try again in a moment")
+
+def submit_image(image_path, variants):
+    """Hand an admitted upload to the pool; its decode slot is freed when it finishes"""
+    try:
+        future = image_pool().submit(build_image_variants, image_path, variants, blobs.root)
+    except Exception:
+        image_decodes.release()
+        raise
+    future.add_done_callback(lambda _: image_decodes.release())
+    return future
+
+def process_image(image_path, variants):
+    """Build variants off the request thread (in the pool) and wait for the result.
+
+    Raises ValueError if the image is refused (see open_image).
+    """
+    admit_image(image_path, variants)
+    return submit_image(image_path, variants).result()
+
+async def process_image_async(image_path, variants):
+    """process_image for async handlers: awaits the pool rather than blocking a thread on it"""
+    await asyncio.to_thread(admit_image, image_path, variants)
+    return await asyncio.wrap_future(submit_image(image_path, variants))
+
+def srcset_html(variants, names):
+    return ", ".join(f"{image_src(variants[name]['key'])} {variants[name]['width']}w"
+                     for name in names if name in variants)
+
+def image_src(ref):
+    """URL for a stored image: a blob key, or a legacy inline data: URI"""
+    if ref.startswith("data:"):
+        return ref
+    return f"{BLOB_ROUTE}/{ref}"
+
+# Render cache
+RENDER_CACHE_FAMILIES = int(os.environ.get("FAMILYCONNECT_RENDER_CACHE", "256"))
+RENDER_CACHE_TTL = 60  # seconds; keeps relative times ("5m ago") reasonably fresh
+
+# Collections each tab view is rendered from
+VIEW_DEPENDENCIES = {
+    "dashboard": ("users", "announcements", "messages", "events", "tasks"),
+    "announcements": ("announcements",),
+    "messages": ("messages",),
+    "events": ("events",),
+    "tasks": ("tasks",),
+    "family_members": ("users",),
+    "photos": ("photos",),
+    "polls": ("polls",),
+    "stories": ("stories",),
+}
+
+class RenderCache:
+    """Rendered HTML per family and view, LRU-evicted by family"""
+
+    def __init__(self, max_families=RENDER_CACHE_FAMILIES, ttl=RENDER_CACHE_TTL):
+        self.max_families = max_families
+        self.ttl = ttl
+        self._families = OrderedDict()  # family_code: {view_key: (version, rendered_at, html)}
+        self._lock = threading.Lock()
+
+    def get(self, code, key, version):
+        with self._lock:
+            views = self._families.get(code)
+            if views is None:
+                return None
+            self._families.move_to_end(code)
+            entry = views.get(key)
+        if entry and entry[0] == version and time.monotonic() - entry[1] < self.ttl:
+            return entry[2]
+        return None
+
+    def put(self, code, key, version, html):
+        with self._lock:
+            views = self._families.get(code)
+            if views is None:
+                views = self._families[code] = {}
+                while len(self._families) > self.max_families:
+                    self._families.popitem(last=False)
+            else:
+                self._families.move_to_end(code)
+            views[key] = (version, time.monotonic(), html)
+
+    def drop(self, code):
+        with self._lock:
+            self._families.pop(code, None)
+
+render_cache = RenderCache()
+
+# Live updates
+LIVE_COALESCE_WINDOW = 0.3  # seconds to let a burst of writes settle before pushing
+LIVE_HEARTBEAT = 30         # seconds between no-op pushes (lets closed sessions unsubscribe)
+
+class Subscription:
+    """One live session's pending changes.
+
+    Changes are kept as a set of collection names, so however many writes
+    arrive while the session is busy they coalesce into at most one
+    re-render per collection (bounded memory, natural backpressure).
+    """
+
+    def __init__(self, code):
+        self.code = code
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+
+    def notify(self, collection):
+        # Called from handler threads
+        with self._lock:
+            self._pending.add(collection)
+        self._loop.call_soon_threadsafe(self._event.set)
+
+    async def wait(self, timeout):
+        """Changed collections since the last call, or an empty set on timeout"""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return set()
+        await asyncio.sleep(LIVE_COALESCE_WINDOW)
+        self._event.clear()
+        with self._lock:
+            changed, self._pending = self._pending, set()
+        return changed
+
+class EventBus:
+    """Per-family publish/subscribe of collection changes"""
+
+    def __init__(self):
+        self._subscribers = {}  # family_code: set of Subscription
+        self._lock = threading.Lock()
+
+    def subscribe(self, code):
+        sub = Subscription(code)
+        with self._lock:
+            self._subscribers.setdefault(code, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subscribers.get(sub.code)
+            if subs:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[sub.code]
+
+    def publish(self, code, collection):
+        with self._lock:
+            subs = list(self._subscribers.get(code, ()))
+        for sub in subs:
+            sub.notify(collection)
+
+event_bus = EventBus()
+
+# Metrics
+# Off: handlers are left unwrapped and the render path only checks this flag
+METRICS_ENABLED = os.environ.get("FAMILYCONNECT_METRICS", "1") != "0"
+METRICS_ROUTE = "/metrics"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FAMILY_SIZES_TTL = 60  # seconds between storage scans for per-family data sizes
+
+class Histogram:
+    """Cumulative-bucket latency histogram in the Prometheus layout"""
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th observation"""
+        rank, seen = q * self.count, 0
+        for bound, n in zip(LATENCY_BUCKETS + (math.inf,), self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return math.inf
+
+class Metrics:
+    """Process-wide handler timings, render sizes and family data sizes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.handlers = {}              # handler name: Histogram
+        self.handler_errors = Counter()
+        self.renders = Counter()        # view: cache misses rendered
+        self.render_bytes = Counter()   # view: bytes of HTML rendered
+        self.render_hits = Counter()    # view: served from the render cache
+        self._sizes = ([], 0.0)         # (family size rows, monotonic time taken)
+        self._label_key = None
+
+    def observe_handler(self, name, seconds, failed=False):
+        with self._lock:
+            histogram = self.handlers.get(name)
+            if histogram is None:
+                histogram = self.handlers[name] = Histogram()
+            histogram.observe(seconds)
+            if failed:
+                self.handler_errors[name] += 1
+
+    def observe_render(self, view, html):
+        size = len(html.encode())
+        with self._lock:
+            self.renders[view] += 1
+            self.render_bytes[view] += size
+
+    def observe_hit(self, view):
+        with self._lock:
+            self.render_hits[view] += 1
+
+    def family_sizes(self):
+        """Storage size rows, rescanned at most every FAMILY_SIZES_TTL seconds"""
+        rows, taken = self._sizes
+        if time.monotonic() - taken > FAMILY_SIZES_TTL:
+            rows = list(db.storage.family_sizes())
+            self._sizes = (rows, time.monotonic())
+        return rows
+
+    def family_label(self, code):
+        # Family codes are login secrets, so the public endpoint only shows a keyed digest
+        if self._label_key is None:
+            self._label_key = db.storage.secret("metrics")
+        return hmac.new(self._label_key, code.encode(), hashlib.sha256).hexdigest()[:12]
+
+    def prometheus_text(self):
+        lines = [
+            "# HELP familyconnect_handler_seconds Time spent in Gradio event handlers.",
+            "# TYPE familyconnect_handler_seconds histogram",
+        ]
+        with self._lock:
+            handlers = {name: (list(h.buckets), h.count, h.sum) for name, h in self.handlers.items()}
+            errors = dict(self.handler_errors)
+            renders, render_bytes, hits = dict(self.renders), dict(self.render_bytes), dict(self.render_hits)
+        for name, (buckets, count, total) in sorted(handlers.items()):
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+                cumulative += n
+                lines.append(f'familyconnect_handler_seconds_bucket{{handler="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'familyconnect_handler_seconds_sum{{handler="{name}"}} {total:.6f}')
+            lines.append(f'familyconnect_handler_seconds_count{{handler="{name}"}} {count}')
+        lines += ["# HELP familyconnect_handler_errors_total Handler calls that raised.",
+                  "# TYPE familyconnect_handler_errors_total counter"]
+        lines += [f'familyconnect_handler_errors_total{{handler="{name}"}} {n}' for name, n in sorted(errors.items())]
+        for metric, help_text, values in (
+                ("familyconnect_renders_total", "Tab views rendered (render cache misses).", renders),
+                ("familyconnect_render_bytes_total", "Bytes of HTML rendered per tab view.", render_bytes),
+                ("familyconnect_render_cache_hits_total", "Tab views served from the render cache.", hits)):
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+            lines += [f'{metric}{{view="{view}"}} {n}' for view, n in sorted(values.items())]
+        lines += ["# HELP familyconnect_family_items Users or items stored per family and collection.",
+                  "# TYPE familyconnect_family_items gauge"]
+        sizes = self.family_sizes()
+        for code, collection, items, _ in sizes:
+            lines.append(f'familyconnect_family_items{{family="{self.family_label(code)}",'
+                         f'collection="{collection}"}} {items}')
+        lines += ["# HELP familyconnect_family_bytes Serialized bytes stored per family and collection.",
+                  "# TYPE familyconnect_family_bytes gauge"]
+        for code, collection, _, size in sizes:
+            lines.append(f'familyconnect_family_bytes{{family="{self.family_label(code)}",'
+                         f'collection="{collection}"}} {size or 0}')
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def timed_handler(fn, name):
+    """Wrap an event handler so its run time lands in `metrics`, keeping its sync/async shape"""
+    if inspect.iscoroutinefunction(fn):
+        @wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start, failed = time.perf_counter(), False
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                metrics.observe_handler(name, time.perf_counter() - start, failed)
+    elif inspect.isgeneratorfunction(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            # Only time spent producing updates counts, not time spent waiting on the client
+            elapsed, failed = 0.0, False
+            updates = fn(*args, **kwargs)
+            try:
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        value = next(updates)
+                    except StopIteration:
+                        return
+                    finally:
+                        elapsed += time.perf_counter() - start
+                    yield value
+            except Exception:
+                failed = True
+                raise
+            finally:
+                updates.close()
+                metrics.observe_handler(name, elapsed, failed)
+    else:
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start, failed = time.perf_counter(), False
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                failed = True
+                raise
+            finally:
+                metrics.observe_handler(name, time.perf_counter() - start, failed)
+    return wrapper
+
+def instrument_handlers(blocks):
+    """Time every backend function wired in `blocks`.
+
+    Long-lived async generator streams (live updates) are skipped, since
+    their run time is almost all waiting.
+    """
+    for block_fn in blocks.fns.values():
+        if block_fn.fn is None or inspect.isasyncgenfunction(block_fn.fn):
+            continue
+        name = block_fn.name
+        if isinstance(block_fn.fn, partial) or name == "<lambda>":
+            name = block_fn.api_name or "lambda"
+        block_fn.fn = timed_handler(block_fn.fn, name)
+
+def cached_fragment(code, key, version, render, *args):
+    """Render one item's HTML through the render cache, keyed by the item's own version"""
+    rendered = render_cache.get(code, key, version)
+    if rendered is None:
+        rendered = render(*args)
+        render_cache.put(code, key, version, rendered)
+    return rendered
+
+def cached_view(view, per_user=False):
+    """Serve a tab builder from the render cache until one of its collections changes"""
+    collections = VIEW_DEPENDENCIES[view]
+
+    def decorator(build):
+        @wraps(build)
+        def wrapper(session):
+            code = session.get('family') if session else None
+            if not db.has_family(code):
+                return build(session)
+            key = (view, session['user']) if per_user else view
+            version = db.version(code, collections)
+            rendered = render_cache.get(code, key, version)
+            if rendered is None:
+                rendered = build(session)
+                render_cache.put(code, key, version, rendered)
+                if METRICS_ENABLED:
+                    metrics.observe_render(view, rendered)
+            elif METRICS_ENABLED:
+                metrics.observe_hit(view)
+            return rendered
+        return wrapper
+    return decorator
+
+db = FamilyConnectDB(make_storage(), broker=make_broker(), node=os.environ.get("FAMILYCONNECT_NODE"))
+
+_ttl_sweeper = None
+
+def start_ttl_sweeper(interval=TTL_SWEEP_INTERVAL):
+    """Background thread that evicts expired stories (and retained-out messages)"""
+    global _ttl_sweeper
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                db.sweep_expired()
+            except Exception:
+                log.exception("TTL sweep failed")
+
+    if _ttl_sweeper is None:
+        _ttl_sweeper = threading.Thread(target=run, name="ttl-sweeper", daemon=True)
+        _ttl_sweeper.start()
+
+# Passwords
+# scrypt cost: ~16 MiB and tens of milliseconds per hash
+PASSWORD_SCRYPT_N = 2 ** 14
+PASSWORD_SCRYPT_R = 8
+PASSWORD_SCRYPT_P = 1
+PASSWORD_HASH_PREFIX = "scrypt$"
+PASSWORD_WORKERS = int(os.environ.get("FAMILYCONNECT_PASSWORD_WORKERS", min(4, os.cpu_count() or 1)))
+LOGIN_CACHE_SIZE = 10000
+LOGIN_CACHE_TTL = 900  # seconds a verified password skips the KDF
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=64 * 1024 * 1024)
+
+def hash_password(password):
+    """Salted scrypt hash encoded as scrypt$n$r$p$salt$hash"""
+    salt = secrets.token_bytes(16)
+    digest = _scrypt(password, salt, PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+    return (f"{PASSWORD_HASH_PREFIX}{PASSWORD_SCRYPT_N}${PASSWORD_SCRYPT_R}${PASSWORD_SCRYPT_P}$"
+            f"{salt.hex()}${digest.hex()}")
+
+def verify_password(password, stored):
+    """(matches, needs_rehash) for a stored hash, or a legacy plaintext password"""
+    if not stored:
+        return False, False
+    if not stored.startswith(PASSWORD_HASH_PREFIX):
+        return hmac.compare_digest(password.encode(), stored.encode()), True
+    n, r, p, salt, digest = stored[len(PASSWORD_HASH_PREFIX):].split("$")
+    n, r, p = int(n), int(r), int(p)
+    ok = hmac.compare_digest(_scrypt(password, bytes.fromhex(salt), n, r, p), bytes.fromhex(digest))
+    return ok, (n, r, p) != (PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+
+_password_pool = None
+_password_pool_lock = threading.Lock()
+
+def password_pool():
+    """Threads that run the KDF (hashlib drops the GIL while hashing).
+
+    The pool is small on purpose: a burst of logins queues here instead of
+    every handler thread hashing at once and starving the rest of the app.
+    """
+    global _password_pool
+    with _password_pool_lock:
+        if _password_pool is None:
+            _password_pool = ThreadPoolExecutor(max_workers=PASSWORD_WORKERS,
+                                                thread_name_prefix="password")
+        return _password_pool
+
+class LoginCache:
+    """Recently verified logins, so re-logins and reconnects skip the KDF.
+
+    Keys are an HMAC of the credentials under a server secret, so no password
+    is held in memory. A hit also requires the stored hash to be unchanged,
+    which invalidates entries when a password changes.
+    """
 
-db = FamilyConnectDB()
+    def __init__(self, max_entries=LOGIN_CACHE_SIZE, ttl=LOGIN_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key: (stored hash, expires at)
+        self._lock = threading.Lock()
+        self._secret = None
+
+    def key(self, *parts):
+        if self._secret is None:
+            self._secret = db.storage.secret("login_cache")
+        return hmac.new(self._secret, "\0".join(parts).encode(), hashlib.sha256).digest()
+
+    def check(self, key, stored):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            if entry[0] != stored or entry[1] < time.monotonic():
+                del self._entries[key]
+                return False
+            self._entries.move_to_end(key)
+            return True
+
+    def remember(self, key, stored):
+        with self._lock:
+            self._entries[key] = (stored, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+login_cache = LoginCache()
+
+def check_password(cache_key, password, stored):
+    """Verify a password on the KDF pool; returns (matches, hash to store or None)"""
+    if login_cache.check(cache_key, stored):
+        return True, None
+    ok, rehash = password_pool().submit(verify_password, password, stored).result()
+    if not ok:
+        return False, None
+    new_hash = password_pool().submit(hash_password, password).result() if rehash else None
+    login_cache.remember(cache_key, new_hash or stored)
+    return True, new_hash
+
+def check_user_password(family_code, username, password):
+    """Check a family member's password, upgrading plaintext or outdated hashes in place"""
+    family = db.get_family(family_code)
+    user = family['users'].get(username) if family else None
+    if user is None:
+        return False
+    ok, new_hash = check_password(login_cache.key("user", family_code, username, password),
+                                  password, user.get('password'))
+    if new_hash:
+        db.put_user(family_code, username, dict(user, password=new_hash))
+    return ok
+
+def check_admin_password(username, password):
+    stored = db.admin_users.get(username)
+    if stored is None:
+        return False
+    ok, new_hash = check_password(login_cache.key("admin", username, password), password, stored)
+    if new_hash:
+        db.admin_users[username] = new_hash
+    return ok
 
 ROLE_COLORS = {
     "Father": "#3b82f6", "Mother": "#ec4899", "Son": "#10b981",
     "Daughter": "#a855f7", "Grandparent": "#f59e0b", "Other": "#6b7280"
 }
 
+FAMILY_CODE_ALPHABET = string.ascii_uppercase + string.digits
+FAMILY_CODE_LENGTH = 8
+FAMILY_CODE_SPACE = len(FAMILY_CODE_ALPHABET) ** FAMILY_CODE_LENGTH
+FEISTEL_HALF_BITS = 21  # 2 ** 42 > 36 ** 8
+
+def permute_code_number(n, key):
+    """Keyed bijection on [0, FAMILY_CODE_SPACE): a 4-round Feistel network
+    over 42 bits, cycle-walking until the result falls back into range."""
+    mask = (1 << FEISTEL_HALF_BITS) - 1
+    while True:
+        left, right = n >> FEISTEL_HALF_BITS, n & mask
+        for round_no in range(4):
+            digest = hmac.new(key, f"{round_no}:{right}".encode(), hashlib.sha256).digest()
+            left, right = right, left ^ (int.from_bytes(digest[:4], "big") & mask)
+        n = (left << FEISTEL_HALF_BITS) | right
+        if n < FAMILY_CODE_SPACE:
+            return n
+
 def generate_family_code():
-    """Generate a unique 8-character family code"""
+    """Unique, unguessable 8-character family code.
+
+    Codes are a keyed permutation of a persistent counter, so new codes never
+    collide with each other; the existence check only guards legacy codes.
+    """
+    key = db.storage.secret("family_codes")
     while True:
-        code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-        if code not in db.families:
+        n = permute_code_number(db.storage.next_counter("family_codes") % FAMILY_CODE_SPACE, key)
+        chars = []
+        for _ in range(FAMILY_CODE_LENGTH):
+            n, digit = divmod(n, len(FAMILY_CODE_ALPHABET))
+            chars.append(FAMILY_CODE_ALPHABET[digit])
+        code = ''.join(chars)
+        if not db.has_family(code):
             return code
 
 def get_role_color(role):
     return ROLE_COLORS.get(role, ROLE_COLORS["Other"])
 
-def format_timestamp(iso_time):
+def format_timestamp(timestamp):
     try:
-        dt = datetime.fromisoformat(iso_time)
+        dt = to_datetime(timestamp)
         now = datetime.now()
         diff = (now - dt).total_seconds()
         if diff < 60: return "Just now"
@@ -108,604 +2587,1329 @@ def format_timestamp(iso_time):
     except:
         return "Just now"
 
-def get_current_family_data():
-    """Get current family data"""
-    if db.current_family and db.current_family in db.families:
-        return db.families[db.current_family]
-    return None
+def format_clock_time(timestamp):
+    """Absolute time for fragments that are rendered once and reused"""
+    try:
+        return to_datetime(timestamp).strftime("%b %d, %I:%M %p")
+    except (TypeError, ValueError, OSError, OverflowError):
+        return ""
 
-def get_user_avatar_html(username):
+def new_session(family_code, username):
+    """Per-browser login state, kept in a gr.State instead of on the shared db"""
+    return {"family": family_code, "user": username}
+
+def get_current_family_data(session):
+    """Get the family of the logged-in session"""
+    if not session:
+        return None
+    return db.get_family(session.get("family"))
+
+def get_user_avatar_html(family, username):
     """Get user avatar (profile pic or emoji)"""
-    family = get_current_family_data()
     if not family:
         return "👤"
 
     user = family['users'].get(username, {})
+    variants = user.get('profile_variants')
+    if variants:
+        return (f'<img src="{image_src(variants["avatar"]["key"])}" srcset="{srcset_html(variants, AVATAR_VARIANTS)}" '
+                f'sizes="50px" loading="lazy" class="fc-cover fc-round">')
     if user.get('profile_pic'):
-        return f'<img src="{user["profile_pic"]}" style="width: 100%; height: 100%; object-fit: cover; border-radius: 50%;">'
+        return f'<img src="{image_src(user["profile_pic"])}" loading="lazy" class="fc-cover fc-round">'
     return user.get('avatar', '👤')
 
+# HTML templates
+# Views are built from templates prepared once at import (see html_template)
+# and rows are collected in a list and joined once at the end. Styling lives in VIEW_CSS (loaded
+# with the page) rather than inline on every row; the per-row colour is passed
+# as the --fc-color custom property.
+VIEW_CSS = """
+    .fc-view { padding: 10px; }
+    .fc-empty { text-align: center; padding: 60px; background: white; border-radius: 20px; }
+    .fc-empty-icon { font-size: 64px; margin-bottom: 20px; }
+    .fc-empty h3 { color: #666; font-size: 20px; }
+    .fc-hint { text-align: center; color: #999; font-size: 13px; margin-bottom: 15px; }
+    .fc-note { color: #666; padding: 20px; }
+    .fc-footer { text-align: center; color: #666; font-size: 13px; }
+    .fc-meta { font-size: 13px; color: #666; }
+    .fc-panel { background: white; padding: 25px; border-radius: 20px; box-shadow: 0 4px 12px rgba(0,0,0,0.08); }
+    .fc-card { background: white; border-radius: 20px; padding: 25px; margin-bottom: 20px;
+               box-shadow: 0 4px 12px rgba(0,0,0,0.08); }
+    .fc-accent { border-left: 5px solid var(--fc-color); }
+    .fc-row { display: flex; align-items: start; gap: 15px; }
+    .fc-body { flex: 1; min-width: 0; }
+    .fc-avatar { background: var(--fc-color); width: 50px; height: 50px; border-radius: 50%;
+                 display: flex; align-items: center; justify-content: center; color: white;
+                 font-weight: bold; font-size: 20px; flex-shrink: 0; box-shadow: 0 2px 6px rgba(0,0,0,0.15);
+                 overflow: hidden; }
+    .fc-cover { width: 100%; height: 100%; object-fit: cover; }
+    .fc-round { border-radius: 50%; }
+    .fc-head { margin-bottom: 8px; }
+    .fc-author { color: #111; font-size: 16px; margin-right: 8px; }
+    .fc-badge { background: var(--fc-color); color: white; padding: 3px 10px; border-radius: 10px;
+                font-size: 11px; font-weight: 600; margin-right: 8px; }
+    .fc-time { color: #999; font-size: 13px; }
+    .fc-reaction { background: #f3f4f6; padding: 4px 10px; border-radius: 12px; font-size: 13px; margin-right: 5px; }
+
+    .fc-stats { display: grid; grid-template-columns: repeat(auto-fit, minmax(200px, 1fr)); gap: 20px;
+                margin-bottom: 30px; }
+    .fc-stat { padding: 25px; border-radius: 20px; color: white; box-shadow: 0 6px 15px rgba(0,0,0,0.1); }
+    .fc-stat-value { font-size: 36px; font-weight: bold; }
+    .fc-stat-label { font-size: 14px; opacity: 0.9; }
+    .fc-birthday { background: #fef3c7; padding: 10px; border-radius: 10px; margin-top: 10px; }
+    .fc-quick-stats { margin-top: 20px; }
+    .fc-quick-stats div { color: #666; font-size: 15px; line-height: 2; }
+
+    .fc-announcement .fc-row { gap: 20px; }
+    .fc-announcement .fc-avatar { width: 60px; height: 60px; font-size: 24px; box-shadow: 0 3px 8px rgba(0,0,0,0.15); }
+    .fc-announcement .fc-head { margin-bottom: 12px; }
+    .fc-announcement .fc-author { font-size: 18px; }
+    .fc-announcement .fc-badge { padding: 4px 12px; border-radius: 12px; font-size: 12px; margin-right: 0; }
+    .fc-announcement .fc-time { font-size: 14px; margin-top: 4px; }
+    .fc-announcement .fc-reaction { padding: 8px 14px; border-radius: 20px; font-size: 16px; margin-right: 8px; }
+    .fc-priority { background: #ef4444; color: white; padding: 4px 12px; border-radius: 12px; font-size: 12px;
+                   font-weight: 600; margin-left: 10px; }
+    .fc-quote { background: linear-gradient(135deg, #f8f9fa 0%, #e9ecef 100%); padding: 20px; border-radius: 15px;
+                margin-bottom: 15px; border: 2px solid #e9ecef; }
+    .fc-quote p { color: #111; font-size: 16px; line-height: 1.6; margin: 0; font-weight: 500; }
+    .fc-chips { display: flex; gap: 10px; flex-wrap: wrap; }
+    .fc-comments { margin-top: 15px; padding-top: 15px; border-top: 2px solid #e5e7eb; }
+    .fc-comment { margin-bottom: 10px; font-size: 14px; }
+
+    .fc-chat { padding: 10px; max-height: 600px; overflow-y: auto; }
+    .fc-message { margin-bottom: 20px; animation: fadeIn 0.3s; }
+    .fc-bubble { background: white; padding: 16px 20px; border-radius: 18px; border-top-left-radius: 4px;
+                 box-shadow: 0 2px 8px rgba(0,0,0,0.1); border: 2px solid #f3f4f6; }
+    .fc-bubble p { color: #111; font-size: 15px; line-height: 1.5; margin: 0; font-weight: 500; }
+    .fc-reactions { margin-top: 8px; }
+
+    .fc-event { --fc-color: #3b82f6; padding: 20px; margin-bottom: 15px; }
+    .fc-event.fc-today { --fc-color: #ef4444; }
+    .fc-event h3 { color: #111; font-size: 18px; margin: 0 0 10px 0; font-weight: bold; }
+    .fc-details { color: #666; font-size: 14px; line-height: 1.8; }
+    .fc-attendees { margin-top: 10px; }
+
+    .fc-task { --fc-color: #f59e0b; background: white; border-radius: 15px; padding: 20px; margin-bottom: 15px;
+               box-shadow: 0 2px 8px rgba(0,0,0,0.08); border-left: 4px solid var(--fc-color);
+               display: flex; justify-content: space-between; align-items: center; }
+    .fc-task.fc-done { --fc-color: #10b981; opacity: 0.6; }
+    .fc-task-title { font-size: 16px; font-weight: 600; color: #111; margin-bottom: 8px; }
+    .fc-task-id { color: #999; font-size: 13px; font-weight: normal; }
+    .fc-status { background: var(--fc-color); color: white; padding: 6px 14px; border-radius: 12px;
+                 font-size: 12px; font-weight: 600; }
+
+    .fc-panel h3 { margin: 0 0 20px 0; color: #111; font-size: 20px; font-weight: bold; }
+    .fc-member { display: flex; align-items: center; gap: 15px; padding: 15px; border-radius: 15px;
+                 margin-bottom: 12px; background: #f9fafb; box-shadow: 0 2px 4px rgba(0,0,0,0.05); }
+    .fc-member.fc-current { border: 3px solid #3b82f6; background: #eff6ff; }
+    .fc-member .fc-avatar { font-size: 28px; font-weight: normal; box-shadow: 0 2px 6px rgba(0,0,0,0.1); }
+    .fc-member-name { font-weight: bold; color: #111; font-size: 16px; margin-bottom: 4px; }
+    .fc-member-role { font-size: 13px; margin-bottom: 4px; }
+    .fc-member .fc-badge { font-size: inherit; margin-right: 0; }
+    .fc-member-status { font-size: 12px; color: #666; }
+    .fc-online { width: 12px; height: 12px; background: #10b981; border-radius: 50%;
+                 box-shadow: 0 0 0 3px rgba(16, 185, 129, 0.2); }
+
+    .fc-gallery { display: grid; grid-template-columns: repeat(auto-fill, minmax(250px, 1fr)); gap: 20px; padding: 10px; }
+    .fc-photo { background: white; border-radius: 15px; overflow: hidden; box-shadow: 0 4px 12px rgba(0,0,0,0.08); }
+    .fc-photo img { width: 100%; height: 250px; object-fit: cover; }
+    .fc-caption { padding: 15px; }
+    .fc-caption strong { display: block; color: #111; margin-bottom: 5px; }
+
+    .fc-poll h3 { color: #111; margin-bottom: 15px; }
+    .fc-poll .fc-meta { margin-bottom: 15px; }
+    .fc-option { margin-bottom: 12px; }
+    .fc-option-head { display: flex; justify-content: space-between; margin-bottom: 5px; }
+    .fc-option-head span { font-weight: 500; }
+    .fc-option-head span + span { font-weight: normal; color: #666; }
+    .fc-bar { background: #e5e7eb; border-radius: 10px; height: 8px; overflow: hidden; }
+    .fc-bar div { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); height: 100%; transition: width 0.3s; }
+
+    .fc-stories { display: flex; gap: 15px; overflow-x: auto; padding: 10px; }
+    .fc-story { min-width: 120px; max-width: 120px; text-align: center; }
+    .fc-story-ring { width: 120px; height: 120px; border-radius: 50%; background: var(--fc-color); padding: 4px;
+                     box-shadow: 0 4px 12px rgba(0,0,0,0.15); }
+    .fc-story-ring div { width: 100%; height: 100%; border-radius: 50%; background: white; display: flex;
+                         align-items: center; justify-content: center; font-size: 48px; overflow: hidden; }
+    .fc-story-author { margin-top: 8px; font-size: 13px; color: #111; font-weight: 500; }
+    .fc-story-time { font-size: 11px; color: #666; }
+
+    .fc-result { background: white; border-radius: 15px; padding: 15px 20px; margin-bottom: 12px;
+                 box-shadow: 0 2px 8px rgba(0,0,0,0.08); }
+    .fc-result-label { font-size: 12px; color: #667eea; font-weight: 600; margin-bottom: 6px; }
+    .fc-result-text { color: #111; font-size: 15px; margin-bottom: 6px; }
+    .fc-result .fc-meta { font-size: 12px; }
+    .fc-view > .fc-meta { margin-bottom: 12px; }
+
+    .fc-family { background: #f9fafb; padding: 20px; border-radius: 15px; margin-bottom: 15px;
+                 border-left: 5px solid #3b82f6; }
+    .fc-family h4 { margin: 0 0 10px 0; color: #111; }
+    .fc-family-meta { font-size: 14px; color: #666; }
+    .fc-family-meta + .fc-family-meta { margin-top: 6px; }
+"""
+
+def html_template(source):
+    """A str.format-style template as a function taking its fields as keywords.
+    Indentation is collapsed once here instead of being shipped on every row."""
+    return " ".join(source.split()).format
+
+EMPTY_STATE = html_template("""
+    <div class='fc-empty'><div class='fc-empty-icon'>{icon}</div><h3>{text}</h3></div>""")
+
 # Admin Panel Functions
 def admin_login(username, password):
-    if username in db.admin_users and db.admin_users[username] == password:
+    """Last output is the admin session flag (admin_state)"""
+    if check_admin_password(username, password):
         return (
             gr.update(visible=False),
             gr.update(visible=True),
             "✅ Admin access granted!",
-            get_admin_dashboard_html()
+            get_admin_dashboard_html(),
+            True
         )
-    return gr.update(), gr.update(), "❌ Invalid admin credentials!", ""
+    return gr.update(), gr.update(), "❌ Invalid admin credentials!", "", False
 
 def create_new_family(family_name):
     if not family_name.strip():
         return "❌ Family name required!", get_admin_dashboard_html()
 
     code = generate_family_code()
-    db.families[code] = {
-        "name": family_name,
-        "code": code,
-        "created": datetime.now().isoformat(),
-        "users": {},
-        "announcements": [],
-        "messages": [],
-        "events": [],
-        "tasks": [],
-        "photos": [],
-        "polls": [],
-        "stories": []
-    }
+    db.create_family(family_name, code)
 
     return f"✅ Family '{family_name}' created! Code: {code}", get_admin_dashboard_html()
 
 def delete_family(family_code):
-    if family_code in db.families:
-        family_name = db.families[family_code]['name']
-        del db.families[family_code]
+    family = db.get_family(family_code)
+    if family:
+        family_name = family['name']
+        db.delete_family(family_code)
         return f"✅ Family '{family_name}' deleted!", get_admin_dashboard_html()
     return "❌ Family code not found!", get_admin_dashboard_html()
 
-def get_admin_dashboard_html():
-    html = f"""
+ADMIN_PAGE_SIZE = 25
+# label: (directory index, descending)
+ADMIN_SORTS = {
+    "Newest": ("created", True),
+    "Oldest": ("created", False),
+    "Name": ("name", False),
+    "Most members": ("members", True),
+}
+
+ADMIN_FAMILY_ROW = html_template("""
+    <div class='fc-family'>
+        <h4>{name}</h4>
+        <div class='fc-family-meta'>
+            🔑 Code: <strong>{code}</strong> |
+            👥 Members: {members} |
+            📅 Created: {created}
+        </div>
+        <div class='fc-family-meta'>
+            ⏳ Pending tasks: {pending} |
+            📆 Upcoming events: {upcoming}
+        </div>
+    </div>""")
+
+def get_admin_dashboard_html(sort="Newest", page=1):
+    field, descending = ADMIN_SORTS.get(sort, ADMIN_SORTS["Newest"])
+    directory = db.directory()
+    pages = max(1, -(-len(directory) // ADMIN_PAGE_SIZE))
+    page = min(max(1, page), pages)
+    families, total = directory.page(field, descending, (page - 1) * ADMIN_PAGE_SIZE, ADMIN_PAGE_SIZE)
+    parts = [f"""
     <div style='padding: 20px;'>
         <h2 style='color: #111; margin-bottom: 20px;'>👑 Admin Dashboard</h2>
 
         <div style='background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
                     padding: 30px; border-radius: 20px; color: white; margin-bottom: 30px;'>
-            <div style='font-size: 48px; font-weight: bold; margin-bottom: 10px;'>{len(db.families)}</div>
+            <div style='font-size: 48px; font-weight: bold; margin-bottom: 10px;'>{total}</div>
             <div style='font-size: 18px;'>Total Families Registered</div>
         </div>
 
         <div style='background: white; padding: 25px; border-radius: 20px; box-shadow: 0 4px 12px rgba(0,0,0,0.08);'>
             <h3 style='margin-bottom: 20px;'>📋 Registered Families</h3>
-    """
+            <div style='font-size: 13px; color: #666; margin-bottom: 15px;'>Page {page} of {pages} • sorted by {sort.lower()}</div>
+    """]
 
-    for code, family in db.families.items():
-        member_count = len(family['users'])
+    today = date.today()
+    for family in families:
+        code = family['code']
+        member_count = family['members']
         created_date = datetime.fromisoformat(family['created']).strftime('%B %d, %Y')
+        pending, upcoming = db.family_activity(code, today)
+
+        parts.append(ADMIN_FAMILY_ROW(name=family['name'], code=code, members=member_count,
+                                      created=created_date, pending=pending, upcoming=upcoming))
+
+    parts.append("</div></div>")
+    return "".join(parts)
+
+def admin_change_page(sort, page, step):
+    """Move the admin listing by `step` pages (0 re-renders, e.g. after a sort change)"""
+    pages = max(1, -(-len(db.directory()) // ADMIN_PAGE_SIZE))
+    page = min(max(1, (page or 1) + step), pages)
+    return get_admin_dashboard_html(sort, page), page
+
+# Backup and restore
+# An export is an NDJSON file (one entry per line, see FamilyConnectDB.export_family)
+# plus a tar of the blobs it references; both are written and read as streams.
+EXPORT_FORMAT = {"type": "familyconnect-export", "version": 1}
+
+def export_families(codes, out_dir):
+    """Write an NDJSON export and its blob archive; returns (ndjson path, tar path, stats)"""
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    label = codes[0] if len(codes) == 1 else "all"
+    ndjson_path = os.path.join(out_dir, f"familyconnect-{label}-{stamp}.ndjson")
+    tar_path = os.path.join(out_dir, f"familyconnect-{label}-{stamp}.blobs.tar")
+    stats = Counter()
+    archived = set()
+    with open(ndjson_path, "w", encoding="utf-8") as out, tarfile.open(tar_path, "w") as tar:
+        out.write(json.dumps(EXPORT_FORMAT) + "\n")
+        for code in codes:
+            for entry in db.export_family(code):
+                out.write(json.dumps(entry, separators=(",", ":"), default=json_default) + "\n")
+                stats[entry['type']] += 1
+                for key in record_blob_keys(entry.get('user') or entry.get('record') or {}):
+                    if key not in archived and blobs.exists(key):
+                        tar.add(blobs.path(key), arcname=key)
+                        archived.add(key)
+    stats['blob'] = len(archived)
+    return ndjson_path, tar_path, stats
+
+def check_export_entry(entry):
+    """Raise ValueError unless `entry` has the fields import_entries reads for its type"""
+    fields = {"family": {"code": str, "name": str, "created": str},
+              "user": {"family": str, "username": str, "user": dict},
+              "record": {"family": str, "collection": str, "record": dict}}.get(
+                  entry.get('type') if isinstance(entry, dict) else None)
+    if fields is None:
+        raise ValueError(f"unknown entry {str(entry)[:80]}")
+    for field, kind in fields.items():
+        if not isinstance(entry.get(field), kind):
+            raise ValueError(f"{entry['type']} entry without a valid '{field}'")
+    if entry['type'] == 'record' and not isinstance(entry['record'].get('id'), int):
+        raise ValueError("record entry without an integer id")
+
+def validate_export(path):
+    """Read a whole NDJSON export before anything is written; returns its entry count"""
+    count = 0
+    for count, entry in enumerate(read_export(path), 1):
+        try:
+            check_export_entry(entry)
+        except ValueError as exc:
+            raise ValueError(f"entry {count}: {exc}") from None
+    return count
+
+def read_export(path):
+    """Entries of an NDJSON export, one line at a time"""
+    with open(path, encoding="utf-8") as f:
+        header = json.loads(f.readline() or "{}")
+        if header.get('type') != EXPORT_FORMAT['type']:
+            raise ValueError("not a FamilyConnect export")
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def import_blob_archive(path):
+    """Restore the blobs that imported records reference from an export's tar.
+
+    Run after import_entries, so members nothing refers to are never written;
+    members whose content doesn't match their key are dropped. Returns the keys
+    stored, which are removed again if the archive turns out to be unreadable.
+    """
+    restored = []
+    try:
+        with tarfile.open(path, "r|*") as tar:
+            for member in tar:
+                key = os.path.basename(member.name)
+                if (not member.isfile() or not BLOB_KEY_RE.match(key) or blobs.exists(key)
+                        or not db.storage.blob_in_use(key)):
+                    continue
+                restored.append(key)  # before writing, so a failure part-way removes it too
+                stored = blobs.put_file(tar.extractfile(member), key.rsplit(".", 1)[1])
+                if stored != key:
+                    restored.pop()
+                    if not db.storage.blob_in_use(stored):
+                        blobs.delete(stored)
+    except BaseException:
+        for key in restored:
+            blobs.delete(key)
+        raise
+    return restored
+
+def export_backup(family_code):
+    """Admin export of one family (or every family when no code is given)"""
+    family_code = (family_code or "").strip()
+    if family_code and not db.has_family(family_code):
+        return "❌ Family code not found!", None, None
+    codes = [family_code] if family_code else db.family_codes()
+    out_dir = tempfile.mkdtemp(prefix="familyconnect-export-")
+    try:
+        ndjson_path, tar_path, stats = export_families(codes, out_dir)
+    except BaseException:
+        remove_export(out_dir)
+        raise
+    return (f"✅ Exported {stats['family']} families, {stats['user']} members, "
+            f"{stats['record']} items and {stats['blob']} images", [ndjson_path, tar_path], out_dir)
+
+def remove_export(out_dir):
+    """Delete an export's temporary directory once the download has been handed to Gradio"""
+    if out_dir:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return None
 
-        html += f"""
-        <div style='background: #f9fafb; padding: 20px; border-radius: 15px; margin-bottom: 15px;
-                    border-left: 5px solid #3b82f6;'>
-            <div style='display: flex; justify-content: space-between; align-items: center;'>
-                <div>
-                    <h4 style='margin: 0 0 10px 0; color: #111;'>{family['name']}</h4>
-                    <div style='font-size: 14px; color: #666;'>
-                        🔑 Code: <strong>{code}</strong> |
-                        👥 Members: {member_count} |
-                        📅 Created: {created_date}
-                    </div>
-                </div>
-            </div>
-        </div>
-        """
+def import_backup(files):
+    """Admin import of an export (.ndjson, optionally with its .blobs.tar)"""
+    paths = [getattr(f, "name", f) for f in (files or [])]
+    ndjson_paths = [p for p in paths if p.endswith(".ndjson")]
+    if len(ndjson_paths) != 1:
+        return "❌ Upload exactly one .ndjson export (plus its .tar of images)!", get_admin_dashboard_html()
+    # Validate everything first, then write rows, then only the blobs those rows use;
+    # a failure at any step deletes what this import created
+    results, restored = {}, []
+    try:
+        validate_export(ndjson_paths[0])
+        results = db.import_entries(read_export(ndjson_paths[0]))
+        for path in paths:
+            if path.endswith(".tar"):
+                restored += import_blob_archive(path)
+    except (ValueError, KeyError, OSError, sqlite3.Error, tarfile.TarError) as exc:
+        for key in restored:
+            blobs.delete(key)
+        db.discard_import(results)
+        return f"❌ Import failed, nothing was imported: {exc}", get_admin_dashboard_html()
+    imported = [code for code, result in results.items() if result == "imported"]
+    skipped = [code for code, result in results.items() if result == "skipped"]
+    message = f"✅ Imported {len(imported)} families and {len(restored)} images"
+    if skipped:
+        message += f" (skipped existing: {', '.join(skipped)})"
+    return message, get_admin_dashboard_html()
+
+# Performance panel
+PERFORMANCE_TOP_FAMILIES = 10
+
+def get_performance_html(is_admin=False):
+    """Admin view of handler latencies, render sizes and the largest families"""
+    if not is_admin:
+        return "<div class='fc-note'>🔒 Log in as admin to see performance data.</div>"
+    if not METRICS_ENABLED:
+        return "<div style='padding: 20px; color: #666;'>Metrics are disabled (FAMILYCONNECT_METRICS=0).</div>"
+    cell = "padding: 6px 10px; border-bottom: 1px solid #eee; text-align: right;"
+    name_cell = "padding: 6px 10px; border-bottom: 1px solid #eee;"
+
+    def table(title, headers, rows):
+        head = "".join(f"<th style='{name_cell if i == 0 else cell}'>{h}</th>" for i, h in enumerate(headers))
+        body = "".join(
+            "<tr>" + "".join(f"<td style='{name_cell if i == 0 else cell}'>{v}</td>" for i, v in enumerate(row))
+            + "</tr>" for row in rows)
+        return f"""
+        <div style='background: white; padding: 20px; border-radius: 15px; margin-bottom: 20px;
+                    box-shadow: 0 4px 12px rgba(0,0,0,0.08);'>
+            <h3 style='margin-bottom: 12px;'>{title}</h3>
+            <table style='width: 100%; border-collapse: collapse; font-size: 14px;'>
+                <tr>{head}</tr>{body}
+            </table>
+        </div>"""
 
-    html += "</div></div>"
-    return html
+    with metrics._lock:
+        handlers = sorted(metrics.handlers.items(), key=lambda item: -item[1].sum)
+        handler_rows = [(name, h.count, metrics.handler_errors[name], f"{1000 * h.sum / h.count:.1f}",
+                         f"≤ {1000 * h.quantile(0.95):g}", f"{h.sum:.2f}") for name, h in handlers]
+        view_rows = []
+        for view in sorted(metrics.renders.keys() | metrics.render_hits.keys()):
+            renders, hits = metrics.renders[view], metrics.render_hits[view]
+            view_rows.append((view, renders, f"{100 * hits / (renders + hits):.0f}%",
+                              f"{metrics.render_bytes[view] / max(renders, 1) / 1024:.1f}"))
+
+    totals = {}
+    for code, collection, items, size in metrics.family_sizes():
+        total = totals.setdefault(code, [0, 0])
+        total[0] += items
+        total[1] += size or 0
+    largest = sorted(totals.items(), key=lambda item: -item[1][1])[:PERFORMANCE_TOP_FAMILIES]
+    family_rows = []
+    for code, (items, size) in largest:
+        # Codes are join credentials; show the digest /metrics labels the family with
+        info = db.storage.family_info(code)
+        label = metrics.family_label(code)
+        family_rows.append((info['name'] if info else label, label, items, f"{size / 1024:.0f}"))
+
+    return ("<div style='padding: 20px;'><h2 style='color: #111; margin-bottom: 20px;'>📈 Performance</h2>"
+            + table("⏱️ Handlers (by total time)", ["Handler", "Calls", "Errors", "Mean ms", "p95 ms", "Total s"],
+                    handler_rows)
+            + table("🖼️ Tab renders", ["View", "Renders", "Cache hits", "Avg KiB"], view_rows)
+            + table("📦 Largest families", ["Family", "Label", "Items", "KiB"], family_rows)
+            + "</div>")
 
 # Dashboard HTML
-def get_dashboard_html():
-    family = get_current_family_data()
+STAT_CARD = html_template("""
+    <div class='fc-stat' style='background: {gradient};'>
+        <div class='fc-stat-value'>{value}</div>
+        <div class='fc-stat-label'>{label}</div>
+    </div>""")
+BIRTHDAY_NOTICE = html_template("<div class='fc-birthday'>🎂 {name}'s birthday {when}</div>")
+DASHBOARD = html_template("""
+    <div style='padding: 20px;'>
+        <h2 style='color: #111; font-size: 28px; margin-bottom: 10px;'>👋 Welcome to {name}!</h2>
+        <p style='color: #666; margin-bottom: 25px;'>Family Code: <strong>{code}</strong></p>
+        <div class='fc-stats'>{stats}</div>
+        {birthdays}
+        <div class='fc-panel fc-quick-stats'>
+            <h3 style='color: #111; margin-bottom: 15px;'>🎯 Quick Stats</h3>
+            <div>
+                ✅ {completed} tasks completed<br>
+                ⏳ {pending} tasks pending<br>
+                📅 {upcoming} events coming up<br>
+                💬 Last message: {last_message}
+            </div>
+        </div>
+    </div>""")
+
+@cached_view("dashboard")
+def get_dashboard_html(session):
+    family = get_current_family_data(session)
     if not family:
         return "<div>No family data available</div>"
 
+    index = db.index(session['family'])
+    today = date.today()
     total_members = len(family['users'])
     total_announcements = len(family['announcements'])
     total_messages = len(family['messages'])
-    upcoming_events = len([e for e in family['events'] if datetime.fromisoformat(e['date']) >= datetime.now()])
-    pending_tasks = len([t for t in family['tasks'] if t['status'] == 'pending'])
+    upcoming_events = index.upcoming_event_count(today)
+    pending_tasks = index.task_counts['pending']
+    completed_tasks = index.task_counts['completed']
+
+    upcoming_bday = "".join(
+        BIRTHDAY_NOTICE(name=name, when='is today!' if days_until == 0 else f'in {days_until} days!')
+        for days_until, name in index.upcoming_birthdays(today))
+    stats = "".join([
+        STAT_CARD(gradient="linear-gradient(135deg, #667eea 0%, #764ba2 100%)", value=total_members,
+                  label="Family Members"),
+        STAT_CARD(gradient="linear-gradient(135deg, #f093fb 0%, #f5576c 100%)", value=total_announcements,
+                  label="Announcements"),
+        STAT_CARD(gradient="linear-gradient(135deg, #4facfe 0%, #00f2fe 100%)", value=total_messages,
+                  label="Chat Messages"),
+        STAT_CARD(gradient="linear-gradient(135deg, #43e97b 0%, #38f9d7 100%)", value=upcoming_events,
+                  label="Upcoming Events"),
+    ])
+    last_message = format_timestamp(family['messages'][-1]['timestamp']) if family['messages'] else 'No messages yet'
+    return DASHBOARD(name=family['name'], code=family['code'], stats=stats, birthdays=upcoming_bday,
+                     completed=completed_tasks, pending=pending_tasks, upcoming=upcoming_events,
+                     last_message=last_message)
 
-    upcoming_bday = ""
-    for username, user in family['users'].items():
-        try:
-            bday = datetime.strptime(user.get('birthday', ''), '%Y-%m-%d')
-            today = datetime.now()
-            next_bday = bday.replace(year=today.year)
-            if next_bday < today:
-                next_bday = next_bday.replace(year=today.year + 1)
-            days_until = (next_bday - today).days
-            if 0 <= days_until <= 30:
-                upcoming_bday += f"<div style='background: #fef3c7; padding: 10px; border-radius: 10px; margin-top: 10px;'>🎂 {user['name']}'s birthday in {days_until} days!</div>"
-        except:
-            pass
-
-    return f"""
-    <div style='padding: 20px;'>
-        <h2 style='color: #111; font-size: 28px; margin-bottom: 10px;'>👋 Welcome to {family['name']}!</h2>
-        <p style='color: #666; margin-bottom: 25px;'>Family Code: <strong>{family['code']}</strong></p>
-
-        <div style='display: grid; grid-template-columns: repeat(auto-fit, minmax(200px, 1fr)); gap: 20px; margin-bottom: 30px;'>
-            <div style='background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 25px; border-radius: 20px; color: white; box-shadow: 0 6px 15px rgba(0,0,0,0.1);'>
-                <div style='font-size: 36px; font-weight: bold;'>{total_members}</div>
-                <div style='font-size: 14px; opacity: 0.9;'>Family Members</div>
-            </div>
-
-            <div style='background: linear-gradient(135deg, #f093fb 0%, #f5576c 100%); padding: 25px; border-radius: 20px; color: white; box-shadow: 0 6px 15px rgba(0,0,0,0.1);'>
-                <div style='font-size: 36px; font-weight: bold;'>{total_announcements}</div>
-                <div style='font-size: 14px; opacity: 0.9;'>Announcements</div>
-            </div>
-
-            <div style='background: linear-gradient(135deg, #4facfe 0%, #00f2fe 100%); padding: 25px; border-radius: 20px; color: white; box-shadow: 0 6px 15px rgba(0,0,0,0.1);'>
-                <div style='font-size: 36px; font-weight: bold;'>{total_messages}</div>
-                <div style='font-size: 14px; opacity: 0.9;'>Chat Messages</div>
-            </div>
-
-            <div style='background: linear-gradient(135deg, #43e97b 0%, #38f9d7 100%); padding: 25px; border-radius: 20px; color: white; box-shadow: 0 6px 15px rgba(0,0,0,0.1);'>
-                <div style='font-size: 36px; font-weight: bold;'>{upcoming_events}</div>
-                <div style='font-size: 14px; opacity: 0.9;'>Upcoming Events</div>
+# Announcements HTML
+ANNOUNCEMENT_COMMENTS_SHOWN = 3  # newest comments shown on the card; the rest are paged in the thread view
+COMMENTS_PAGE_SIZE = 20
+REACTION_EMOJIS = ["❤️", "👍", "😂", "😮", "😢", "🎉"]
+PRIORITY_BADGE = "<span class='fc-priority'>🔥 HIGH PRIORITY</span>"
+REACTION = html_template("<span class='fc-reaction'>{emoji} {count}</span>")
+COMMENT = html_template("<div class='fc-comment'><strong>{author}:</strong> {content}</div>")
+EARLIER_COMMENTS = html_template("<div class='fc-meta'>+ {count} earlier comments (thread #{id})</div>")
+ANNOUNCEMENT = html_template("""
+    <div class='fc-card fc-accent fc-announcement' style='--fc-color: {color};'>
+        <div class='fc-row'>
+            <div class='fc-avatar'>{initial}</div>
+            <div class='fc-body'>
+                <div class='fc-head'>
+                    <strong class='fc-author'>{author}</strong>
+                    <span class='fc-badge'>{role}</span>
+                    {priority}
+                    <div class='fc-time'>{time} • #{id}</div>
+                </div>
+                <div class='fc-quote'><p>{content}</p></div>
+                <div class='fc-chips'>{reactions}</div>
+                {comments}
             </div>
         </div>
+    </div>""")
 
-        {upcoming_bday}
-
-        <div style='background: white; padding: 25px; border-radius: 20px; box-shadow: 0 4px 12px rgba(0,0,0,0.08); margin-top: 20px;'>
-            <h3 style='color: #111; margin-bottom: 15px;'>🎯 Quick Stats</h3>
-            <div style='color: #666; font-size: 15px; line-height: 2;'>
-                ✅ {len([t for t in family['tasks'] if t['status'] == 'completed'])} tasks completed<br>
-                ⏳ {pending_tasks} tasks pending<br>
-                📅 {upcoming_events} events coming up<br>
-                💬 Last message: {format_timestamp(family['messages'][-1]['timestamp']) if family['messages'] else 'No messages yet'}
-            </div>
-        </div>
-    </div>
-    """
+def render_reactions_html(reactions):
+    return " ".join([REACTION(emoji=emoji, count=len(users)) for emoji, users in reactions.items()])
 
-# Announcements HTML
-def get_announcements_html():
-    family = get_current_family_data()
+def render_comments_html(announcement, limit):
+    """The newest `limit` comments, oldest first, under a count of the earlier ones"""
+    comments = announcement.get('comments')
+    if not comments:
+        return ""
+    start = max(0, len(comments) - limit)
+    parts = ["<div class='fc-comments'>"]
+    if start:
+        parts.append(EARLIER_COMMENTS(count=start, id=announcement['id']))
+    parts.extend(COMMENT(author=comment['author'], content=comment['content']) for comment in comments[start:])
+    parts.append("</div>")
+    return "".join(parts)
+
+def render_announcement_html(announcement):
+    """HTML fragment for a single announcement"""
+    role = announcement.get('role', 'Other')
+    comments_html = render_comments_html(announcement, ANNOUNCEMENT_COMMENTS_SHOWN)
+    return ANNOUNCEMENT(
+        id=announcement['id'],
+        color=get_role_color(role), initial=announcement['author'][0], author=announcement['author'],
+        role=role, priority=PRIORITY_BADGE if announcement.get('priority') == 'high' else "",
+        time=format_timestamp(announcement['timestamp']), content=announcement['content'],
+        reactions=render_reactions_html(announcement.get('reactions') or {}), comments=comments_html)
+
+@cached_view("announcements")
+def get_announcements_html(session):
+    family = get_current_family_data(session)
     if not family or not family['announcements']:
-        return """<div style='text-align: center; padding: 60px; background: white; border-radius: 20px;'>
-            <div style='font-size: 64px; margin-bottom: 20px;'>📢</div>
-            <h3 style='color: #666; font-size: 20px;'>No announcements yet</h3></div>"""
-
-    html = "<div style='padding: 10px;'>"
-    for announcement in reversed(family['announcements']):
-        role = announcement.get('role', 'Other')
-        color = get_role_color(role)
-        priority_badge = ""
-        if announcement.get('priority') == 'high':
-            priority_badge = "<span style='background: #ef4444; color: white; padding: 4px 12px; border-radius: 12px; font-size: 12px; font-weight: 600; margin-left: 10px;'>🔥 HIGH PRIORITY</span>"
-
-        reactions_html = " ".join([f"<span style='background: #f3f4f6; padding: 8px 14px; border-radius: 20px; margin-right: 8px; font-size: 16px;'>{emoji} {len(users)}</span>"
-                                   for emoji, users in announcement.get('reactions', {}).items()])
-
-        comments_html = ""
-        if announcement.get('comments'):
-            comments_html = f"<div style='margin-top: 15px; padding-top: 15px; border-top: 2px solid #e5e7eb;'>"
-            for comment in announcement['comments'][:3]:
-                comments_html += f"<div style='margin-bottom: 10px; font-size: 14px;'><strong>{comment['author']}:</strong> {comment['content']}</div>"
-            if len(announcement['comments']) > 3:
-                comments_html += f"<div style='color: #666; font-size: 13px;'>+ {len(announcement['comments']) - 3} more comments</div>"
-            comments_html += "</div>"
-
-        html += f"""
-        <div style='background: white; border-radius: 20px; padding: 25px; margin-bottom: 20px;
-                    box-shadow: 0 4px 12px rgba(0,0,0,0.08); border-left: 5px solid {color};'>
-            <div style='display: flex; align-items: start; gap: 20px;'>
-                <div style='background: {color}; width: 60px; height: 60px; border-radius: 50%;
-                           display: flex; align-items: center; justify-content: center;
-                           color: white; font-weight: bold; font-size: 24px; flex-shrink: 0;
-                           box-shadow: 0 3px 8px rgba(0,0,0,0.15);'>{announcement['author'][0]}</div>
-                <div style='flex: 1; min-width: 0;'>
-                    <div style='margin-bottom: 12px;'>
-                        <strong style='color: #111; font-size: 18px; display: inline; margin-right: 8px;'>{announcement['author']}</strong>
-                        <span style='background: {color}; color: white; padding: 4px 12px; border-radius: 12px;
-                                    font-size: 12px; font-weight: 600;'>{role}</span>
-                        {priority_badge}
-                        <div style='color: #999; font-size: 14px; margin-top: 4px;'>{format_timestamp(announcement['timestamp'])}</div>
-                    </div>
-                    <div style='background: linear-gradient(135deg, #f8f9fa 0%, #e9ecef 100%);
-                               padding: 20px; border-radius: 15px; margin-bottom: 15px; border: 2px solid #e9ecef;'>
-                        <p style='color: #111; font-size: 16px; line-height: 1.6; margin: 0; font-weight: 500;'>
-                            {announcement['content']}</p>
-                    </div>
-                    <div style='display: flex; gap: 10px; flex-wrap: wrap;'>{reactions_html}</div>
-                    {comments_html}
-                </div>
-            </div>
-        </div>"""
-    html += "</div>"
-    return html
+        return EMPTY_STATE(icon="📢", text="No announcements yet")
+
+    # Cached per item on its revision, so a reaction or comment re-renders only that announcement
+    code = session['family']
+    parts = ["<div class='fc-view'>"]
+    parts.extend(cached_fragment(code, ("announcement", announcement['id']), announcement.get('rev') or 0,
+                                 render_announcement_html, announcement)
+                 for announcement in reversed(family['announcements']))
+    parts.append("</div>")
+    return "".join(parts)
+
+def render_comment_thread(session, announcement_id, limit=COMMENTS_PAGE_SIZE):
+    """One announcement's comments, newest `limit` of them"""
+    family = get_current_family_data(session)
+    announcement = find_by_id(family['announcements'], announcement_id) if family and announcement_id else None
+    if announcement is None:
+        return EMPTY_STATE(icon="💬", text="Pick an announcement by its number")
+    if not announcement.get('comments'):
+        return EMPTY_STATE(icon="💬", text="No comments yet")
+    return "<div class='fc-panel'>" + render_comments_html(announcement, limit) + "</div>"
+
+def show_comments(announcement_id, session):
+    """Open a comment thread at its newest page"""
+    return render_comment_thread(session, int(announcement_id or 0)), COMMENTS_PAGE_SIZE
+
+def show_more_comments(announcement_id, limit, session):
+    """Page further back through a comment thread"""
+    limit = (limit or COMMENTS_PAGE_SIZE) + COMMENTS_PAGE_SIZE
+    return render_comment_thread(session, int(announcement_id or 0), limit), limit
 
 # Messages HTML with reactions
-def get_messages_html():
-    family = get_current_family_data()
-    if not family or not family['messages']:
-        return """<div style='text-align: center; padding: 60px; background: white; border-radius: 20px;'>
-            <div style='font-size: 64px; margin-bottom: 20px;'>💬</div>
-            <h3 style='color: #666; font-size: 20px;'>No messages yet</h3></div>"""
-
-    html = "<div style='padding: 10px; max-height: 600px; overflow-y: auto;'>"
-    for msg in family['messages']:
-        role = msg.get('role', 'Other')
-        color = get_role_color(role)
-
-        reactions_html = ""
-        if msg.get('reactions'):
-            reactions_html = "<div style='margin-top: 8px;'>" + " ".join([
-                f"<span style='background: #f3f4f6; padding: 4px 10px; border-radius: 12px; font-size: 13px; margin-right: 5px;'>{emoji} {len(users)}</span>"
-                for emoji, users in msg['reactions'].items()
-            ]) + "</div>"
-
-        html += f"""
-        <div style='margin-bottom: 20px; animation: fadeIn 0.3s;'>
-            <div style='display: flex; align-items: start; gap: 15px;'>
-                <div style='background: {color}; width: 50px; height: 50px; border-radius: 50%;
-                           display: flex; align-items: center; justify-content: center;
-                           color: white; font-weight: bold; font-size: 20px; flex-shrink: 0;
-                           box-shadow: 0 2px 6px rgba(0,0,0,0.15);'>{msg['author'][0]}</div>
-                <div style='flex: 1; min-width: 0;'>
-                    <div style='margin-bottom: 8px;'>
-                        <strong style='color: #111; font-size: 16px; margin-right: 8px;'>{msg['author']}</strong>
-                        <span style='background: {color}; color: white; padding: 3px 10px; border-radius: 10px;
-                                    font-size: 11px; font-weight: 600; margin-right: 8px;'>{role}</span>
-                        <span style='color: #999; font-size: 13px;'>{format_timestamp(msg['timestamp'])}</span>
-                    </div>
-                    <div style='background: white; padding: 16px 20px; border-radius: 18px;
-                               border-top-left-radius: 4px; box-shadow: 0 2px 8px rgba(0,0,0,0.1);
-                               border: 2px solid #f3f4f6;'>
-                        <p style='color: #111; font-size: 15px; line-height: 1.5; margin: 0; font-weight: 500;'>{msg['content']}</p>
-                        {reactions_html}
-                    </div>
+MESSAGES_PAGE_SIZE = 50   # messages per page / initial chat window
+MESSAGES_WINDOW = 500     # newest fragments a chat view keeps while appending
+
+EMPTY_MESSAGES_HTML = EMPTY_STATE(icon="💬", text="No messages yet")
+MESSAGE = html_template("""
+    <div class='fc-message' style='--fc-color: {color};'>
+        <div class='fc-row'>
+            <div class='fc-avatar'>{initial}</div>
+            <div class='fc-body'>
+                <div class='fc-head'>
+                    <strong class='fc-author'>{author}</strong>
+                    <span class='fc-badge'>{role}</span>
+                    <span class='fc-time'>{time} • #{id}</span>
                 </div>
+                <div class='fc-bubble'><p>{content}</p>{reactions}</div>
             </div>
-        </div>"""
-    html += "</div>"
-    return html
-
-# Continue with remaining HTML functions (events, tasks, family members)...
-def get_events_html():
-    family = get_current_family_data()
-    if not family or not family['events']:
-        return """<div style='text-align: center; padding: 60px; background: white; border-radius: 20px;'>
-            <div style='font-size: 64px; margin-bottom: 20px;'>📅</div>
-            <h3 style='color: #666; font-size: 20px;'>No events scheduled</h3></div>"""
+        </div>
+    </div>""")
 
-    html = "<div style='padding: 10px;'>"
-    for event in sorted(family['events'], key=lambda x: x['date']):
-        try:
-            event_date = datetime.fromisoformat(event['date'])
-        except ValueError:
-            try:
-                event_date = datetime.strptime(event['date'], '%d/%B/%y')
-            except ValueError:
-                try:
-                    event_date = datetime.strptime(event['date'], '%Y-%m-%d')
-                except ValueError:
-                    continue
+def render_message_html(msg):
+    """HTML fragment for a single chat message"""
+    role = msg.get('role', 'Other')
+    reactions = msg.get('reactions')
+    reactions_html = ""
+    if reactions:
+        reactions_html = "<div class='fc-reactions'>" + render_reactions_html(reactions) + "</div>"
+    return MESSAGE(id=msg['id'], color=get_role_color(role), initial=msg['author'][0], author=msg['author'], role=role,
+                   time=format_clock_time(msg['timestamp']), content=msg['content'], reactions=reactions_html)
+
+def get_messages_page(session, before=None, limit=MESSAGES_PAGE_SIZE):
+    """Newest `limit` messages older than the `before` cursor.
+
+    Returns (messages, cursor); pass cursor back to fetch the previous page,
+    it is None once the start of the chat is reached.
+    """
+    if not get_current_family_data(session):
+        return [], None
+    return db.get_page(session['family'], 'messages', before, limit)
+
+def new_chat_view(session):
+    """Chat view state: rendered (id, fragment) pairs plus paging cursors"""
+    messages, cursor = get_messages_page(session)
+    index = db.index(session['family']) if session else None
+    return {
+        "family": session['family'] if session else None,
+        "cursor": cursor,
+        "last_id": messages[-1]['id'] if messages else 0,
+        "edits": index.edits_position() if index else (None, 0),
+        "fragments": [(msg['id'], render_message_html(msg)) for msg in messages],
+    }
 
-        is_today = event_date.date() == datetime.now().date()
-        border_color = "#ef4444" if is_today else "#3b82f6"
-
-        attendees_html = ""
-        if event.get('attendees'):
-            attendees_html = f"<div style='margin-top: 10px;'>👥 Attending: {', '.join(event['attendees'])}</div>"
-
-        html += f"""
-        <div style='background: white; border-radius: 20px; padding: 20px; margin-bottom: 15px;
-                    box-shadow: 0 4px 12px rgba(0,0,0,0.08); border-left: 5px solid {border_color};'>
-            <div style='display: flex; justify-content: space-between; align-items: start;'>
-                <div style='flex: 1;'>
-                    <h3 style='color: #111; font-size: 18px; margin: 0 0 10px 0; font-weight: bold;'>
-                        {event['title']} {'🔴' if is_today else ''}</h3>
-                    <div style='color: #666; font-size: 14px; line-height: 1.8;'>
-                        📅 {event_date.strftime('%B %d, %Y')}<br>
-                        🕐 {event['time']}<br>
-                        📍 {event['location']}<br>
-                        👤 Created by {event['creator']}
-                        {attendees_html}
-                    </div>
-                </div>
+def chat_lock(chat):
+    """Lock for a chat view's state. The same object is shared by the session's
+    handlers and its live_updates stream, which run on different threads."""
+    # setdefault is atomic, so callers racing on a fresh view get the same lock
+    return chat.setdefault('lock', threading.RLock())
+
+def sync_chat_view(session, chat):
+    """Append fragments for messages newer than the view has seen (append-only render
+    path), re-rendering only the ones edited (reacted to) since"""
+    if chat is None or not session:
+        return new_chat_view(session)
+    with chat_lock(chat):
+        index = db.index(session['family'])
+        edited = index.message_edits_since(chat.get('edits', (None, 0)))
+        if chat.get('family') != session['family'] or edited is None:
+            # Filled in place: the chat state object is shared with the live_updates stream
+            lock = chat['lock']
+            chat.clear()
+            chat.update(new_chat_view(session), lock=lock)
+            return chat
+        fragments = chat['fragments']
+        messages = db.get_family(session['family'])['messages']
+        for msg_id in set(edited):
+            i = bisect.bisect_left(fragments, msg_id, key=itemgetter(0))
+            msg = find_by_id(messages, msg_id)
+            if msg is not None and i < len(fragments) and fragments[i][0] == msg_id:
+                fragments[i] = (msg_id, render_message_html(msg))
+        chat['edits'] = index.edits_position()
+        for msg in db.get_since(session['family'], 'messages', chat['last_id']):
+            fragments.append((msg['id'], render_message_html(msg)))
+            chat['last_id'] = msg['id']
+        if len(fragments) > MESSAGES_WINDOW:
+            del fragments[:-MESSAGES_WINDOW]
+            chat['cursor'] = fragments[0][0]
+    return chat
+
+def render_chat_view(chat):
+    if not chat or not chat.get('fragments'):
+        return EMPTY_MESSAGES_HTML
+    with chat_lock(chat):
+        parts = ["<div class='fc-chat'>"]
+        if chat['cursor'] is not None:
+            parts.append("<div class='fc-hint'>⬆️ Older messages available</div>")
+        parts.extend(fragment for _, fragment in chat['fragments'])
+    parts.append("</div>")
+    return "".join(parts)
+
+@cached_view("messages")
+def get_messages_html(session):
+    family = get_current_family_data(session)
+    if not family or not family['messages']:
+        return EMPTY_MESSAGES_HTML
+    return render_chat_view(new_chat_view(session))
+
+def load_older_messages(session, chat):
+    """Prepend the previous page of messages to the chat view"""
+    if not get_current_family_data(session):
+        return EMPTY_MESSAGES_HTML, chat
+    chat = sync_chat_view(session, chat)
+    with chat_lock(chat):
+        if chat['cursor'] is not None:
+            older, chat['cursor'] = get_messages_page(session, before=chat['cursor'])
+            chat['fragments'][:0] = [(msg['id'], render_message_html(msg)) for msg in older]
+    return render_chat_view(chat), chat
+
+# Events HTML
+EVENTS_PAGE_SIZE = 20
+EVENT_RANGES = ["Upcoming", "This week", "Next 30 days", "Past"]
+
+def event_range_bounds(range_name, today):
+    """(start, end, newest_first) for an Events tab filter"""
+    if range_name == "This week":
+        monday = today - timedelta(days=today.weekday())
+        return monday, monday + timedelta(days=7), False
+    if range_name == "Next 30 days":
+        return today, today + timedelta(days=30), False
+    if range_name == "Past":
+        return None, today, True
+    return today, None, False
+
+EVENT = html_template("""
+    <div class='fc-card fc-accent fc-event{today_class}'>
+        <h3>{title} {today_mark}</h3>
+        <div class='fc-details'>
+            📅 {date}<br>
+            🕐 {time}<br>
+            📍 {location}<br>
+            👤 Created by {creator}
+            {attendees}
+        </div>
+    </div>""")
+ATTENDEES = html_template("<div class='fc-attendees'>👥 Attending: {names}</div>")
+EVENTS_FOOTER = html_template("<div class='fc-footer'>Showing {shown} of {total} events</div>")
+
+def render_event_html(event_date, event, today):
+    is_today = event_date == today
+    attendees = event.get('attendees')
+    return EVENT(today_class=" fc-today" if is_today else "", title=event['title'],
+                 today_mark='🔴' if is_today else '', date=event_date.strftime('%B %d, %Y'),
+                 time=event['time'], location=event['location'], creator=event['creator'],
+                 attendees=ATTENDEES(names=', '.join(attendees)) if attendees else "")
+
+def render_events_window(session, range_name="Upcoming", limit=EVENTS_PAGE_SIZE):
+    """First `limit` events of a date range, straight from the date index"""
+    family = get_current_family_data(session)
+    if not family or not family['events']:
+        return EMPTY_STATE(icon="📅", text="No events scheduled")
+
+    today = date.today()
+    start, end, newest_first = event_range_bounds(range_name, today)
+    events, total = db.index(session['family']).query_events(start, end, limit=limit, newest_first=newest_first)
+    if not events:
+        return EMPTY_STATE(icon="📅", text=f"No events ({range_name.lower()})")
+
+    parts = ["<div class='fc-view'>"]
+    parts.extend(render_event_html(event_date, event, today) for event_date, event in events)
+    if total > len(events):
+        parts.append(EVENTS_FOOTER(shown=len(events), total=total))
+    parts.append("</div>")
+    return "".join(parts)
+
+@cached_view("events")
+def get_events_html(session):
+    return render_events_window(session)
+
+def show_events(range_name, session):
+    """Switch the Events tab to another date range (resets the window)"""
+    return render_events_window(session, range_name), EVENTS_PAGE_SIZE
+
+def show_more_events(range_name, limit, session):
+    """Lazy-load the next page of the current range"""
+    limit = (limit or EVENTS_PAGE_SIZE) + EVENTS_PAGE_SIZE
+    return render_events_window(session, range_name, limit), limit
+
+TASK = html_template("""
+    <div class='fc-task{done_class}'>
+        <div class='fc-body'>
+            <div class='fc-task-title'>{icon} {task} <span class='fc-task-id'>#{id}</span></div>
+            <div class='fc-meta'>
+                👤 Assigned to: <strong>{assigned_to}</strong> |
+                📅 Due: {due} |
+                ✍️ By: {created_by}
             </div>
-        </div>"""
-    html += "</div>"
-    return html
+        </div>
+        <span class='fc-status'>{status}</span>
+    </div>""")
 
-def get_tasks_html():
-    family = get_current_family_data()
+def render_task_html(task):
+    done = task['status'] == 'completed'
+    return TASK(done_class=" fc-done" if done else "", icon="✅" if done else "⏳", task=task['task'], id=task['id'],
+                assigned_to=task['assigned_to'], due=task['due'],
+                created_by=task.get('created_by', 'Unknown'), status=task['status'].upper())
+
+def render_tasks_html(tasks):
+    parts = ["<div class='fc-view'>"]
+    parts.extend(render_task_html(task) for task in tasks)
+    parts.append("</div>")
+    return "".join(parts)
+
+@cached_view("tasks")
+def get_tasks_html(session):
+    family = get_current_family_data(session)
     if not family or not family['tasks']:
-        return """<div style='text-align: center; padding: 60px; background: white; border-radius: 20px;'>
-            <div style='font-size: 64px; margin-bottom: 20px;'>✅</div>
-            <h3 style='color: #666; font-size: 20px;'>No tasks assigned</h3></div>"""
-
-    html = "<div style='padding: 10px;'>"
-    for task in family['tasks']:
-        status_color = "#10b981" if task['status'] == 'completed' else "#f59e0b"
-        status_icon = "✅" if task['status'] == 'completed' else "⏳"
-        opacity = "0.6" if task['status'] == 'completed' else "1"
-
-        html += f"""
-        <div style='background: white; border-radius: 15px; padding: 20px; margin-bottom: 15px;
-                    box-shadow: 0 2px 8px rgba(0,0,0,0.08); opacity: {opacity};
-                    border-left: 4px solid {status_color};'>
-            <div style='display: flex; justify-content: space-between; align-items: center;'>
-                <div style='flex: 1;'>
-                    <div style='font-size: 16px; font-weight: 600; color: #111; margin-bottom: 8px;'>
-                        {status_icon} {task['task']}</div>
-                    <div style='font-size: 13px; color: #666;'>
-                        👤 Assigned to: <strong>{task['assigned_to']}</strong> |
-                        📅 Due: {task['due']} |
-                        ✍️ By: {task.get('created_by', 'Unknown')}
-                    </div>
-                </div>
-                <span style='background: {status_color}; color: white; padding: 6px 14px;
-                            border-radius: 12px; font-size: 12px; font-weight: 600;'>
-                    {task['status'].upper()}</span>
-            </div>
-        </div>"""
-    html += "</div>"
-    return html
+        return EMPTY_STATE(icon="✅", text="No tasks assigned")
+    return render_tasks_html(family['tasks'])
+
+TASK_VIEWS = ["All", "My pending", "Overdue", "Due this week"]
+
+def render_tasks_view(session, view_name="All"):
+    """Tasks tab filtered to one of TASK_VIEWS; the filters read the task indexes
+    directly, so they cost O(log n + matches)"""
+    family = get_current_family_data(session)
+    if view_name not in TASK_VIEWS[1:] or not family or not family['tasks']:
+        return get_tasks_html(session)
+
+    index = db.index(session['family'])
+    today = date.today()
+    if view_name == "My pending":
+        tasks = index.assigned_tasks(family['users'][session['user']]['name'])
+    elif view_name == "Overdue":
+        tasks = index.pending_tasks_due(end=today)
+    else:
+        tasks = index.pending_tasks_due(today, today - timedelta(days=today.weekday()) + timedelta(days=7))
+    if not tasks:
+        return EMPTY_STATE(icon="✅", text=f"No tasks ({view_name.lower()})")
+    return render_tasks_html(tasks)
+
+def get_task_board_html(session, tabs):
+    """Tasks tab in the view this session last picked"""
+    return render_tasks_view(session, tabs.get('task_view', TASK_VIEWS[0]) if tabs else TASK_VIEWS[0])
+
+def show_tasks(view_name, session, tabs):
+    """Switch the Tasks tab filter (remembered for live updates)"""
+    if tabs is not None:
+        tabs['task_view'] = view_name
+    return render_tasks_view(session, view_name)
+
+MEMBER = html_template("""
+    <div class='fc-member{current_class}' style='--fc-color: {color};'>
+        <div class='fc-avatar'>{avatar}</div>
+        <div class='fc-body'>
+            <div class='fc-member-name'>{name} {you}</div>
+            <div class='fc-member-role'><span class='fc-badge'>{role}</span></div>
+            <div class='fc-member-status'>{status}</div>
+        </div>
+        <div class='fc-online'></div>
+    </div>""")
 
-def get_family_members_html():
-    family = get_current_family_data()
+@cached_view("family_members", per_user=True)
+def get_family_members_html(session):
+    family = get_current_family_data(session)
     if not family:
         return ""
 
-    html = "<div style='background: white; border-radius: 20px; padding: 25px; box-shadow: 0 4px 12px rgba(0,0,0,0.08);'>"
-    html += "<h3 style='margin: 0 0 20px 0; color: #111; font-size: 20px; font-weight: bold;'>👥 Family Members</h3>"
-
+    parts = ["<div class='fc-panel'><h3>👥 Family Members</h3>"]
     for username, user in family['users'].items():
-        is_current = username == db.current_user
-        border = "border: 3px solid #3b82f6; background: #eff6ff;" if is_current else "background: #f9fafb;"
+        is_current = username == session['user']
         role = user.get('role', 'Other')
-        color = get_role_color(role)
-
-        avatar_content = get_user_avatar_html(username)
-
-        html += f"""
-        <div style='display: flex; align-items: center; gap: 15px; padding: 15px;
-                    border-radius: 15px; margin-bottom: 12px; {border}
-                    box-shadow: 0 2px 4px rgba(0,0,0,0.05);'>
-            <div style='background: {color}; width: 50px; height: 50px; border-radius: 50%;
-                       display: flex; align-items: center; justify-content: center;
-                       font-size: 28px; box-shadow: 0 2px 6px rgba(0,0,0,0.1); overflow: hidden;'>{avatar_content}</div>
-            <div style='flex: 1; min-width: 0;'>
-                <div style='font-weight: bold; color: #111; font-size: 16px; margin-bottom: 4px;'>
-                    {user['name']} {'(You)' if is_current else ''}</div>
-                <div style='font-size: 13px; margin-bottom: 4px;'>
-                    <span style='background: {color}; color: white; padding: 3px 10px;
-                                border-radius: 10px; font-weight: 600;'>{role}</span>
-                </div>
-                <div style='font-size: 12px; color: #666;'>{user['status']}</div>
-            </div>
-            <div style='width: 12px; height: 12px; background: #10b981; border-radius: 50%;
-                       box-shadow: 0 0 0 3px rgba(16, 185, 129, 0.2);'></div>
-        </div>"""
-    html += "</div>"
-    return html
+        parts.append(MEMBER(current_class=" fc-current" if is_current else "", color=get_role_color(role),
+                            avatar=get_user_avatar_html(family, username), name=user['name'],
+                            you='(You)' if is_current else '', role=role, status=user['status']))
+    parts.append("</div>")
+    return "".join(parts)
 
 # Photo Gallery HTML
-def get_photos_html():
-    family = get_current_family_data()
+PHOTO = html_template("""
+    <div class='fc-photo'>
+        {image}
+        <div class='fc-caption'>
+            <strong>{caption}</strong>
+            <div class='fc-meta'>By {author} • {time}</div>
+        </div>
+    </div>""")
+PHOTO_IMAGE = html_template("""
+    <a href="{full}" target="_blank"><img src="{grid}" srcset="{srcset}"
+        sizes="(max-width: 640px) 100vw, 400px" loading="lazy"></a>""")
+PHOTO_LEGACY_IMAGE = html_template('<img src="{src}" loading="lazy">')
+
+@cached_view("photos")
+def get_photos_html(session):
+    family = get_current_family_data(session)
     if not family or not family.get('photos'):
-        return """<div style='text-align: center; padding: 60px; background: white; border-radius: 20px;'>
-            <div style='font-size: 64px; margin-bottom: 20px;'>📸</div>
-            <h3 style='color: #666; font-size: 20px;'>No photos yet</h3></div>"""
+        return EMPTY_STATE(icon="📸", text="No photos yet")
 
-    html = "<div style='display: grid; grid-template-columns: repeat(auto-fill, minmax(250px, 1fr)); gap: 20px; padding: 10px;'>"
+    parts = ["<div class='fc-gallery'>"]
     for photo in reversed(family['photos']):
-        html += f"""
-        <div style='background: white; border-radius: 15px; overflow: hidden; box-shadow: 0 4px 12px rgba(0,0,0,0.08);'>
-            <img src="{photo['image']}" style='width: 100%; height: 250px; object-fit: cover;'>
-            <div style='padding: 15px;'>
-                <div style='font-weight: bold; color: #111; margin-bottom: 5px;'>{photo['caption']}</div>
-                <div style='font-size: 13px; color: #666;'>By {photo['author']} • {format_timestamp(photo['timestamp'])}</div>
-            </div>
-        </div>"""
-    html += "</div>"
-    return html
+        variants = photo.get('variants')
+        if variants:
+            img_html = PHOTO_IMAGE(full=image_src(variants['full']['key']), grid=image_src(variants['grid']['key']),
+                                   srcset=srcset_html(variants, PHOTO_VARIANTS))
+        else:
+            img_html = PHOTO_LEGACY_IMAGE(src=image_src(photo.get('blob') or photo['image']))
+        parts.append(PHOTO(image=img_html, caption=photo['caption'], author=photo['author'],
+                           time=format_timestamp(photo['timestamp'])))
+    parts.append("</div>")
+    return "".join(parts)
 
 # Polls HTML
-def get_polls_html():
-    family = get_current_family_data()
+def normalize_poll(poll):
+    """Upgrade a legacy {option: [voter names]} poll to the counter layout in place"""
+    if 'counts' not in poll:
+        votes = poll.pop('votes', {})
+        poll['options'] = list(votes)
+        poll['counts'] = {option: len(voters) for option, voters in votes.items()}
+        poll['voters'] = {voter: option for option, voters in votes.items() for voter in voters}
+        poll['total'] = sum(poll['counts'].values())
+        poll['rev'] = 0
+    return poll
+
+POLL = html_template("""
+    <div class='fc-card fc-poll'>
+        <h3>{question}</h3>
+        <div class='fc-meta'>By {creator} • {time} • {total} votes</div>
+        {options}
+    </div>""")
+POLL_OPTION = html_template("""
+    <div class='fc-option'>
+        <div class='fc-option-head'><span>{option}</span><span>{count} votes ({percentage:.0f}%)</span></div>
+        <div class='fc-bar'><div style='width: {percentage}%;'></div></div>
+    </div>""")
+
+def render_poll_html(poll):
+    """HTML fragment for one poll, from its running tallies"""
+    poll = normalize_poll(poll)
+    total_votes = poll['total']
+    counts = poll['counts']
+    options = "".join([
+        POLL_OPTION(option=option, count=counts[option],
+                    percentage=(counts[option] / total_votes * 100) if total_votes > 0 else 0)
+        for option in poll['options']])
+    return POLL(question=poll['question'], creator=poll['creator'], time=format_timestamp(poll['timestamp']),
+                total=total_votes, options=options)
+
+@cached_view("polls")
+def get_polls_html(session):
+    family = get_current_family_data(session)
     if not family or not family.get('polls'):
-        return """<div style='text-align: center; padding: 60px; background: white; border-radius: 20px;'>
-            <div style='font-size: 64px; margin-bottom: 20px;'>📊</div>
-            <h3 style='color: #666; font-size: 20px;'>No polls yet</h3></div>"""
-
-    html = "<div style='padding: 10px;'>"
-    for poll in reversed(family['polls']):
-        total_votes = sum(len(votes) for votes in poll['votes'].values())
-        html += f"""
-        <div style='background: white; border-radius: 20px; padding: 25px; margin-bottom: 20px;
-                    box-shadow: 0 4px 12px rgba(0,0,0,0.08);'>
-            <h3 style='color: #111; margin-bottom: 15px;'>{poll['question']}</h3>
-            <div style='font-size: 13px; color: #666; margin-bottom: 15px;'>
-                By {poll['creator']} • {format_timestamp(poll['timestamp'])} • {total_votes} votes
-            </div>
-        """
-        for option, voters in poll['votes'].items():
-            vote_count = len(voters)
-            percentage = (vote_count / total_votes * 100) if total_votes > 0 else 0
-            html += f"""
-            <div style='margin-bottom: 12px;'>
-                <div style='display: flex; justify-content: space-between; margin-bottom: 5px;'>
-                    <span style='font-weight: 500;'>{option}</span>
-                    <span style='color: #666;'>{vote_count} votes ({percentage:.0f}%)</span>
-                </div>
-                <div style='background: #e5e7eb; border-radius: 10px; height: 8px; overflow: hidden;'>
-                    <div style='background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                               height: 100%; width: {percentage}%; transition: width 0.3s;'></div>
-                </div>
-            </div>"""
-        html += "</div>"
-    html += "</div>"
-    return html
+        return EMPTY_STATE(icon="📊", text="No polls yet")
+
+    # Each poll is cached on its own revision, so a vote re-renders only that poll
+    code = session['family']
+    parts = ["<div class='fc-view'>"]
+    parts.extend(cached_fragment(code, ("poll", poll['id']), poll.get('rev', 0), render_poll_html, poll)
+                 for poll in reversed(family['polls']))
+    parts.append("</div>")
+    return "".join(parts)
 
 # Stories HTML
-def get_stories_html():
-    family = get_current_family_data()
+STORY = html_template("""
+    <div class='fc-story' style='--fc-color: {color};'>
+        <div class='fc-story-ring'><div>{content}</div></div>
+        <div class='fc-story-author'>{author}</div>
+        <div class='fc-story-time'>{time}</div>
+    </div>""")
+STORY_IMAGE = html_template('<img src="{src}" loading="lazy" class="fc-cover">')
+
+@cached_view("stories")
+def posted_at(item):
+    """Epoch seconds of an item's timestamp, whatever form it was stored in (0 if unreadable)"""
+    try:
+        value = to_epoch(item.get('timestamp'))
+    except (TypeError, ValueError, OverflowError):
+        return 0
+    return value if isinstance(value, (int, float)) else 0
+
+def get_stories_html(session):
+    family = get_current_family_data(session)
     if not family or not family.get('stories'):
-        return """<div style='text-align: center; padding: 60px; background: white; border-radius: 20px;'>
-            <div style='font-size: 64px; margin-bottom: 20px;'>⭐</div>
-            <h3 style='color: #666; font-size: 20px;'>No stories yet</h3></div>"""
-
-    html = "<div style='display: flex; gap: 15px; overflow-x: auto; padding: 10px;'>"
-    for story in family['stories']:
-        # Check if story is still active (24 hours)
-        story_time = datetime.fromisoformat(story['timestamp'])
-        if (datetime.now() - story_time).total_seconds() > 86400:
-            continue
+        return EMPTY_STATE(icon="⭐", text="No stories yet")
 
-        role = story.get('role', 'Other')
-        color = get_role_color(role)
-
-        html += f"""
-        <div style='min-width: 120px; max-width: 120px;'>
-            <div style='width: 120px; height: 120px; border-radius: 50%; background: {color};
-                       padding: 4px; box-shadow: 0 4px 12px rgba(0,0,0,0.15);'>
-                <div style='width: 100%; height: 100%; border-radius: 50%; background: white;
-                           display: flex; align-items: center; justify-content: center;
-                           font-size: 48px; overflow: hidden;'>
-                    {story.get('content', '📷')}
-                </div>
-            </div>
-            <div style='text-align: center; margin-top: 8px; font-size: 13px; color: #111; font-weight: 500;'>
-                {story['author']}
-            </div>
-            <div style='text-align: center; font-size: 11px; color: #666;'>
-                {format_timestamp(story['timestamp'])}
-            </div>
-        </div>"""
-    html += "</div>"
-    return html
+    # Stories are in posting order: skip straight to the first one still live
+    stories = family['stories']
+    cutoff = time.time() - TTL_POLICIES['stories']
+    start = bisect.bisect_right(stories, cutoff, key=posted_at)
+
+    parts = ["<div class='fc-stories'>"]
+    for story in stories[start:]:
+        if story.get('variants'):
+            content = STORY_IMAGE(src=image_src(story['variants']['story']['key']))
+        else:
+            content = story.get('content', '📷')
+        parts.append(STORY(color=get_role_color(story.get('role', 'Other')), content=content,
+                           author=story['author'], time=format_timestamp(story['timestamp'])))
+    parts.append("</div>")
+    return "".join(parts)
+
+# Search
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_RESULTS = 100
+
+SEARCH_RESULT = html_template("""
+    <div class='fc-result'>
+        <div class='fc-result-label'>{label}</div>
+        <div class='fc-result-text'>{text}</div>
+        <div class='fc-meta'>{meta}</div>
+    </div>""")
+
+def render_search_result_html(collection, record):
+    if collection == 'messages':
+        label, text = "💬 Chat", record['content']
+        meta = f"{record['author']} • {format_timestamp(record['timestamp'])}"
+    elif collection == 'announcements':
+        label, text = "📢 Announcement", record['content']
+        meta = f"{record['author']} • {format_timestamp(record['timestamp'])}"
+    elif collection == 'tasks':
+        label, text = "✅ Task", record['task']
+        meta = f"Assigned to {record['assigned_to']} • Due {record['due']} • {record['status']}"
+    else:
+        label, text = "📅 Event", record['title']
+        meta = f"{record['date']} {record['time']} • {record.get('location', '')}"
+    return SEARCH_RESULT(label=label, text=text, meta=meta)
+
+def search_family(query, session):
+    """Generator: rank matches once, then stream them to the Search tab a page at a time"""
+    family = get_current_family_data(session)
+    if not family or not query or not query.strip():
+        yield "<div class='fc-note'>Type a word (or the start of one) to search.</div>"
+        return
+
+    started = time.perf_counter()
+    docs, total, exact = db.search_index(session['family']).search(query, SEARCH_MAX_RESULTS)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if not docs:
+        yield f"<div class='fc-note'>No results for <strong>{html.escape(query)}</strong></div>"
+        return
+
+    header = (f"<div class='fc-meta'>"
+              f"{total}{'' if exact else '+'} results ({elapsed_ms:.1f} ms)"
+              f"{' • showing the top ' + str(len(docs)) if total > len(docs) or not exact else ''}</div>")
+    parts = ["<div class='fc-view'>", header]
+    for start in range(0, len(docs), SEARCH_PAGE_SIZE):
+        for collection, record_id in docs[start:start + SEARCH_PAGE_SIZE]:
+            record = find_by_id(family[collection], record_id)
+            if record:
+                parts.append(render_search_result_html(collection, record))
+        yield "".join(parts) + "</div>"
+
+# Lazy tabs
+# Only the dashboard is rendered at login. Other tabs render on first selection
+# and are then kept current by live_updates; the chat is windowed and cheap, so
+# it is built on selection and never prefetched.
+TAB_VIEWS = {  # tab id: builder for the tab's main display
+    "announcements": get_announcements_html, "events": get_events_html, "tasks": get_tasks_html,
+    "photos": get_photos_html, "polls": get_polls_html, "stories": get_stories_html,
+}
+TAB_PREFETCH_ORDER = ["announcements", "events", "tasks", "photos", "polls", "stories"]
+TAB_PREFETCH_WORKERS = 2
+
+class TabPredictor:
+    """Counts which tab users open after each tab, across all sessions"""
+
+    def __init__(self):
+        self._next = {}  # tab: Counter of tabs opened next
+        self._lock = threading.Lock()
+
+    def record(self, previous, tab):
+        if previous != tab:
+            with self._lock:
+                self._next.setdefault(previous, Counter())[tab] += 1
+
+    def ranked(self, tab):
+        """Likely next tabs, most likely first, falling back to TAB_PREFETCH_ORDER"""
+        with self._lock:
+            learned = [name for name, _ in self._next.get(tab, Counter()).most_common()]
+        return learned + TAB_PREFETCH_ORDER
+
+tab_predictor = TabPredictor()
+prefetch_pool = ThreadPoolExecutor(max_workers=TAB_PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+def new_tab_state():
+    """Per-login record of which views this session has rendered"""
+    return {"selected": "dashboard", "loaded": {"dashboard", "family_members"}, "task_view": TASK_VIEWS[0]}
+
+def prefetch_next_tab(tab, session, tabs):
+    """Warm the render cache for the most likely next tab this session hasn't loaded"""
+    for candidate in tab_predictor.ranked(tab):
+        if candidate in TAB_VIEWS and candidate not in tabs['loaded']:
+            prefetch_pool.submit(TAB_VIEWS[candidate], session)
+            return
+
+def select_tab(tab, session, tabs):
+    """Record a tab selection; returns True the first time the tab is opened"""
+    if not session or tabs is None:
+        return False
+    tab_predictor.record(tabs['selected'], tab)
+    tabs['selected'] = tab
+    first = tab not in tabs['loaded']
+    tabs['loaded'].add(tab)
+    prefetch_next_tab(tab, session, tabs)
+    return first
+
+def note_tab(tab, session, tabs):
+    """Tab.select for tabs with nothing to render"""
+    select_tab(tab, session, tabs)
+
+def open_tab(tab, session, tabs):
+    """Tab.select: render the tab on first selection, otherwise leave it as is"""
+    if select_tab(tab, session, tabs):
+        return TAB_VIEWS[tab](session)
+    return gr.update()
+
+def open_chat(session, chat, tabs):
+    if select_tab("messages", session, tabs):
+        chat = sync_chat_view(session, chat)
+        return render_chat_view(chat), chat
+    return gr.update(), chat
+
+def open_family_panel(session, tabs):
+    """Sidebar, rendered right after login so it doesn't delay the dashboard"""
+    if not session or tabs is None:
+        return ""
+    prefetch_next_tab("dashboard", session, tabs)
+    return get_family_members_html(session)
+
+def main_app_outputs(session):
+    """Main view outputs for a fresh login: tab selection, dashboard, blanked lazy
+    views (announcements, chat, events, tasks, sidebar, photos, polls, stories),
+    then the session, chat and tab states"""
+    if session is None:
+        return (gr.update(), "", "", "", "", "", "", "", "", "", None, None, None)
+    return (gr.Tabs(selected="dashboard"), get_dashboard_html(session), "", "", "", "", "", "", "", "",
+            session, {}, new_tab_state())
 
 # Authentication
+def open_family_login(request: gr.Request):
+    """Page load: ?family=CODE (where the cluster router sends a family) opens
+    the family login with the code filled in"""
+    code = request.query_params.get("family") if request else None
+    if not code:
+        return gr.update(), gr.update(), gr.update()
+    return gr.update(visible=False), gr.update(visible=True), code
+
 def login(family_code, username, password):
-    if family_code not in db.families:
+    family = db.get_family(family_code)
+    if not family:
         return (gr.update(visible=True), gr.update(visible=False),
-                "❌ Invalid family code!", "", "", "", "", "", "", "", "", "")
+                "❌ Invalid family code!", *main_app_outputs(None))
 
-    family = db.families[family_code]
-    if username in family['users'] and family['users'][username]['password'] == password:
-        db.current_user = username
-        db.current_family = family_code
-        return (
-            gr.update(visible=False), gr.update(visible=True),
-            f"✅ Welcome back, {family['users'][username]['name']}!",
-            get_dashboard_html(), get_announcements_html(), get_messages_html(),
-            get_events_html(), get_tasks_html(), get_family_members_html(),
-            get_photos_html(), get_polls_html(), get_stories_html()
-        )
+    if check_user_password(family_code, username, password):
+        session = new_session(family_code, username)
+        return (gr.update(visible=False), gr.update(visible=True),
+                f"✅ Welcome back, {family['users'][username]['name']}!", *main_app_outputs(session))
     return (gr.update(visible=True), gr.update(visible=False),
-            "❌ Invalid credentials!", "", "", "", "", "", "", "", "", "")
+            "❌ Invalid credentials!", *main_app_outputs(None))
 
 def register(family_code, name, username, password, role, avatar, status, birthday, bio, email):
-    if family_code not in db.families:
-        return "❌ Invalid family code!", gr.update(), gr.update(), "", "", "", "", "", "", "", "", ""
+    if not db.has_family(family_code):
+        return "❌ Invalid family code!", gr.update(), gr.update(), *main_app_outputs(None)
 
     if not all([name, username, password, role]):
-        return "❌ Fill all required fields!", gr.update(), gr.update(), "", "", "", "", "", "", "", "", ""
+        return "❌ Fill all required fields!", gr.update(), gr.update(), *main_app_outputs(None)
 
-    family = db.families[family_code]
+    family = db.get_family(family_code)
     if username in family['users']:
-        return "❌ Username exists in this family!", gr.update(), gr.update(), "", "", "", "", "", "", "", "", ""
+        return "❌ Username exists in this family!", gr.update(), gr.update(), *main_app_outputs(None)
 
-    family['users'][username] = {
+    db.put_user(family_code, username, {
         "name": name, "avatar": avatar or "👤", "status": status or "Available",
-        "password": password, "role": role, "birthday": birthday,
+        "password": password_pool().submit(hash_password, password).result(),
+        "role": role, "birthday": birthday,
         "profile_pic": None, "bio": bio or "", "email": email or ""
-    }
-    db.current_user = username
-    db.current_family = family_code
+    })
+    session = new_session(family_code, username)
     return (f"✅ Welcome, {name}!", gr.update(visible=False), gr.update(visible=True),
-            get_dashboard_html(), get_announcements_html(), get_messages_html(),
-            get_events_html(), get_tasks_html(), get_family_members_html(),
-            get_photos_html(), get_polls_html(), get_stories_html())
+            *main_app_outputs(session))
 
 def logout():
-    db.current_user = None
-    db.current_family = None
-    return (gr.update(visible=True), gr.update(visible=False), "", "", "", "", "", "", "", "", "", "")
+    return (gr.update(visible=True), gr.update(visible=False), "", *main_app_outputs(None))
 
 # Profile picture update
-def update_profile_picture(image):
-    if not db.current_user or not db.current_family:
-        return "❌ You must be logged in", get_family_members_html()
+def update_profile_picture(image, session):
+    if not session:
+        return "❌ You must be logged in", get_family_members_html(session)
 
     if image is None:
-        return "❌ Please upload an image", get_family_members_html()
+        return "❌ Please upload an image", get_family_members_html(session)
 
-    family = get_current_family_data()
-    if family:
-        # Convert image to base64
-        import base64
-        from io import BytesIO
-        from PIL import Image
+    if get_current_family_data(session):
+        try:
+            variants = process_image(image, AVATAR_VARIANTS)
+        except ValueError as exc:
+            return f"❌ {exc}", get_family_members_html(session)
+        return save_profile_picture(variants, session)
 
-        # Resize and convert image
-        img = Image.open(image)
-        img = img.resize((200, 200))
-        buffered = BytesIO()
-        img.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode()
+    return "❌ Error updating profile picture", get_family_members_html(session)
 
-        family['users'][db.current_user]['profile_pic'] = f"data:image/png;base64,{img_str}"
+def save_profile_picture(variants, session):
+    family = get_current_family_data(session)
+    if not family:
+        return "❌ Error updating profile picture", get_family_members_html(session)
+
+    user = family['users'][session['user']]
+    user['profile_pic'] = variants['avatar']['key']
+    user['profile_variants'] = variants
+    db.put_user(session['family'], session['user'], user)
 
-        return "✅ Profile picture updated!", get_family_members_html()
+    return "✅ Profile picture updated!", get_family_members_html(session)
 
-    return "❌ Error updating profile picture", get_family_members_html()
+async def update_profile_picture_async(image, session):
+    """update_profile_picture for the event queue (see upload_photo_async)"""
+    if not session or image is None:
+        return await asyncio.to_thread(update_profile_picture, image, session)
+    try:
+        variants = await process_image_async(image, AVATAR_VARIANTS)
+    except ValueError as exc:
+        return f"❌ {exc}", await asyncio.to_thread(get_family_members_html, session)
+    return await asyncio.to_thread(save_profile_picture, variants, session)
 
 # Main functions
-def post_announcement(content, priority):
-    if not db.current_user or not content.strip():
-        return "❌ Cannot post empty announcement!", get_announcements_html()
+def post_announcement(content, priority, session):
+    if not session or not content.strip():
+        return "❌ Cannot post empty announcement!", get_announcements_html(session)
 
-    family = get_current_family_data()
+    family = get_current_family_data(session)
     if not family:
-        return "❌ No family selected!", get_announcements_html()
+        return "❌ No family selected!", get_announcements_html(session)
 
-    user = family['users'][db.current_user]
-    family['announcements'].append({
-        "id": len(family['announcements']) + 1, "author": user['name'],
+    user = family['users'][session['user']]
+    db.add_record(session['family'], 'announcements', {
+        "author": user['name'],
         "role": user.get('role', 'Other'), "content": content,
         "timestamp": datetime.now().isoformat(), "type": "text",
         "reactions": {}, "priority": priority, "comments": []
     })
-    return "✅ Announcement posted!", get_announcements_html()
+    return "✅ Announcement posted!", get_announcements_html(session)
 
-def send_message(content):
-    if not db.current_user or not content.strip():
-        return "❌ Cannot send empty message!", get_messages_html()
+def toggle_reaction(collection, item_id, emoji, session):
+    """Add this user's `emoji` reaction to an item, or take it back if already
+    there. Reactions are {emoji: set of usernames}, like poll voters, so both
+    directions are O(1) and members who share a display name count separately.
 
-    family = get_current_family_data()
+    Returns a status message.
+    """
+    family = get_current_family_data(session)
     if not family:
-        return "❌ No family selected!", get_messages_html()
+        return "❌ No family selected!"
+    if not item_id or emoji not in REACTION_EMOJIS:
+        return "❌ Pick an item number and a reaction!"
+    username = session['user']
+
+    def apply(record):
+        reactions = record.container('reactions')
+        users = reactions.get(emoji)
+        if not isinstance(users, set):
+            users = reactions[emoji] = set(users or ())  # lists as loaded from JSON
+        if username in users:
+            users.discard(username)
+            if not users:
+                del reactions[emoji]
+            result = f"↩️ Removed your {emoji}"
+        else:
+            users.add(username)
+            result = f"✅ Reacted {emoji}"
+        record['rev'] = (record.get('rev') or 0) + 1
+        return result
+
+    record, result = db.modify_record(session['family'], collection, int(item_id), apply)
+    if record is None:
+        return f"❌ No #{int(item_id)} to react to!"
+    return result
+
+def react_to_announcement(announcement_id, emoji, session):
+    return toggle_reaction('announcements', announcement_id, emoji, session), get_announcements_html(session)
+
+def react_to_message(message_id, emoji, session, chat=None):
+    status = toggle_reaction('messages', message_id, emoji, session)
+    chat = sync_chat_view(session, chat)
+    return status, render_chat_view(chat), chat
+
+def comment_on_announcement(announcement_id, content, session):
+    family = get_current_family_data(session)
+    if not family:
+        return "❌ No family selected!", get_announcements_html(session), gr.update()
+    if not announcement_id or not content or not content.strip():
+        return "❌ Pick an announcement and write a comment!", get_announcements_html(session), gr.update()
+    author = family['users'][session['user']]['name']
+
+    def apply(announcement):
+        announcement.container('comments').append(
+            {"author": author, "content": content, "timestamp": datetime.now().isoformat()})
+        announcement['rev'] = (announcement.get('rev') or 0) + 1
+        return True
+
+    announcement, _ = db.modify_record(session['family'], 'announcements', int(announcement_id), apply)
+    if announcement is None:
+        return f"❌ No announcement #{int(announcement_id)}!", get_announcements_html(session), gr.update()
+    return ("✅ Comment posted!", get_announcements_html(session),
+            render_comment_thread(session, announcement['id']))
+
+def send_message(content, session, chat=None):
+    if not session or not content.strip():
+        chat = sync_chat_view(session, chat)
+        return "❌ Cannot send empty message!", render_chat_view(chat), chat
+
+    family = get_current_family_data(session)
+    if not family:
+        return "❌ No family selected!", EMPTY_MESSAGES_HTML, chat
 
-    user = family['users'][db.current_user]
-    family['messages'].append({
+    user = family['users'][session['user']]
+    db.add_record(session['family'], 'messages', {
         "author": user['name'], "role": user.get('role', 'Other'),
         "content": content, "timestamp": datetime.now().isoformat(),
         "reactions": {}
     })
-    return "", get_messages_html()
+    chat = sync_chat_view(session, chat)
+    return "", render_chat_view(chat), chat
 
-def add_event(title, date, time, location):
-    if not db.current_user or not all([title, date, time]):
-        return "❌ Fill all fields!", get_events_html()
+def add_event(title, date, time, location, session):
+    if not session or not all([title, date, time]):
+        return "❌ Fill all fields!", get_events_html(session)
 
-    family = get_current_family_data()
+    family = get_current_family_data(session)
     if not family:
-        return "❌ No family selected!", get_events_html()
+        return "❌ No family selected!", get_events_html(session)
 
     try:
         if '/' in date:
@@ -714,101 +3918,302 @@ def add_event(title, date, time, location):
             event_date = datetime.strptime(date, '%Y-%m-%d')
         iso_date = event_date.isoformat().split('T')[0]
     except ValueError:
-        return "❌ Invalid date format! Use YYYY-MM-DD or DD/Month/YY", get_events_html()
+        return "❌ Invalid date format! Use YYYY-MM-DD or DD/Month/YY", get_events_html(session)
 
-    family['events'].append({
-        "id": len(family['events']) + 1, "title": title, "date": iso_date,
+    db.add_record(session['family'], 'events', {
+        "title": title, "date": iso_date,
         "time": time, "location": location or "TBD",
-        "creator": family['users'][db.current_user]['name'],
+        "creator": family['users'][session['user']]['name'],
         "attendees": []
     })
-    return "✅ Event added!", get_events_html()
+    return "✅ Event added!", get_events_html(session)
 
-def add_task(task, assigned_to, due_date):
-    if not db.current_user or not all([task, assigned_to, due_date]):
-        return "❌ Fill all fields!", get_tasks_html()
+def member_names(family):
+    return [user['name'] for user in family['users'].values()]
 
-    family = get_current_family_data()
-    if not family:
-        return "❌ No family selected!", get_tasks_html()
+def task_assignee_choices(session):
+    """Tasks tab select: fill the assignee dropdowns with the family's members"""
+    family = get_current_family_data(session)
+    choices = member_names(family) if family else []
+    return gr.update(choices=choices), gr.update(choices=choices)
 
-    family['tasks'].append({
-        "id": len(family['tasks']) + 1, "task": task,
-        "assigned_to": assigned_to, "status": "pending", "due": due_date,
-        "created_by": family['users'][db.current_user]['name']
-    })
-    return "✅ Task added!", get_tasks_html()
+def add_task(task, assigned_to, due_date, session, tabs=None):
+    if not session or not all([task, assigned_to, due_date]):
+        return "❌ Fill all fields!", get_task_board_html(session, tabs)
 
-def upload_photo(image, caption):
-    if not db.current_user or not image:
-        return "❌ Please upload an image!", get_photos_html()
+    family = get_current_family_data(session)
+    if not family:
+        return "❌ No family selected!", get_task_board_html(session, tabs)
+    if assigned_to not in member_names(family):
+        return "❌ Assign the task to a family member!", get_task_board_html(session, tabs)
+    due = parse_event_date(due_date)
+    if due is None:
+        return "❌ Invalid date format! Use YYYY-MM-DD", get_task_board_html(session, tabs)
+
+    db.add_record(session['family'], 'tasks', {
+        "task": task,
+        "assigned_to": assigned_to, "status": "pending", "due": due.isoformat(),
+        "created_by": family['users'][session['user']]['name']
+    })
+    return "✅ Task added!", get_task_board_html(session, tabs)
 
-    family = get_current_family_data()
+def update_task(task_id, change, session, tabs):
+    """Apply change(task) to task #task_id; it returns an error message or None"""
+    family = get_current_family_data(session)
+    if not family:
+        return "❌ No family selected!", get_task_board_html(session, tabs)
+    if not task_id:
+        return "❌ Enter a task number!", get_task_board_html(session, tabs)
+    errors = []
+
+    def apply(task):
+        error = change(task)
+        errors.append(error)
+        return error is None
+
+    task, _ = db.modify_record(session['family'], 'tasks', int(task_id), apply)
+    if task is None:
+        return f"❌ No task #{int(task_id)}!", get_task_board_html(session, tabs)
+    if errors[0]:
+        return errors[0], get_task_board_html(session, tabs)
+    return f"✅ Task #{task['id']} updated!", get_task_board_html(session, tabs)
+
+def complete_task(task_id, session, tabs):
+    def change(task):
+        if task['status'] == 'completed':
+            return "ℹ️ Task already completed"
+        task['status'] = 'completed'
+    return update_task(task_id, change, session, tabs)
+
+def reassign_task(task_id, assigned_to, session, tabs):
+    family = get_current_family_data(session)
+    if family and assigned_to not in member_names(family):
+        return "❌ Pick a family member to reassign to!", get_task_board_html(session, tabs)
+
+    def change(task):
+        if task['assigned_to'] == assigned_to:
+            return f"ℹ️ Already assigned to {assigned_to}"
+        task['assigned_to'] = assigned_to
+    return update_task(task_id, change, session, tabs)
+
+def upload_photo(image, caption, session):
+    if not session or not image:
+        return "❌ Please upload an image!", get_photos_html(session)
+
+    family = get_current_family_data(session)
     if not family:
-        return "❌ No family selected!", get_photos_html()
+        return "❌ No family selected!", get_photos_html(session)
 
-    import base64
-    from PIL import Image
+    try:
+        variants = process_image(image, PHOTO_VARIANTS)
+    except ValueError as exc:
+        return f"❌ {exc}", get_photos_html(session)
+    return save_photo(variants, caption, session)
 
-    img = Image.open(image)
-    img.thumbnail((800, 800))
-    buffered = BytesIO()
-    img.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
+def save_photo(variants, caption, session):
+    family = get_current_family_data(session)
+    if not family:
+        return "❌ No family selected!", get_photos_html(session)
 
-    family['photos'].append({
-        "id": len(family['photos']) + 1,
-        "image": f"data:image/png;base64,{img_str}",
+    db.add_record(session['family'], 'photos', {
+        "blob": variants['full']['key'],
+        "variants": variants,
         "caption": caption or "Family photo",
-        "author": family['users'][db.current_user]['name'],
+        "author": family['users'][session['user']]['name'],
         "timestamp": datetime.now().isoformat()
     })
 
-    return "✅ Photo uploaded!", get_photos_html()
+    return "✅ Photo uploaded!", get_photos_html(session)
 
-def create_poll(question, options):
-    if not db.current_user or not question.strip():
-        return "❌ Enter a question!", get_polls_html()
+async def upload_photo_async(image, caption, session):
+    """upload_photo for the event queue: no handler thread is held while the
+    image pool decodes, and the write and re-render run on a worker thread"""
+    if not session or not image:
+        return await asyncio.to_thread(upload_photo, image, caption, session)
+    try:
+        variants = await process_image_async(image, PHOTO_VARIANTS)
+    except ValueError as exc:
+        return f"❌ {exc}", await asyncio.to_thread(get_photos_html, session)
+    return await asyncio.to_thread(save_photo, variants, caption, session)
+
+def create_poll(question, options, session):
+    if not session or not question.strip():
+        return "❌ Enter a question!", get_polls_html(session)
 
-    family = get_current_family_data()
+    family = get_current_family_data(session)
     if not family:
-        return "❌ No family selected!", get_polls_html()
+        return "❌ No family selected!", get_polls_html(session)
 
     option_list = [opt.strip() for opt in options.split('\n') if opt.strip()]
     if len(option_list) < 2:
-        return "❌ Need at least 2 options!", get_polls_html()
+        return "❌ Need at least 2 options!", get_polls_html(session)
 
-    family['polls'].append({
-        "id": len(family['polls']) + 1,
+    option_list = list(dict.fromkeys(option_list))
+    db.add_record(session['family'], 'polls', {
         "question": question,
-        "votes": {opt: [] for opt in option_list},
-        "creator": family['users'][db.current_user]['name'],
+        "options": option_list,
+        "counts": {opt: 0 for opt in option_list},
+        "voters": {},  # username: chosen option
+        "total": 0,
+        "rev": 0,
+        "creator": family['users'][session['user']]['name'],
         "timestamp": datetime.now().isoformat()
     })
 
-    return "✅ Poll created!", get_polls_html()
+    return "✅ Poll created!", get_polls_html(session)
+
+def poll_choices(session):
+    """Dropdown choices for the vote form: newest polls first"""
+    family = get_current_family_data(session)
+    if not family:
+        return gr.update(choices=[], value=None)
+    return gr.update(choices=[(poll['question'], poll['id']) for poll in reversed(family['polls'])])
+
+def poll_option_choices(poll_id, session):
+    family = get_current_family_data(session)
+    poll = find_by_id(family['polls'], int(poll_id)) if family and poll_id else None
+    if not poll:
+        return gr.update(choices=[], value=None)
+    return gr.update(choices=normalize_poll(poll)['options'], value=None)
+
+def vote_poll(poll_id, option, session):
+    """Record (or change) this user's vote: O(1) counter updates on a single poll"""
+    if not session or not poll_id or not option:
+        return "❌ Pick a poll and an option!", get_polls_html(session)
+
+    username = session['user']
+
+    def apply(poll):
+        normalize_poll(poll)
+        if option not in poll['counts']:
+            return None
+        previous = poll['voters'].get(username)
+        if previous == option:
+            return None
+        if previous is None:
+            poll['total'] += 1
+        else:
+            poll['counts'][previous] -= 1
+        poll['counts'][option] += 1
+        poll['voters'][username] = option
+        poll['rev'] += 1
+        return "✅ Vote changed!" if previous else "✅ Vote recorded!"
+
+    poll, result = db.modify_record(session['family'], 'polls', int(poll_id), apply)
+    if poll is None:
+        return "❌ Poll not found!", get_polls_html(session)
+    return result or "ℹ️ Your vote is unchanged", get_polls_html(session)
 
-def post_story(content):
-    if not db.current_user or not content.strip():
-        return "❌ Story cannot be empty!", get_stories_html()
+STORY_VARIANTS = {"story": (240, True)}
 
-    family = get_current_family_data()
+def post_story(content, image, session):
+    if not session or not (content.strip() or image):
+        return "❌ Story cannot be empty!", get_stories_html(session)
+
+    if not get_current_family_data(session):
+        return "❌ No family selected!", get_stories_html(session)
+
+    try:
+        variants = process_image(image, STORY_VARIANTS) if image else None
+    except ValueError as exc:
+        return f"❌ {exc}", get_stories_html(session)
+    return save_story(content, variants, session)
+
+def save_story(content, variants, session):
+    family = get_current_family_data(session)
     if not family:
-        return "❌ No family selected!", get_stories_html()
+        return "❌ No family selected!", get_stories_html(session)
 
-    user = family['users'][db.current_user]
-    family['stories'].append({
-        "id": len(family['stories']) + 1,
+    user = family['users'][session['user']]
+    story = {
         "author": user['name'],
         "role": user.get('role', 'Other'),
-        "content": content,
+        "content": content or "📷",
         "timestamp": datetime.now().isoformat()
-    })
+    }
+    if variants:
+        story["variants"] = variants
+    db.add_record(session['family'], 'stories', story)
+
+    return "✅ Story posted!", get_stories_html(session)
+
+async def post_story_async(content, image, session):
+    """post_story for the event queue (see upload_photo_async)"""
+    if not session or not image:
+        return await asyncio.to_thread(post_story, content, image, session)
+    try:
+        variants = await process_image_async(image, STORY_VARIANTS)
+    except ValueError as exc:
+        return f"❌ {exc}", await asyncio.to_thread(get_stories_html, session)
+    return await asyncio.to_thread(save_story, content, variants, session)
+
+# Live updates: views pushed to subscribed sessions, in live_updates output order
+LIVE_VIEW_BUILDERS = {
+    "dashboard": get_dashboard_html, "announcements": get_announcements_html,
+    "events": get_events_html, "tasks": get_task_board_html,
+    "family_members": get_family_members_html, "photos": get_photos_html,
+    "polls": get_polls_html, "stories": get_stories_html,
+}
+LIVE_VIEWS_WITH_STATE = {"tasks"}  # builders that also take the tabs state (the picked filter)
+
+async def live_updates(session, chat, tabs):
+    """Generator event: push changes made by other family members to this session.
+
+    Only views this session has loaded and whose collections changed are
+    re-rendered (and those renders are shared through the render cache);
+    chat is extended with just the new message fragments. Everything else
+    is sent as a no-op update.
+    """
+    if not session or tabs is None:
+        return
+    sub = event_bus.subscribe(session['family'])
+    try:
+        while True:
+            changed = await sub.wait(LIVE_HEARTBEAT)
+            if not db.has_family(session['family']):
+                return
+            if 'messages' in changed and 'messages' in tabs['loaded']:
+                chat = await asyncio.to_thread(sync_chat_view, session, chat)
+                chat_update = render_chat_view(chat)
+            else:
+                chat_update = gr.update()
+            view_updates = []
+            for view, build in LIVE_VIEW_BUILDERS.items():
+                if view in tabs['loaded'] and changed.intersection(VIEW_DEPENDENCIES[view]):
+                    args = (session, tabs) if view in LIVE_VIEWS_WITH_STATE else (session,)
+                    view_updates.append(await asyncio.to_thread(build, *args))
+                else:
+                    view_updates.append(gr.update())
+            yield (chat_update, chat, *view_updates)
+    finally:
+        event_bus.unsubscribe(sub)
+
+# Event concurrency
+# Events queue in lanes (Gradio concurrency ids), each with its own slots, so
+# slow work waits in its own line: a burst of uploads or logins can't take the
+# slots chat sends and tab switches need. Upload handlers are async and hold
+# no thread while the image pool works; auth is sized to the KDF pool, with
+# room for logins the login cache answers without it.
+EVENT_LANES = {
+    "chat": int(os.environ.get("FAMILYCONNECT_CHAT_CONCURRENCY", "16")),
+    "views": int(os.environ.get("FAMILYCONNECT_VIEW_CONCURRENCY", "8")),
+    "uploads": int(os.environ.get("FAMILYCONNECT_UPLOAD_CONCURRENCY", IMAGE_WORKERS * 2)),
+    "auth": PASSWORD_WORKERS * 2,
+}
+
+def lane(name):
+    """Event listener arguments that queue the event in lane `name`"""
+    return {"concurrency_id": name, "concurrency_limit": EVENT_LANES[name]}
 
-    return "✅ Story posted!", get_stories_html()
+def private_api():
+    """Event listener arguments that keep an event off the client API (the
+    keyword changed in Gradio 6)"""
+    if "api_visibility" in inspect.signature(gr.Button.click).parameters:
+        return {"api_visibility": "private"}
+    return {"api_name": False, "show_api": False}
 
 # Build Gradio Interface
-with gr.Blocks(css="""
+APP_CSS = VIEW_CSS + """
     .gradio-container { max-width: 1600px !important; }
     .main-header {
         background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
@@ -820,7 +4225,17 @@ with gr.Blocks(css="""
         border: none !important; font-weight: 600 !important;
     }
     @keyframes fadeIn { from { opacity: 0; transform: translateY(10px); } to { opacity: 1; transform: translateY(0); } }
-""", theme=gr.themes.Soft()) as app:
+"""
+APP_THEME = gr.themes.Soft()
+
+with gr.Blocks(css=APP_CSS, theme=APP_THEME) as app:
+
+    # Logged-in family/user for this browser session (None when logged out)
+    session_state = gr.State(None)
+    # Rendered chat window for this session, appended to as messages arrive
+    chat_state = gr.State(None)
+    # Tabs this session has rendered (see new_tab_state); shared with live_updates
+    tabs_state = gr.State(None)
 
     gr.HTML("""<div class="main-header">
         <h1 style='font-size: 48px; margin-bottom: 10px; font-weight: bold;'>👨‍👩‍👧‍👦 FamilyConnect Pro</h1>
@@ -842,6 +4257,12 @@ with gr.Blocks(css="""
 
     # Admin Dashboard
     with gr.Column(visible=False) as admin_dashboard:
+        with gr.Row():
+            admin_sort = gr.Dropdown(label="Sort families by", choices=list(ADMIN_SORTS), value="Newest")
+            admin_prev_btn = gr.Button("⬅️ Previous page", variant="secondary")
+            admin_next_btn = gr.Button("Next page ➡️", variant="secondary")
+        admin_page = gr.State(1)
+        admin_state = gr.State(False)  # set by a successful admin login in this browser session
         admin_display = gr.HTML()
         gr.Markdown("### ➕ Create New Family")
         with gr.Row():
@@ -855,6 +4276,23 @@ with gr.Blocks(css="""
             delete_family_btn = gr.Button("Delete Family", variant="stop")
         delete_status = gr.Markdown("")
 
+        gr.Markdown("### 💾 Backup & Restore")
+        with gr.Row():
+            export_family_code = gr.Textbox(label="Family Code", placeholder="Leave empty to export all families")
+            export_btn = gr.Button("Export", variant="secondary")
+        export_status = gr.Markdown("")
+        export_files = gr.File(label="Export files", file_count="multiple", interactive=False)
+        export_dir = gr.State(None)  # temporary directory of the last export, removed once served
+        with gr.Row():
+            import_files = gr.File(label="Export to import (.ndjson + .blobs.tar)", file_count="multiple",
+                                   file_types=[".ndjson", ".tar"])
+            import_btn = gr.Button("Import", variant="primary")
+        import_status = gr.Markdown("")
+
+        with gr.Accordion("📈 Performance", open=False, visible=METRICS_ENABLED):
+            performance_refresh_btn = gr.Button("🔄 Refresh", variant="secondary")
+            performance_display = gr.HTML()
+
         admin_logout_btn = gr.Button("🚪 Logout", variant="secondary")
 
     # Login Section
@@ -890,77 +4328,129 @@ with gr.Blocks(css="""
     with gr.Column(visible=False) as main_app:
         with gr.Row():
             with gr.Column(scale=8):
-                with gr.Tab("🏠 Dashboard"):
-                    dashboard_display = gr.HTML()
-
-                with gr.Tab("📢 Announcements"):
-                    announcement_display = gr.HTML()
-                    with gr.Accordion("✍️ New Announcement", open=False):
-                        announcement_input = gr.Textbox(label="Message", lines=4,
-                            placeholder="Share important updates with the family...")
-                        announcement_priority = gr.Radio(
-                            label="Priority", choices=["normal", "high"], value="normal")
-                        post_btn = gr.Button("📣 Post", variant="primary")
-                        post_status = gr.Markdown("")
-
-                with gr.Tab("💬 Family Chat"):
-                    messages_display = gr.HTML()
-                    with gr.Row():
-                        message_input = gr.Textbox(label="", placeholder="Type message...",
-                            lines=2, scale=5)
-                        send_btn = gr.Button("📤 Send", scale=1, variant="primary")
-
-                with gr.Tab("📅 Events Calendar"):
-                    events_display = gr.HTML()
-                    with gr.Accordion("➕ Add Event", open=False):
-                        event_title = gr.Textbox(label="Event Title*")
+                with gr.Tabs() as main_tabs:
+                    with gr.Tab("🏠 Dashboard", id="dashboard") as dashboard_tab:
+                        dashboard_display = gr.HTML()
+
+                    with gr.Tab("📢 Announcements", id="announcements") as announcements_tab:
+                        announcement_display = gr.HTML()
+                        with gr.Accordion("✍️ New Announcement", open=False):
+                            announcement_input = gr.Textbox(label="Message", lines=4,
+                                placeholder="Share important updates with the family...")
+                            announcement_priority = gr.Radio(
+                                label="Priority", choices=["normal", "high"], value="normal")
+                            post_btn = gr.Button("📣 Post", variant="primary")
+                            post_status = gr.Markdown("")
+                        with gr.Accordion("💬 React & Comment", open=False):
+                            with gr.Row():
+                                announcement_number = gr.Number(label="Announcement #", precision=0)
+                                announcement_emoji = gr.Dropdown(label="Reaction",
+                                    choices=REACTION_EMOJIS, value=REACTION_EMOJIS[0])
+                                react_announcement_btn = gr.Button("React / Undo", variant="secondary")
+                            comment_input = gr.Textbox(label="Comment", lines=2)
+                            with gr.Row():
+                                comment_btn = gr.Button("💬 Comment", variant="primary")
+                                view_comments_btn = gr.Button("🧵 View Thread", variant="secondary")
+                            comment_status = gr.Markdown("")
+                            comments_limit = gr.State(COMMENTS_PAGE_SIZE)
+                            comments_display = gr.HTML()
+                            more_comments_btn = gr.Button("⬆️ Earlier comments", variant="secondary", size="sm")
+
+                    with gr.Tab("💬 Family Chat", id="messages") as messages_tab:
+                        load_older_btn = gr.Button("⬆️ Load older messages", variant="secondary", size="sm")
+                        messages_display = gr.HTML()
+                        with gr.Row():
+                            message_input = gr.Textbox(label="", placeholder="Type message...",
+                                lines=2, scale=5)
+                            send_btn = gr.Button("📤 Send", scale=1, variant="primary")
                         with gr.Row():
-                            event_date = gr.Textbox(label="Date (YYYY-MM-DD)*")
-                            event_time = gr.Textbox(label="Time (HH:MM)*")
-                        event_location = gr.Textbox(label="Location")
-                        add_event_btn = gr.Button("📅 Add Event", variant="primary")
-                        event_status = gr.Markdown("")
-
-                with gr.Tab("✅ Family Tasks"):
-                    tasks_display = gr.HTML()
-                    with gr.Accordion("➕ Add Task", open=False):
-                        task_input = gr.Textbox(label="Task Description*")
+                            message_number = gr.Number(label="Message #", precision=0)
+                            message_emoji = gr.Dropdown(label="Reaction",
+                                choices=REACTION_EMOJIS, value=REACTION_EMOJIS[0])
+                            react_message_btn = gr.Button("React / Undo", variant="secondary")
+                        message_react_status = gr.Markdown("")
+
+                    with gr.Tab("📅 Events Calendar", id="events") as events_tab:
+                        events_range = gr.Radio(label="Show", choices=EVENT_RANGES, value="Upcoming")
+                        events_limit = gr.State(EVENTS_PAGE_SIZE)
+                        events_display = gr.HTML()
+                        more_events_btn = gr.Button("⬇️ Show more events", variant="secondary", size="sm")
+                        with gr.Accordion("➕ Add Event", open=False):
+                            event_title = gr.Textbox(label="Event Title*")
+                            with gr.Row():
+                                event_date = gr.Textbox(label="Date (YYYY-MM-DD)*")
+                                event_time = gr.Textbox(label="Time (HH:MM)*")
+                            event_location = gr.Textbox(label="Location")
+                            add_event_btn = gr.Button("📅 Add Event", variant="primary")
+                            event_status = gr.Markdown("")
+
+                    with gr.Tab("✅ Family Tasks", id="tasks") as tasks_tab:
+                        tasks_view = gr.Radio(label="Show", choices=TASK_VIEWS, value="All")
+                        tasks_display = gr.HTML()
+                        with gr.Accordion("➕ Add Task", open=False):
+                            task_input = gr.Textbox(label="Task Description*")
+                            with gr.Row():
+                                # Filled with the family's members when the tab opens
+                                task_assigned = gr.Dropdown(label="Assign To*",
+                                    choices=[], allow_custom_value=True)
+                                task_due = gr.Textbox(label="Due Date (YYYY-MM-DD)*")
+                            add_task_btn = gr.Button("✅ Add Task", variant="primary")
+                            task_status = gr.Markdown("")
+                        with gr.Accordion("✏️ Update Task", open=False):
+                            with gr.Row():
+                                task_number = gr.Number(label="Task #", precision=0)
+                                task_reassign_to = gr.Dropdown(label="Reassign To",
+                                    choices=[], allow_custom_value=True)
+                            with gr.Row():
+                                complete_task_btn = gr.Button("✅ Mark Completed", variant="primary")
+                                reassign_task_btn = gr.Button("👤 Reassign", variant="secondary")
+                            task_update_status = gr.Markdown("")
+
+                    with gr.Tab("📸 Photo Gallery", id="photos") as photos_tab:
+                        photos_display = gr.HTML()
+                        with gr.Accordion("📤 Upload Photo", open=False):
+                            # image_mode=None: Gradio hands over the file as uploaded instead of
+                            # decoding and re-saving it; open_image vets it before any decode
+                            photo_upload = gr.Image(type="filepath", label="Select Photo", image_mode=None)
+                            photo_caption = gr.Textbox(label="Caption", placeholder="Add a caption...")
+                            upload_photo_btn = gr.Button("📸 Upload", variant="primary")
+                            photo_status = gr.Markdown("")
+
+                    with gr.Tab("📊 Polls", id="polls") as polls_tab:
+                        polls_display = gr.HTML()
+                        with gr.Accordion("➕ Create Poll", open=False):
+                            poll_question = gr.Textbox(label="Question*", placeholder="What should we do this weekend?")
+                            poll_options = gr.Textbox(label="Options (one per line)*",
+                                placeholder="Go to beach\nStay home\nVisit grandparents", lines=4)
+                            create_poll_btn = gr.Button("📊 Create Poll", variant="primary")
+                            poll_status = gr.Markdown("")
+                        with gr.Accordion("🗳️ Vote", open=False):
+                            with gr.Row():
+                                vote_poll_choice = gr.Dropdown(label="Poll", choices=[])
+                                vote_option = gr.Dropdown(label="Your vote", choices=[])
+                            vote_btn = gr.Button("🗳️ Vote", variant="primary")
+                            vote_status = gr.Markdown("")
+
+                    with gr.Tab("⭐ Stories (24h)", id="stories") as stories_tab:
+                        stories_display = gr.HTML()
+                        with gr.Accordion("➕ Post Story", open=False):
+                            story_content = gr.Textbox(label="Story", placeholder="Share what's happening... (expires in 24h)")
+                            story_image = gr.Image(type="filepath", label="Photo (optional)", image_mode=None)
+                            post_story_btn = gr.Button("⭐ Post Story", variant="primary")
+                            story_status = gr.Markdown("")
+
+                    with gr.Tab("🔍 Search", id="search") as search_tab:
                         with gr.Row():
-                            task_assigned = gr.Dropdown(label="Assign To*",
-                                choices=[])
-                            task_due = gr.Textbox(label="Due Date (YYYY-MM-DD)*")
-                        add_task_btn = gr.Button("✅ Add Task", variant="primary")
-                        task_status = gr.Markdown("")
-
-                with gr.Tab("📸 Photo Gallery"):
-                    photos_display = gr.HTML()
-                    with gr.Accordion("📤 Upload Photo", open=False):
-                        photo_upload = gr.Image(type="filepath", label="Select Photo")
-                        photo_caption = gr.Textbox(label="Caption", placeholder="Add a caption...")
-                        upload_photo_btn = gr.Button("📸 Upload", variant="primary")
-                        photo_status = gr.Markdown("")
-
-                with gr.Tab("📊 Polls"):
-                    polls_display = gr.HTML()
-                    with gr.Accordion("➕ Create Poll", open=False):
-                        poll_question = gr.Textbox(label="Question*", placeholder="What should we do this weekend?")
-                        poll_options = gr.Textbox(label="Options (one per line)*",
-                            placeholder="Go to beach\nStay home\nVisit grandparents", lines=4)
-                        create_poll_btn = gr.Button("📊 Create Poll", variant="primary")
-                        poll_status = gr.Markdown("")
-
-                with gr.Tab("⭐ Stories (24h)"):
-                    stories_display = gr.HTML()
-                    with gr.Accordion("➕ Post Story", open=False):
-                        story_content = gr.Textbox(label="Story", placeholder="Share what's happening... (expires in 24h)")
-                        post_story_btn = gr.Button("⭐ Post Story", variant="primary")
-                        story_status = gr.Markdown("")
-
-                with gr.Tab("👤 My Profile"):
-                    gr.Markdown("## 👤 Profile Settings")
-                    profile_pic_upload = gr.Image(type="filepath", label="Upload Profile Picture")
-                    update_pic_btn = gr.Button("📸 Update Profile Picture", variant="primary")
-                    profile_status = gr.Markdown("")
+                            search_query = gr.Textbox(label="", placeholder="Search messages, announcements, tasks and events...", scale=5)
+                            search_btn = gr.Button("🔍 Search", scale=1, variant="primary")
+                        search_results = gr.HTML()
+
+                    with gr.Tab("👤 My Profile", id="profile") as profile_tab:
+                        gr.Markdown("## 👤 Profile Settings")
+                        profile_pic_upload = gr.Image(type="filepath", label="Upload Profile Picture",
+                                                      image_mode=None)
+                        update_pic_btn = gr.Button("📸 Update Profile Picture", variant="primary")
+                        profile_status = gr.Markdown("")
 
             with gr.Column(scale=3):
                 family_display = gr.HTML()
@@ -987,7 +4477,8 @@ with gr.Blocks(css="""
     admin_login_btn.click(
         admin_login,
         inputs=[admin_username, admin_password],
-        outputs=[admin_section, admin_dashboard, admin_status, admin_display]
+        outputs=[admin_section, admin_dashboard, admin_status, admin_display, admin_state],
+        **lane("auth")
     )
 
     user_login_btn.click(
@@ -995,9 +4486,29 @@ with gr.Blocks(css="""
         outputs=[admin_section, login_section]
     )
 
+    app.load(open_family_login, outputs=[admin_section, login_section, login_family_code])
+
     admin_logout_btn.click(
-        lambda: (gr.update(visible=True), gr.update(visible=False), "", ""),
-        outputs=[admin_section, admin_dashboard, admin_status, admin_display]
+        lambda: (gr.update(visible=True), gr.update(visible=False), "", "", False),
+        outputs=[admin_section, admin_dashboard, admin_status, admin_display, admin_state]
+    )
+
+    admin_sort.change(
+        lambda sort: admin_change_page(sort, 1, 0),
+        inputs=[admin_sort],
+        outputs=[admin_display, admin_page]
+    )
+
+    admin_prev_btn.click(
+        lambda sort, page: admin_change_page(sort, page, -1),
+        inputs=[admin_sort, admin_page],
+        outputs=[admin_display, admin_page]
+    )
+
+    admin_next_btn.click(
+        lambda sort, page: admin_change_page(sort, page, 1),
+        inputs=[admin_sort, admin_page],
+        outputs=[admin_display, admin_page]
     )
 
     create_family_btn.click(
@@ -1012,90 +4523,368 @@ with gr.Blocks(css="""
         outputs=[delete_status, admin_display]
     ).then(lambda: "", outputs=[delete_family_code])
 
+    export_btn.click(
+        export_backup,
+        inputs=[export_family_code],
+        outputs=[export_status, export_files, export_dir]
+    ).then(remove_export, inputs=[export_dir], outputs=[export_dir])
+
+    import_btn.click(
+        import_backup,
+        inputs=[import_files],
+        outputs=[import_status, admin_display]
+    ).then(lambda: None, outputs=[import_files])
+
+    performance_refresh_btn.click(get_performance_html, inputs=[admin_state], outputs=[performance_display],
+                                  **private_api())
+
     back_to_admin_btn.click(
         lambda: (gr.update(visible=True), gr.update(visible=False)),
         outputs=[admin_section, login_section]
     )
 
     # User Event Handlers
-    login_btn.click(
+    # Outputs of live_updates: the chat, then LIVE_VIEW_BUILDERS in order
+    live_outputs = [messages_display, chat_state, dashboard_display, announcement_display,
+                    events_display, tasks_display, family_display, photos_display,
+                    polls_display, stories_display]
+
+    # Outputs of main_app_outputs, shared by login, register and logout
+    main_outputs = [main_tabs, dashboard_display, announcement_display, messages_display,
+                    events_display, tasks_display, family_display, photos_display,
+                    polls_display, stories_display, session_state, chat_state, tabs_state]
+
+    login_live = login_btn.click(
         login,
         inputs=[login_family_code, login_username, login_password],
-        outputs=[login_section, main_app, login_status, dashboard_display,
-                announcement_display, messages_display, events_display,
-                tasks_display, family_display, photos_display, polls_display, stories_display]
-    )
-
-    register_btn.click(
+        outputs=[login_section, main_app, login_status, *main_outputs],
+        **lane("auth")
+    ).then(
+        open_family_panel, inputs=[session_state, tabs_state], outputs=[family_display],
+        show_progress="hidden"
+    ).then(live_updates, inputs=[session_state, chat_state, tabs_state], outputs=live_outputs,
+           concurrency_limit=None, show_progress="hidden")
+
+    register_live = register_btn.click(
         register,
         inputs=[reg_family_code, reg_name, reg_username, reg_password, reg_role,
                reg_avatar, reg_status, reg_birthday, reg_bio, reg_email],
-        outputs=[register_status, login_section, main_app, dashboard_display,
-                announcement_display, messages_display, events_display,
-                tasks_display, family_display, photos_display, polls_display, stories_display]
-    )
+        outputs=[register_status, login_section, main_app, *main_outputs],
+        **lane("auth")
+    ).then(
+        open_family_panel, inputs=[session_state, tabs_state], outputs=[family_display],
+        show_progress="hidden"
+    ).then(live_updates, inputs=[session_state, chat_state, tabs_state], outputs=live_outputs,
+           concurrency_limit=None, show_progress="hidden")
 
     logout_btn.click(
         logout,
-        outputs=[login_section, main_app, login_status, dashboard_display,
-                announcement_display, messages_display, events_display,
-                tasks_display, family_display, photos_display, polls_display, stories_display]
+        outputs=[login_section, main_app, login_status, *main_outputs],
+        cancels=[login_live, register_live]
     )
 
+    # Tabs render on first selection (see TAB_VIEWS)
+    for tab, display in [(announcements_tab, announcement_display), (events_tab, events_display),
+                         (tasks_tab, tasks_display), (photos_tab, photos_display),
+                         (polls_tab, polls_display), (stories_tab, stories_display)]:
+        tab.select(
+            partial(open_tab, tab.id), inputs=[session_state, tabs_state], outputs=[display],
+            api_name=f"open_{tab.id}", show_progress="hidden", **lane("views")
+        )
+
+    messages_tab.select(
+        open_chat, inputs=[session_state, chat_state, tabs_state], outputs=[messages_display, chat_state],
+        api_name="open_messages", show_progress="hidden", **lane("chat")
+    )
+
+    for tab in (dashboard_tab, search_tab, profile_tab):
+        tab.select(
+            partial(note_tab, tab.id), inputs=[session_state, tabs_state], outputs=None,
+            api_name=f"open_{tab.id}", show_progress="hidden"
+        )
+
     post_btn.click(
         post_announcement,
-        inputs=[announcement_input, announcement_priority],
+        inputs=[announcement_input, announcement_priority, session_state],
         outputs=[post_status, announcement_display]
     ).then(lambda: ("", "normal"), outputs=[announcement_input, announcement_priority])
 
+    react_announcement_btn.click(
+        react_to_announcement,
+        inputs=[announcement_number, announcement_emoji, session_state],
+        outputs=[comment_status, announcement_display]
+    )
+
+    comment_btn.click(
+        comment_on_announcement,
+        inputs=[announcement_number, comment_input, session_state],
+        outputs=[comment_status, announcement_display, comments_display]
+    ).then(lambda: ("", COMMENTS_PAGE_SIZE), outputs=[comment_input, comments_limit])
+
+    view_comments_btn.click(
+        show_comments,
+        inputs=[announcement_number, session_state],
+        outputs=[comments_display, comments_limit]
+    )
+
+    more_comments_btn.click(
+        show_more_comments,
+        inputs=[announcement_number, comments_limit, session_state],
+        outputs=[comments_display, comments_limit]
+    )
+
+    react_message_btn.click(
+        react_to_message,
+        inputs=[message_number, message_emoji, session_state, chat_state],
+        outputs=[message_react_status, messages_display, chat_state],
+        **lane("chat")
+    )
+
     send_btn.click(
         send_message,
-        inputs=[message_input],
-        outputs=[message_input, messages_display]
+        inputs=[message_input, session_state, chat_state],
+        outputs=[message_input, messages_display, chat_state],
+        **lane("chat")
     )
 
     message_input.submit(
         send_message,
-        inputs=[message_input],
-        outputs=[message_input, messages_display]
+        inputs=[message_input, session_state, chat_state],
+        outputs=[message_input, messages_display, chat_state],
+        **lane("chat")
+    )
+
+    load_older_btn.click(
+        load_older_messages,
+        inputs=[session_state, chat_state],
+        outputs=[messages_display, chat_state],
+        **lane("chat")
+    )
+
+    events_range.change(
+        show_events,
+        inputs=[events_range, session_state],
+        outputs=[events_display, events_limit]
+    )
+
+    more_events_btn.click(
+        show_more_events,
+        inputs=[events_range, events_limit, session_state],
+        outputs=[events_display, events_limit]
     )
 
     add_event_btn.click(
         add_event,
-        inputs=[event_title, event_date, event_time, event_location],
+        inputs=[event_title, event_date, event_time, event_location, session_state],
         outputs=[event_status, events_display]
-    ).then(lambda: ("", "", "", ""),
-          outputs=[event_title, event_date, event_time, event_location])
+    ).then(lambda: ("", "", "", "", "Upcoming", EVENTS_PAGE_SIZE),
+          outputs=[event_title, event_date, event_time, event_location, events_range, events_limit])
 
     add_task_btn.click(
         add_task,
-        inputs=[task_input, task_assigned, task_due],
+        inputs=[task_input, task_assigned, task_due, session_state, tabs_state],
         outputs=[task_status, tasks_display]
     ).then(lambda: ("", None, ""), outputs=[task_input, task_assigned, task_due])
 
+    tasks_tab.select(task_assignee_choices, inputs=[session_state], outputs=[task_assigned, task_reassign_to])
+
+    tasks_view.change(
+        show_tasks,
+        inputs=[tasks_view, session_state, tabs_state],
+        outputs=[tasks_display]
+    )
+
+    complete_task_btn.click(
+        complete_task,
+        inputs=[task_number, session_state, tabs_state],
+        outputs=[task_update_status, tasks_display]
+    )
+
+    reassign_task_btn.click(
+        reassign_task,
+        inputs=[task_number, task_reassign_to, session_state, tabs_state],
+        outputs=[task_update_status, tasks_display]
+    )
+
     upload_photo_btn.click(
-        upload_photo,
-        inputs=[photo_upload, photo_caption],
-        outputs=[photo_status, photos_display]
+        upload_photo_async,
+        inputs=[photo_upload, photo_caption, session_state],
+        outputs=[photo_status, photos_display],
+        api_name="upload_photo", **lane("uploads")
     ).then(lambda: (None, ""), outputs=[photo_upload, photo_caption])
 
+    vote_poll_choice.focus(
+        poll_choices,
+        inputs=[session_state],
+        outputs=[vote_poll_choice]
+    )
+
+    vote_poll_choice.change(
+        poll_option_choices,
+        inputs=[vote_poll_choice, session_state],
+        outputs=[vote_option]
+    )
+
+    vote_btn.click(
+        vote_poll,
+        inputs=[vote_poll_choice, vote_option, session_state],
+        outputs=[vote_status, polls_display]
+    )
+
     create_poll_btn.click(
         create_poll,
-        inputs=[poll_question, poll_options],
+        inputs=[poll_question, poll_options, session_state],
         outputs=[poll_status, polls_display]
     ).then(lambda: ("", ""), outputs=[poll_question, poll_options])
 
     post_story_btn.click(
-        post_story,
-        inputs=[story_content],
-        outputs=[story_status, stories_display]
-    ).then(lambda: "", outputs=[story_content])
+        post_story_async,
+        inputs=[story_content, story_image, session_state],
+        outputs=[story_status, stories_display],
+        api_name="post_story", **lane("uploads")
+    ).then(lambda: ("", None), outputs=[story_content, story_image])
+
+    search_btn.click(
+        search_family,
+        inputs=[search_query, session_state],
+        outputs=[search_results]
+    )
+
+    search_query.submit(
+        search_family,
+        inputs=[search_query, session_state],
+        outputs=[search_results]
+    )
 
     update_pic_btn.click(
-        update_profile_picture,
-        inputs=[profile_pic_upload],
-        outputs=[profile_status, family_display]
+        update_profile_picture_async,
+        inputs=[profile_pic_upload, session_state],
+        outputs=[profile_status, family_display],
+        api_name="update_profile_picture", **lane("uploads")
     ).then(lambda: None, outputs=[profile_pic_upload])
 
+if METRICS_ENABLED:
+    instrument_handlers(app)
+
+# Sessions are isolated per browser, so handlers can run in parallel
+CONCURRENCY_LIMIT = int(os.environ.get("FAMILYCONNECT_CONCURRENCY", "16"))
+BLOB_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Serve through Gradio's own launch() with a public share link instead of the
+# plain server (the Colab path); on by default inside Colab
+SHARE_LINK = os.environ.get("FAMILYCONNECT_SHARE", "1" if "google.colab" in sys.modules else "0") == "1"
+
+def add_server_routes(server):
+    """Stored images under BLOB_ROUTE (and metrics) on a FastAPI app: our own or Gradio's"""
+    from fastapi import Request, Response
+    from fastapi.responses import FileResponse, PlainTextResponse
+
+    @server.get(BLOB_ROUTE + "/{key}")
+    def get_blob(key: str, request: Request):
+        if not blobs.exists(key):
+            return Response(status_code=404)
+        # Content-addressed: the digest is a strong validator and the bytes never change
+        headers = {"ETag": f'"{key.split(".")[0]}"', "Cache-Control": BLOB_CACHE_CONTROL}
+        if request.headers.get("if-none-match") == headers["ETag"]:
+            return Response(status_code=304, headers=headers)
+        return FileResponse(blobs.path(key), media_type=BLOB_CONTENT_TYPES[key.rsplit(".", 1)[1]],
+                            headers=headers)
+
+    if METRICS_ENABLED:
+        @server.get(METRICS_ROUTE)
+        def get_metrics():
+            return PlainTextResponse(metrics.prometheus_text(), media_type="text/plain; version=0.0.4")
+
+def app_styling(start):
+    """css/theme arguments for mount_gradio_app or launch: newer Gradio applies them
+    there and ignores the Blocks arguments"""
+    if "css" not in inspect.signature(start).parameters:
+        return {}
+    return {"css": APP_CSS, "theme": APP_THEME}
+
+def create_server():
+    """FastAPI app serving the Gradio UI at / and stored images under BLOB_ROUTE"""
+    from fastapi import FastAPI
+
+    server = FastAPI()
+    add_server_routes(server)
+    app.queue(default_concurrency_limit=CONCURRENCY_LIMIT)
+    start_ttl_sweeper()
+    return gr.mount_gradio_app(server, app, path="/", **app_styling(gr.mount_gradio_app))
+
+def launch_shared(host, port):
+    """Run on Gradio's own server with a public share link (FAMILYCONNECT_SHARE=1)"""
+    app.queue(default_concurrency_limit=CONCURRENCY_LIMIT)
+    start_ttl_sweeper()
+    app.launch(share=True, server_name=host, server_port=port, prevent_thread_lock=True,
+               **app_styling(app.launch))
+    add_server_routes(app.app)  # Gradio creates its FastAPI app in launch()
+    app.block_thread()
+
+# Multi-process mode
+# FAMILYCONNECT_WORKERS=N runs N app processes on PORT+1..PORT+N, sharing the
+# SQLite store and a broker hub, behind a router on PORT. Gradio sessions live
+# in one process, so the router redirects rather than proxies: /family/CODE
+# sends the browser to that family's home worker, which then holds the hot
+# caches (hydrated family, indexes, rendered views) for its own families.
+CLUSTER_WORKERS = int(os.environ.get("FAMILYCONNECT_WORKERS", "1"))
+
+def create_router(ports):
+    """FastAPI app redirecting each family to its home worker"""
+    from fastapi import FastAPI, Request
+    from fastapi.responses import RedirectResponse
+
+    router = FastAPI()
+    rotation = itertools.count()
+
+    def worker_url(request, port, query=None):
+        url = f"{request.url.scheme}://{request.url.hostname}:{port}/"
+        return f"{url}?{urlencode(query)}" if query else url
+
+    @router.get("/family/{code}")
+    def family_home(code: str, request: Request):
+        port = ports[home_worker(code, len(ports))]
+        return RedirectResponse(worker_url(request, port, {"family": code}), status_code=307)
+
+    @router.get("/")
+    def landing(request: Request):
+        # No family yet (admin, new family): any worker will do
+        return RedirectResponse(worker_url(request, ports[next(rotation) % len(ports)]), status_code=307)
+
+    return router
+
+def run_cluster(workers, host, port):
+    """Start the broker hub and the worker processes, then serve the router"""
+    import uvicorn
+    if not os.environ.get("FAMILYCONNECT_DB"):
+        raise SystemExit("FAMILYCONNECT_WORKERS needs FAMILYCONNECT_DB: the workers share one SQLite store")
+    hub_path, hub_dir = os.environ.get("FAMILYCONNECT_BROKER_SOCKET"), None
+    if not hub_path:
+        hub_dir = tempfile.mkdtemp(prefix="familyconnect-")  # mode 0700: only this user can enter
+        hub_path = os.path.join(hub_dir, "broker.sock")
+    BrokerHub(hub_path).start()
+    ports = [port + 1 + i for i in range(workers)]
+    processes = []
+    for i, worker_port in enumerate(ports):
+        env = dict(os.environ, FAMILYCONNECT_WORKERS="1", PORT=str(worker_port),
+                   FAMILYCONNECT_BROKER=f"unix:{hub_path}", FAMILYCONNECT_NODE=f"worker-{i}")
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env))
+    try:
+        uvicorn.run(create_router(ports), host=host, port=port)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        if hub_dir is not None:
+            shutil.rmtree(hub_dir, ignore_errors=True)
+
 if __name__ == "__main__":
-    app.launch(share=True, debug=True)
+    host, port = os.environ.get("HOST", "0.0.0.0"), int(os.environ.get("PORT", "7860"))
+    if CLUSTER_WORKERS > 1:
+        run_cluster(CLUSTER_WORKERS, host, port)
+    elif SHARE_LINK:
+        launch_shared(host, port)
+    else:
+        import uvicorn
+        uvicorn.run(create_server(), host=host, port=port)
@@ -0,0 +1,408 @@
+"""
+FamilyConnect Pro - benchmarks and load generator
+
+  python benchmark.py handlers [--members 8 --messages 5000 --events 500 --photos 200 ...]
+  python benchmark.py load [--url http://host:7860/] [--families 1,2,4,8,16] [--members 3]
+  python benchmark.py memory [--items 200000]
+
+`handlers` builds a synthetic family directly in FamilyConnectDB and times every
+tab builder (cold: render cache dropped, and warm: served from it) plus the main
+mutators, reporting p50/p95/p99 latency and peak traced memory per operation.
+
+`load` drives the Gradio app over its HTTP API with N concurrent simulated
+families (each member is a separate gradio_client session), stepping N up until
+p95 latency exceeds --slo. Without --url it starts the app in-process on a free
+port; point it at a separately started server for numbers that don't share a
+GIL with the load generator.
+
+`memory` compares the bytes per item of the compact record types against the
+plain dict layout they replace, for every collection that has one.
+
+All honour FAMILYCONNECT_DB; images go to a temporary FAMILYCONNECT_BLOBS
+unless one is set.
+"""
+
+import argparse
+import os
+import random
+import re
+import resource
+import socket
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+os.environ.setdefault("FAMILYCONNECT_BLOBS", tempfile.mkdtemp(prefix="familyconnect-bench-"))
+
+import app
+from PIL import Image
+
+PASSWORD = "bench123"
+ROLES = ["Father", "Mother", "Son", "Daughter", "Grandparent", "Other"]
+WORDS = ("dinner pizza soccer school homework groceries movie garden holiday birthday "
+         "doctor dentist practice weekend grandma recipe trip beach camping piano").split()
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, round(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {"n": len(samples), "p50": percentile(samples, 50),
+            "p95": percentile(samples, 95), "p99": percentile(samples, 99)}
+
+def sentence(rng, words=8):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize()
+
+def make_test_image(path, size=(1600, 1200)):
+    """A JPEG with enough detail that encoding cost is realistic"""
+    img = Image.merge("RGB", [Image.radial_gradient("L"), Image.linear_gradient("L"),
+                              Image.effect_noise((256, 256), 64)]).resize(size)
+    img.save(path, "JPEG", quality=90)
+    return path
+
+# Synthetic data
+def build_family(code, members=8, messages=5000, events=500, photos=200, tasks=300,
+                 announcements=200, polls=50, stories=50, seed=0):
+    """Create a family of the given size straight through FamilyConnectDB (no handlers)"""
+    rng = random.Random(seed)
+    db = app.db
+    db.create_family(f"Bench Family {code}", code)
+    password = app.hash_password(PASSWORD)
+    usernames = [f"member{i}" for i in range(members)]
+    for i, username in enumerate(usernames):
+        db.put_user(code, username, {
+            "name": f"Member {i}", "avatar": "👤", "status": "Available", "password": password,
+            "role": ROLES[i % len(ROLES)], "birthday": f"19{60 + i % 40}-{1 + i % 12:02d}-{1 + i % 28:02d}",
+            "profile_pic": None, "bio": sentence(rng), "email": f"{username}@bench.test"
+        })
+    names = [f"Member {i}" for i in range(members)]
+    start = time.time() - 90 * 86400
+
+    def timestamp(i, total):
+        return app.datetime.fromtimestamp(start + 90 * 86400 * i / max(total, 1)).isoformat()
+
+    for i in range(messages):
+        author = rng.randrange(members)
+        db.add_record(code, "messages", {
+            "author": names[author], "role": ROLES[author % len(ROLES)], "content": sentence(rng),
+            "timestamp": timestamp(i, messages), "reactions": {}})
+    for i in range(announcements):
+        db.add_record(code, "announcements", {
+            "author": rng.choice(names), "role": rng.choice(ROLES), "content": sentence(rng, 20),
+            "timestamp": timestamp(i, announcements), "type": "text", "reactions": {},
+            "priority": rng.choice(["normal", "high"]), "comments": []})
+    today = app.date.today()
+    for i in range(events):
+        day = today + app.timedelta(days=rng.randrange(-180, 180))
+        db.add_record(code, "events", {
+            "title": sentence(rng, 3), "date": day.isoformat(), "time": f"{rng.randrange(8, 21):02d}:00",
+            "location": rng.choice(["Home", "School", "Park", "TBD"]), "creator": rng.choice(names),
+            "attendees": []})
+    for i in range(tasks):
+        db.add_record(code, "tasks", {
+            "task": sentence(rng, 4), "assigned_to": rng.choice(names),
+            "status": rng.choice(["pending", "completed"]),
+            "due": (today + app.timedelta(days=rng.randrange(-30, 30))).isoformat(),
+            "created_by": rng.choice(names)})
+    if photos:
+        image = make_test_image(os.path.join(tempfile.mkdtemp(), "photo.jpg"))
+        variants = app.process_image(image, app.PHOTO_VARIANTS)
+        for i in range(photos):
+            db.add_record(code, "photos", {
+                "blob": variants['full']['key'], "variants": variants, "caption": sentence(rng, 4),
+                "author": rng.choice(names), "timestamp": timestamp(i, photos)})
+    for i in range(polls):
+        options = list(dict.fromkeys(sentence(rng, 2) for _ in range(4)))
+        db.add_record(code, "polls", {
+            "question": sentence(rng, 6) + "?", "options": options, "counts": {opt: 0 for opt in options},
+            "voters": {}, "total": 0, "rev": 0, "creator": rng.choice(names),
+            "timestamp": timestamp(i, polls)})
+    now = time.time()
+    for i in range(stories):
+        db.add_record(code, "stories", {
+            "author": rng.choice(names), "role": rng.choice(ROLES), "content": sentence(rng),
+            "timestamp": app.datetime.fromtimestamp(now - 3600 * 20 * i / max(stories, 1)).isoformat()})
+    return usernames
+
+# Handler benchmarks
+BUILDERS = ["get_dashboard_html", "get_announcements_html", "get_messages_html", "get_events_html",
+            "get_tasks_html", "get_family_members_html", "get_photos_html", "get_polls_html",
+            "get_stories_html"]
+
+def payload_size(result):
+    """UTF-8 bytes of the HTML a handler returns (summed over tuple outputs)"""
+    parts = result if isinstance(result, tuple) else (result,)
+    return sum(len(part.encode()) for part in parts if isinstance(part, str))
+
+def handler_cases(code, session, rng, image):
+    """(name, callable, runs before each call) for everything `handlers` times"""
+    cases = []
+    for name in BUILDERS:
+        build = getattr(app, name)
+        cases.append((f"{name} (cold)", lambda build=build: build(session),
+                      lambda: app.render_cache.drop(code)))
+        cases.append((f"{name} (warm)", lambda build=build: build(session), None))
+    cases.append(("get_admin_dashboard_html", app.get_admin_dashboard_html, None))
+    cases.append(("login (kdf)", lambda: app.login(code, session['user'], PASSWORD), app.login_cache.clear))
+    cases.append(("login (cached)", lambda: app.login(code, session['user'], PASSWORD), None))
+    cases.append(("send_message", lambda: app.send_message(sentence(rng), session), None))
+    cases.append(("add_event", lambda: app.add_event(
+        sentence(rng, 3), (app.date.today() + app.timedelta(days=rng.randrange(60))).isoformat(),
+        "18:00", "Home", session), None))
+    cases.append(("upload_photo", lambda: app.upload_photo(image, sentence(rng, 4), session), None))
+    for view in app.TASK_VIEWS[1:]:
+        cases.append((f"tasks: {view.lower()}", lambda view=view: app.show_tasks(view, session, None), None))
+    task_ids = [task['id'] for task in app.db.get_family(code)['tasks']]
+    members = app.member_names(app.db.get_family(code))
+    cases.append(("reassign_task", lambda: app.reassign_task(rng.choice(task_ids), rng.choice(members),
+                                                            session, None), None))
+    announcement_ids = [item['id'] for item in app.db.get_family(code)['announcements']]
+    cases.append(("react_to_announcement", lambda: app.react_to_announcement(
+        rng.choice(announcement_ids), rng.choice(app.REACTION_EMOJIS), session), None))
+    cases.append(("comment_on_announcement", lambda: app.comment_on_announcement(
+        rng.choice(announcement_ids), sentence(rng), session), None))
+    return cases
+
+def run_handlers(args):
+    code = "BENCH001"
+    started = time.perf_counter()
+    usernames = build_family(code, args.members, args.messages, args.events, args.photos, args.tasks,
+                             args.announcements, args.polls, args.stories, seed=args.seed)
+    print(f"Built family {code} in {time.perf_counter() - started:.1f}s "
+          f"({args.members} members, {args.messages} messages, {args.events} events, {args.photos} photos)")
+    session = app.new_session(code, usernames[0])
+    rng = random.Random(args.seed)
+    image = make_test_image(os.path.join(tempfile.mkdtemp(), "upload.jpg"))
+
+    print(f"\n{'operation':<38}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak KiB':>11}{'out KiB':>10}")
+    for name, call, before in handler_cases(code, session, rng, image):
+        if args.only and not re.search(args.only, name):
+            continue
+        iterations = args.iterations if name not in ("upload_photo", "login (kdf)") else args.slow_iterations
+        samples = []
+        for _ in range(iterations):
+            if before:
+                before()
+            t0 = time.perf_counter()
+            result = call()
+            samples.append((time.perf_counter() - t0) * 1000)
+        # Memory is traced in a separate pass, since tracemalloc slows everything down
+        tracemalloc.start()
+        peak = 0
+        for _ in range(min(3, iterations)):
+            if before:
+                before()
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            call()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+        tracemalloc.stop()
+        stats = summarize(samples)
+        print(f"{name:<38}{stats['n']:>6}{stats['p50']:>10.2f}{stats['p95']:>10.2f}{stats['p99']:>10.2f}"
+              f"{peak / 1024:>11.0f}{payload_size(result) / 1024:>10.1f}")
+    print(f"\nProcess peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB")
+
+# Memory layout comparison
+def synthetic_items(collection, n, rng):
+    """`n` items in their dict layout, as they come out of json.loads"""
+    names = [f"Member {i}" for i in range(8)]
+    now = time.time()
+    for i in range(n):
+        author = rng.randrange(len(names))
+        timestamp = app.datetime.fromtimestamp(now - i * 60).isoformat()
+        if collection == "messages":
+            item = {"author": names[author], "role": ROLES[author % len(ROLES)], "content": sentence(rng),
+                    "timestamp": timestamp, "reactions": {}}
+        elif collection == "announcements":
+            item = {"author": names[author], "role": ROLES[author % len(ROLES)], "content": sentence(rng, 20),
+                    "timestamp": timestamp, "type": "text", "reactions": {}, "priority": "normal",
+                    "comments": []}
+        elif collection == "tasks":
+            item = {"task": sentence(rng, 4), "assigned_to": names[author], "status": "pending",
+                    "due": app.date.today().isoformat(), "created_by": rng.choice(names)}
+        elif collection == "events":
+            item = {"title": sentence(rng, 3), "date": app.date.today().isoformat(), "time": "18:00",
+                    "location": "Home", "creator": names[author], "attendees": []}
+        else:
+            item = {"author": names[author], "role": ROLES[author % len(ROLES)], "content": sentence(rng),
+                    "timestamp": timestamp}
+        item["id"] = i + 1
+        yield app.json.loads(app.json.dumps(item))
+
+def traced_size(build):
+    """(result, bytes allocated by build() and still alive)"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, size
+
+def run_memory(args):
+    print(f"{'collection':<16}{'items':>9}{'dict B/item':>13}{'compact B/item':>16}{'saved':>8}")
+    for collection in app.COMPACT_RECORD_TYPES:
+        source = list(synthetic_items(collection, args.items, random.Random(args.seed)))
+        payload = app.json.dumps(source)
+        del source
+        dicts, dict_size = traced_size(lambda: app.json.loads(payload))
+        del dicts
+        compact, compact_size = traced_size(
+            lambda: [app.compact_record(collection, item) for item in app.json.loads(payload)])
+        del compact
+        print(f"{collection:<16}{args.items:>9}{dict_size / args.items:>13.0f}"
+              f"{compact_size / args.items:>16.0f}{1 - compact_size / dict_size:>8.0%}")
+
+# Load generator
+# api_name: (weight, arguments factory)
+LOAD_ACTIONS = {
+    "/send_message": (45, lambda rng: (sentence(rng),)),
+    "/show_events": (15, lambda rng: (rng.choice(app.EVENT_RANGES),)),
+    "/search_family": (15, lambda rng: (rng.choice(WORDS),)),
+    "/add_event": (10, lambda rng: (sentence(rng, 3), (app.date.today() + app.timedelta(
+        days=rng.randrange(60))).isoformat(), "18:00", "Home")),
+    "/post_announcement": (10, lambda rng: (sentence(rng, 20), rng.choice(["normal", "high"]))),
+    # Every load family registers "Member 0" (see create_load_family)
+    "/add_task": (5, lambda rng: (sentence(rng, 4), "Member 0", (app.date.today() + app.timedelta(
+        days=rng.randrange(-7, 30))).isoformat())),
+}
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_embedded_server():
+    """Serve the app from a daemon thread; returns its URL"""
+    import uvicorn
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app.create_server(), host="127.0.0.1", port=port,
+                                           log_level="warning"))
+    threading.Thread(target=server.run, name="bench-server", daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}/"
+
+class LoadRecorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)  # api_name: latencies in ms
+        self.errors = defaultdict(int)
+
+    def call(self, client, api_name, *args):
+        t0 = time.perf_counter()
+        try:
+            result = client.predict(*args, api_name=api_name)
+        except Exception:
+            with self._lock:
+                self.errors[api_name] += 1
+            return None
+        elapsed = (time.perf_counter() - t0) * 1000
+        with self._lock:
+            self.samples[api_name].append(elapsed)
+        return result
+
+def create_load_family(url, index, members):
+    """Create a family and register its members through the API; returns (code, clients)"""
+    from gradio_client import Client
+    admin = Client(url, verbose=False)
+    status, _ = admin.predict(f"Load Family {index}", api_name="/create_new_family")
+    code = re.search(r"Code: (\w+)", status).group(1)
+    clients = []
+    for i in range(members):
+        client = Client(url, verbose=False)
+        client.predict(code, f"Member {i}", f"member{i}", PASSWORD, ROLES[i % len(ROLES)],
+                       "🧑", "Available", "", "", "", api_name="/register")
+        clients.append((f"member{i}", client))
+    return code, clients
+
+def simulate_member(recorder, client, code, username, stop_at, think, seed):
+    rng = random.Random(seed)
+    names = list(LOAD_ACTIONS)
+    weights = [LOAD_ACTIONS[name][0] for name in names]
+    recorder.call(client, "/login", code, username, PASSWORD)
+    while time.monotonic() < stop_at:
+        api_name = rng.choices(names, weights)[0]
+        recorder.call(client, api_name, *LOAD_ACTIONS[api_name][1](rng))
+        time.sleep(rng.expovariate(1 / think) if think else 0)
+
+def run_load(args):
+    url = args.url or start_embedded_server()
+    print(f"Driving {url} with {args.members} members per family, {args.think}s mean think time")
+    families = []
+    print(f"\n{'families':>8}{'users':>7}{'req/s':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for step in [int(n) for n in args.families.split(",")]:
+        while len(families) < step:
+            families.append(create_load_family(url, len(families), args.members))
+        recorder = LoadRecorder()
+        stop_at = time.monotonic() + args.duration
+        threads = [threading.Thread(target=simulate_member, daemon=True,
+                                    args=(recorder, client, code, username, stop_at, args.think, hash((code, username))))
+                   for code, clients in families[:step] for username, client in clients]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+        all_samples = [ms for samples in recorder.samples.values() for ms in samples]
+        stats = summarize(all_samples)
+        print(f"{step:>8}{len(threads):>7}{stats['n'] / elapsed:>8.1f}{stats['p50']:>10.1f}"
+              f"{stats['p95']:>10.1f}{stats['p99']:>10.1f}{sum(recorder.errors.values()):>8}")
+        if args.verbose:
+            for api_name, samples in sorted(recorder.samples.items()):
+                per_action = summarize(samples)
+                print(f"{'':>8}  {api_name:<22}{per_action['n']:>6}{per_action['p50']:>10.1f}"
+                      f"{per_action['p95']:>10.1f}{per_action['p99']:>10.1f}")
+        if stats['p95'] > args.slo * 1000:
+            print(f"\np95 above {args.slo}s SLO: latency collapses at about {step} families "
+                  f"({len(threads)} concurrent users)")
+            break
+
+def main():
+    parser = argparse.ArgumentParser(description="FamilyConnect Pro benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    handlers = commands.add_parser("handlers", help="time tab builders and mutators on a synthetic family")
+    handlers.add_argument("--members", type=int, default=8)
+    handlers.add_argument("--messages", type=int, default=5000)
+    handlers.add_argument("--events", type=int, default=500)
+    handlers.add_argument("--photos", type=int, default=200)
+    handlers.add_argument("--tasks", type=int, default=300)
+    handlers.add_argument("--announcements", type=int, default=200)
+    handlers.add_argument("--polls", type=int, default=50)
+    handlers.add_argument("--stories", type=int, default=50)
+    handlers.add_argument("--iterations", type=int, default=50)
+    handlers.add_argument("--slow-iterations", type=int, default=10,
+                          help="iterations for upload_photo and uncached login")
+    handlers.add_argument("--only", help="regex selecting which operations to run")
+    handlers.add_argument("--seed", type=int, default=0)
+
+    memory = commands.add_parser("memory", help="compare compact records with the dict layout")
+    memory.add_argument("--items", type=int, default=200000, help="items per collection")
+    memory.add_argument("--seed", type=int, default=0)
+
+    load = commands.add_parser("load", help="drive the app over HTTP with concurrent simulated families")
+    load.add_argument("--url", help="running app to target (default: start one in-process)")
+    load.add_argument("--families", default="1,2,4,8,16,32", help="comma-separated family counts to step through")
+    load.add_argument("--members", type=int, default=3, help="concurrent sessions per family")
+    load.add_argument("--duration", type=float, default=20, help="seconds per step")
+    load.add_argument("--think", type=float, default=0.5, help="mean seconds between a member's actions")
+    load.add_argument("--slo", type=float, default=2.0, help="p95 seconds at which to stop stepping up")
+    load.add_argument("--verbose", action="store_true", help="per-endpoint latencies for each step")
+
+    args = parser.parse_args()
+    if args.command == "handlers":
+        run_handlers(args)
+    elif args.command == "memory":
+        run_memory(args)
+    else:
+        run_load(args)
+
+if __name__ == "__main__":
+    main()